@@ -0,0 +1,162 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+from fastapi.responses import JSONResponse
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    """
+    Concurrency limit of one class of endpoints. Up to `concurrency` requests run at the same time,
+    up to `queue_size` more wait in arrival order, each for at most `max_wait` seconds. Requests beyond
+    the queue are rejected at once (429), requests whose wait runs out are rejected with 503, both with
+    a Retry-After estimated from the recent service times.
+
+    Only used from the event loop, so the bookkeeping needs no lock.
+    """
+
+    def __init__(self, name, concurrency, queue_size, max_wait):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+
+        self.active = 0
+        self.waiters = deque()
+        self.service_seconds = None  # Moving average of the time admitted requests took
+
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.peak_queue = 0
+        self.total_wait = 0.0
+        self.longest_wait = 0.0
+
+    async def acquire(self):
+        """
+        Waits for a slot, raises AdmissionRejected when the queue is full or the wait runs out.
+        """
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+
+        if len(self.waiters) >= self.queue_size:
+            self.rejected_queue_full += 1
+            raise AdmissionRejected(429, f"Too many {self.name} requests waiting, please retry later.", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        self.peak_queue = max(self.peak_queue, len(self.waiters))
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self._discard(future)
+            self.rejected_timeout += 1
+            raise AdmissionRejected(503, f"The server is busy with {self.name} requests, please retry later.", self.retry_after())
+        except BaseException:
+            # The client went away while waiting, a slot handed over meanwhile goes to the next waiter
+            self._discard(future)
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.total_wait += waited
+            self.longest_wait = max(self.longest_wait, waited)
+
+        # The slot was handed over by `release`, `active` already counts it
+        self.admitted += 1
+
+    def release(self, service_seconds=None):
+        """
+        Frees the slot of a finished request, handing it straight to the oldest waiter if any.
+        """
+        if service_seconds is not None:
+            self.service_seconds = service_seconds if self.service_seconds is None else 0.8 * self.service_seconds + 0.2 * service_seconds
+
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def retry_after(self):
+        """
+        Seconds until the requests ahead should be served: the queue drained at the recent service time.
+        """
+        service = self.service_seconds if self.service_seconds is not None else 1.0
+        return max(1, math.ceil(service * (len(self.waiters) + 1) / self.concurrency))
+
+    def _discard(self, future):
+        try:
+            self.waiters.remove(future)
+        except ValueError:
+            pass
+
+    def stats(self):
+        finished_waits = self.admitted + self.rejected_timeout
+        return {
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "max_wait_seconds": self.max_wait,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "peak_queue": self.peak_queue,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "average_wait_ms": round(self.total_wait / finished_waits * 1000, 3) if finished_waits else 0.0,
+            "longest_wait_ms": round(self.longest_wait * 1000, 3),
+            "average_service_ms": round(self.service_seconds * 1000, 3) if self.service_seconds is not None else None,
+        }
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the limiter of each endpoint class to its HTTP routes. A request holds its
+    slot until the response has been fully sent, so streamed responses count for their whole duration.
+    Routes without a class (and WebSockets) are not limited.
+
+    Args:
+        app: The wrapped ASGI application.
+        limiters (dict): AdmissionLimiter per endpoint class.
+        routes (dict): Endpoint class per path.
+    """
+
+    def __init__(self, app, limiters, routes):
+        self.app = app
+        self.limiters = limiters
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        endpoint_class = self.routes.get(scope["path"]) if scope["type"] == "http" else None
+        if endpoint_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = self.limiters[endpoint_class]
+        try:
+            await limiter.acquire()
+        except AdmissionRejected as rejected:
+            response = JSONResponse({"detail": rejected.detail}, status_code=rejected.status_code,
+                                    headers={"Retry-After": str(rejected.retry_after)})
+            await response(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(time.perf_counter() - started)
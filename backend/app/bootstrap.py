@@ -0,0 +1,127 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app.updated_model import (
+    get_sheet_constants_from_proportions, add_columns_batch, linear_fit_batch,
+    optimize_q_batch, double_modified_q_batch, double_modified_packing_density
+)
+
+
+def resample_means(fractions, total, sp_gravity, indices):
+    """
+    Averages the samples picked by `indices` (one resample per row), ignoring missing values like the
+    groupby mean of `average_samples_per_date`.
+
+    Returns:
+        tuple: (fractions, total, sp_gravity) means of shapes (B, M), (B,) and (B,).
+    """
+    def nan_mean(values):
+        picked = values[indices]
+        counts = (~np.isnan(picked)).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, np.nansum(picked, axis=1) / counts, np.nan)
+
+    return nan_mean(fractions), nan_mean(total), nan_mean(sp_gravity)
+
+
+def evaluate_resamples(cube, samples, indices, proportions_dict, packing_density):
+    """
+    Runs GBD and the three q-value methods for a batch of resamples of one date.
+
+    Args:
+        cube (SieveCube): Averaged samples of the uploaded workbook.
+        samples (list): Per sheet, the (fractions, total, sp_gravity) samples from `cube.replicates_for`.
+        indices (list): Per sheet, the picked samples of every resample, shape (B, R).
+        proportions_dict (dict): Proportions keyed by sheet name.
+        packing_density (float): Packing density used for GBD and the Modified Andreasen method.
+
+    Returns:
+        dict: Arrays of shape (B,) for gbd, q_value, r_squared, modified_q and double_modified_q.
+    """
+    proportions = cube.proportion_vector(proportions_dict)
+    cpft_proportions = cube.proportion_vector(proportions_dict, default=1)
+
+    total_volume = 0
+    cpft_blocks, row_proportions = [], []
+    for s, ((fractions, total, sp_gravity), picked) in enumerate(zip(samples, indices)):
+        fractions, total, sp_gravity = resample_means(fractions, total, sp_gravity, picked)
+        total_volume = total_volume + total * proportions[s] / sp_gravity
+
+        # Cumulative weights (sum of all finer fractions) weighted by the sheet proportion
+        filled = np.nan_to_num(fractions)
+        cumulative = np.cumsum(filled[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        cpft_blocks.append(cumulative * cpft_proportions[s])
+        row_proportions.extend([cpft_proportions[s]] * cumulative.shape[1])
+
+    plan = cube.mesh_plan
+    sheet_cpft = np.hstack(cpft_blocks)[:, plan.gather]
+    sheet_constants = get_sheet_constants_from_proportions(proportions_dict)
+    D_values, normalized_d, pct_CPFT = add_columns_batch(
+        sheet_cpft, plan, np.array(row_proportions)[plan.gather], proportions_dict, sheet_constants)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        q_value, _, r_squared = linear_fit_batch(np.log(normalized_d), np.log(pct_CPFT))
+        modified_q = optimize_q_batch(D_values, pct_CPFT * packing_density)
+        double_modified_q = double_modified_q_batch(D_values, pct_CPFT * double_modified_packing_density)
+
+    return {
+        "gbd": 100 / total_volume * packing_density,
+        "q_value": q_value,
+        "r_squared": r_squared,
+        "modified_q": modified_q,
+        "double_modified_q": double_modified_q,
+    }
+
+
+def bootstrap_confidence_intervals(cube, rows, proportions_dict, packing_density, n_resamples=2000,
+                                   confidence=0.95, seed=None, chunk_size=500, max_workers=None):
+    """
+    Bootstrap confidence intervals of GBD and the q-values of one date.
+
+    The individual samples of every sheet are resampled with replacement, each resample is averaged
+    and run through the cumulative weights, sheet CPFT and fitting stages as whole arrays. Resamples are
+    evaluated in chunks on a thread pool.
+
+    Args:
+        cube (SieveCube): Averaged samples of the uploaded workbook.
+        rows (np.ndarray): Cube rows of the date, shape (S,).
+        proportions_dict (dict): Proportions keyed by sheet name.
+        packing_density (float): Packing density used for GBD and the Modified Andreasen method.
+        n_resamples (int): Number of bootstrap resamples.
+        confidence (float): Confidence level of the percentile intervals.
+        seed (int): Seed of the random generator, for reproducible intervals.
+        chunk_size (int): Resamples evaluated together by one worker.
+        max_workers (int): Number of worker threads, defaults to the number of CPUs.
+
+    Returns:
+        dict: Per result, the estimate (from all samples), lower and upper bounds and standard error,
+        and the number of samples of every sheet.
+    """
+    samples = cube.replicates_for(rows)
+    rng = np.random.default_rng(seed)
+    indices = [rng.integers(0, len(total), size=(n_resamples, len(total))) for _, total, _ in samples]
+
+    estimate = evaluate_resamples(cube, samples, [np.arange(len(total))[None, :] for _, total, _ in samples],
+                                  proportions_dict, packing_density)
+
+    chunks = [[picked[start:start + chunk_size] for picked in indices] for start in range(0, n_resamples, chunk_size)]
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        results = list(executor.map(
+            lambda chunk: evaluate_resamples(cube, samples, chunk, proportions_dict, packing_density), chunks))
+
+    tail = (1 - confidence) / 2 * 100
+    intervals = {}
+    for name in estimate:
+        values = np.concatenate([result[name] for result in results])
+        lower, upper = np.nanpercentile(values, [tail, 100 - tail])
+        intervals[name] = {
+            "estimate": round(float(estimate[name][0]), 4),
+            "lower": round(float(lower), 4),
+            "upper": round(float(upper), 4),
+            "std_error": round(float(np.nanstd(values, ddof=1)), 4),
+        }
+
+    intervals["samples"] = {sheet_name: len(total) for sheet_name, (_, total, _) in zip(cube.sheets, samples)}
+    return intervals
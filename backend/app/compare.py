@@ -0,0 +1,20 @@
+from app.updated_model import summarize_dates_batch
+
+
+# Worker side of /compare/. It lives apart from app.updated_main so that the "spawn" worker processes
+# only import the calculation modules, not the server setup (result store, job pool, admission limiters).
+
+def compare_dataset(cube, dates, proportions_dict, packing_density):
+    """
+    Summary rows of one dataset for every date, computed in one vector pass, run in a worker process.
+
+    Args:
+        cube (SieveCube): Averaged samples of the dataset, from `SieveCube.without_replicates`.
+        dates (pd.DatetimeIndex): Dates to calculate.
+        proportions_dict (dict): Proportions keyed by sheet name.
+        packing_density (float): Packing density used for the GBD and the Modified Andreasen method.
+
+    Returns:
+        list: One row per date with GBD and all q-values, or the error of that date.
+    """
+    return summarize_dates_batch(cube, dates, proportions_dict, packing_density)
@@ -0,0 +1,79 @@
+import os
+
+from openpyxl import Workbook
+
+
+# Sheets of the export, one per method, with the summary columns written to each
+method_sheets = {
+    "GBD": ["total_volume", "specific_gravity", "gbd"],
+    "Andreasen": ["q_value", "r_squared"],
+    "Modified Andreasen": ["modified_q", "mae"],
+    "Double Modified": ["double_modified_q"],
+}
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def excel_values(df):
+    """
+    Rows of a DataFrame as plain values, missing values as empty cells.
+    """
+    for row in df.astype(object).where(df.notna(), None).itertuples(index=False):
+        yield list(row)
+
+
+def write_results_workbook(path, date_results, include_intermediate=False):
+    """
+    Writes per-date results to an .xlsx file with openpyxl's write-only mode. Rows are written to
+    temporary files as they come and every per-date sheet is closed once written, so memory stays flat
+    whatever the number of dates.
+
+    Args:
+        path (str): File to write.
+        date_results (iterable): (summary row, intermediate table or None, error or None) per date, where
+            the summary row is a dict from `summarize_all_methods` (only 'Date' when the date failed).
+        include_intermediate (bool): Also write the intermediate table of every date to its own sheet.
+
+    Returns:
+        int: Number of dates written.
+    """
+    workbook = Workbook(write_only=True)
+
+    sheets = {}
+    for title, columns in method_sheets.items():
+        sheets[title] = workbook.create_sheet(title)
+        sheets[title].append(["Date"] + columns)
+    errors = workbook.create_sheet("Errors")
+    errors.append(["Date", "error"])
+
+    count = 0
+    for summary, intermediate_df, error in date_results:
+        count += 1
+        if error is not None:
+            errors.append([summary["Date"], error])
+            continue
+
+        for title, columns in method_sheets.items():
+            sheets[title].append([summary["Date"]] + [summary[column] for column in columns])
+
+        if include_intermediate and intermediate_df is not None:
+            date_sheet = workbook.create_sheet(summary["Date"])
+            date_sheet.append(list(intermediate_df.columns))
+            for row in excel_values(intermediate_df):
+                date_sheet.append(row)
+            date_sheet.close()
+
+    workbook.save(path)
+    return count
+
+
+def iter_file_chunks(path, chunk_size=1 << 16):
+    """
+    Streams a file in chunks and deletes it once it has been sent (or the client went away).
+    """
+    try:
+        with open(path, "rb") as file:
+            while chunk := file.read(chunk_size):
+                yield chunk
+    finally:
+        os.remove(path)
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+
+# Kinds of sample changes between two uploads of a dataset
+
+ADDED = "added"
+MODIFIED = "modified"
+REMOVED = "removed"
+
+
+def format_date(date):
+    return pd.Timestamp(date).strftime("%d-%m-%Y")
+
+
+def same_layout(old_cube, new_cube):
+    """
+    True when both cubes have the same sheets, mesh columns and particle sizes, so that their results
+    can be compared date by date.
+    """
+    return (old_cube.sheets == new_cube.sheets and old_cube.mesh_columns == new_cube.mesh_columns
+            and np.array_equal(old_cube.d_values, new_cube.d_values, equal_nan=True))
+
+
+def changed_samples(old_cube, new_cube):
+    """
+    Averaged samples (one per sheet and date) that were added, modified or removed between two cubes
+    of the same layout.
+
+    Returns:
+        dict: {(sheet_name, datetime64): ADDED, MODIFIED or REMOVED}
+    """
+    changes = {}
+    for s, sheet_name in enumerate(new_cube.sheets):
+        old_dates = old_cube.dates[old_cube.available[:, s]]
+        new_dates = new_cube.dates[new_cube.available[:, s]]
+
+        for date in np.setdiff1d(new_dates, old_dates):
+            changes[(sheet_name, date)] = ADDED
+        for date in np.setdiff1d(old_dates, new_dates):
+            changes[(sheet_name, date)] = REMOVED
+
+        common = np.intersect1d(old_dates, new_dates)
+        old_rows = np.searchsorted(old_cube.dates, common)
+        new_rows = np.searchsorted(new_cube.dates, common)
+        old_values = np.column_stack([old_cube.fractions[old_rows, s], old_cube.total[old_rows, s], old_cube.sp_gravity[old_rows, s]])
+        new_values = np.column_stack([new_cube.fractions[new_rows, s], new_cube.total[new_rows, s], new_cube.sp_gravity[new_rows, s]])
+        differs = ~((old_values == new_values) | (np.isnan(old_values) & np.isnan(new_values))).all(axis=1)
+        for date in common[differs]:
+            changes[(sheet_name, date)] = MODIFIED
+
+    return changes
+
+
+def plan_recompute(new_cube, dates, tracked_inputs, changes):
+    """
+    Decides which per-date results have to be recomputed after a data change.
+
+    A result depends on the sample each sheet resolves to (exact or nearest past date). It is stale when
+    one of those samples was modified, or when a sheet now resolves to a different date (a sample was
+    added or removed in between). Results of dates never computed before are computed as new.
+
+    Args:
+        new_cube (SieveCube): Cube of the changed data.
+        dates (pd.DatetimeIndex): Dates of the results.
+        tracked_inputs (dict): Input dates per sheet of the existing results, keyed by date.
+        changes (dict): Output of `changed_samples`.
+
+    Returns:
+        tuple: (reused dates, {date: reasons} of the dates to recompute).
+    """
+    inputs = new_cube.input_dates(dates)
+    reused, recompute = [], {}
+
+    for date, date_inputs in zip(dates.values, inputs):
+        previous = tracked_inputs.get(date)
+        if previous is None:
+            recompute[date] = ["new date"]
+            continue
+
+        reasons = []
+        for sheet_name, old_input, new_input in zip(new_cube.sheets, previous, date_inputs):
+            if not (old_input == new_input or (np.isnat(old_input) and np.isnat(new_input))):
+                old_text = "none" if np.isnat(old_input) else format_date(old_input)
+                new_text = "none" if np.isnat(new_input) else format_date(new_input)
+                reasons.append(f"{sheet_name} now uses the sample of {new_text} instead of {old_text}")
+            elif changes.get((sheet_name, new_input)) == MODIFIED:
+                reasons.append(f"{sheet_name} sample of {format_date(new_input)} was modified")
+
+        if reasons:
+            recompute[date] = reasons
+        else:
+            reused.append(date)
+
+    return reused, recompute
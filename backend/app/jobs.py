@@ -0,0 +1,171 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Job states
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job function when the job has been cancelled by the client.
+    """
+
+
+class Job:
+    """
+    A long running computation submitted to the JobManager.
+
+    The job function receives the Job itself and reports progress with `advance()`. It should call
+    `check_cancelled()` between units of work so that cancellation takes effect promptly.
+    """
+
+    def __init__(self, kind, total, params=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params or {}
+        self.status = QUEUED
+        self.total = total
+        self.processed = 0
+        self.current = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+    def advance(self, current=None, count=1):
+        """
+        Marks `count` more units of work as processed, `current` describes the last unit (e.g. a date).
+        """
+        with self._lock:
+            self.processed += count
+            self.current = current
+
+    def eta_seconds(self):
+        """
+        Estimated remaining time based on the average time per processed unit so far.
+        """
+        if self.started_at is None or self.processed == 0 or not self.total:
+            return None
+        if self.status in FINISHED_STATES:
+            return 0.0
+        elapsed = time.time() - self.started_at
+        remaining = max(self.total - self.processed, 0)
+        return round(elapsed / self.processed * remaining, 2)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "status": self.status,
+                "params": self.params,
+                "processed": self.processed,
+                "total": self.total,
+                "current": self.current,
+                "eta_seconds": self.eta_seconds(),
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+
+class JobManager:
+    """
+    In-process job queue backed by a thread pool. No external broker is needed, jobs live as long as
+    the server process does.
+
+    Args:
+        max_workers (int): Number of jobs that may run at the same time, further jobs wait in the queue.
+        max_finished_jobs (int): Number of finished jobs kept for status/result lookups before the
+            oldest ones are discarded.
+    """
+
+    def __init__(self, max_workers=2, max_finished_jobs=100):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.max_finished_jobs = max_finished_jobs
+
+    def submit(self, kind, func, total, params=None):
+        """
+        Queues `func(job)` for execution and returns the Job. The return value of `func` becomes the
+        job result.
+        """
+        job = Job(kind, total, params)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict_finished()
+        self._executor.submit(self._run, job, func)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Requests cancellation. Queued jobs never start, running jobs stop at their next check.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel()
+        with job._lock:
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.finished_at = time.time()
+        return job
+
+    def _run(self, job, func):
+        with job._lock:
+            if job.status != QUEUED:
+                return
+            job.status = RUNNING
+            job.started_at = time.time()
+
+        try:
+            result = func(job)
+            status, error = COMPLETED, None
+        except JobCancelled:
+            result, status, error = None, CANCELLED, None
+        except Exception as e:
+            result, status, error = None, FAILED, str(e)
+
+        with job._lock:
+            job.result = result
+            job.status = status
+            job.error = error
+            job.finished_at = time.time()
+
+    def _evict_finished(self):
+        finished = [job for job in self._jobs.values() if job.status in FINISHED_STATES]
+        if len(finished) <= self.max_finished_jobs:
+            return
+        finished.sort(key=lambda job: job.finished_at or job.created_at)
+        for job in finished[:len(finished) - self.max_finished_jobs]:
+            del self._jobs[job.id]
@@ -0,0 +1,189 @@
+import os
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Kernels of the fitting and CPFT hot loops, in a NumPy version and, when numba is installed, a
+# JIT-compiled version. KERNEL_BACKEND selects them: "numpy", "numba" or "auto" (numba when installed).
+# Both versions take the same arguments and give the same results up to floating point rounding.
+# The compiled kernels release the GIL instead of starting threads of their own, the callers (bootstrap
+# chunks, background jobs, request handlers) already run on thread pools.
+
+golden_ratio = (np.sqrt(5) - 1) / 2
+
+
+def andreasen_cpft_numpy(D, q, D_min, D_max):
+    """
+    Modified Andreasen CPFT (as a fraction) of particle sizes `D`, element-wise with broadcasting.
+    """
+    return (D ** q - D_min ** q) / (D_max ** q - D_min ** q)
+
+
+def squared_error_numpy(D, D_min, D_max, valid, fractions, q):
+    predicted = andreasen_cpft_numpy(D, q[:, None], D_min[:, None], D_max[:, None])
+    return np.where(valid, (predicted - fractions) ** 2, 0).sum(axis=1)
+
+
+def golden_section_q_numpy(D, D_min, D_max, valid, fractions, low, high, iterations):
+    """
+    Golden-section search of the q minimising the squared error of every curve.
+
+    Args:
+        D (np.ndarray): Particle sizes of every curve, shape (B, R).
+        D_min, D_max (np.ndarray): Smallest and largest size of every curve among its valid rows, shape (B,).
+        valid (np.ndarray): Rows of every curve, shape (B, R).
+        fractions (np.ndarray): CPFT as fractions, shape (B, R).
+        low, high (float): Bounds of q.
+        iterations (int): Number of search steps.
+
+    Returns:
+        np.ndarray: q of every curve, shape (B,).
+    """
+    low = np.full(len(fractions), float(low))
+    high = np.full(len(fractions), float(high))
+
+    for _ in range(iterations):
+        left, right = high - golden_ratio * (high - low), low + golden_ratio * (high - low)
+        minimum_left = squared_error_numpy(D, D_min, D_max, valid, fractions, left) < squared_error_numpy(D, D_min, D_max, valid, fractions, right)
+        high = np.where(minimum_left, right, high)
+        low = np.where(minimum_left, low, left)
+
+    return (low + high) / 2
+
+
+def mean_absolute_error_numpy(D, D_min, D_max, valid, pct_CPFT, q):
+    """
+    Mean absolute error (in percent) between `pct_CPFT` and the Modified Andreasen CPFT of every curve,
+    over its valid rows. Shapes as in `golden_section_q_numpy`, `q` of shape (B,).
+    """
+    calculated = andreasen_cpft_numpy(D, q[:, None], D_min[:, None], D_max[:, None]) * 100
+    return np.where(valid, np.abs(pct_CPFT - calculated), 0).sum(axis=1) / valid.sum(axis=1)
+
+
+def carry_forward_numpy(pct_CPFT, carry, start=100.0):
+    """
+    Replaces, row after row, the cells flagged in `carry` by the last non-zero pct_CPFT of the same
+    curve (`start` before the first one). Works in place on `pct_CPFT`, shape (B, R).
+    """
+    previous = np.full(len(pct_CPFT), float(start))
+    for row in range(pct_CPFT.shape[1]):
+        pct_CPFT[:, row] = np.where(carry[:, row], previous, pct_CPFT[:, row])
+        previous = np.where(pct_CPFT[:, row] != 0, pct_CPFT[:, row], previous)
+    return pct_CPFT
+
+
+if numba is not None:
+    @numba.vectorize(["float64(float64, float64, float64, float64)"], cache=True)
+    def andreasen_cpft_numba(D, q, D_min, D_max):
+        return (D ** q - D_min ** q) / (D_max ** q - D_min ** q)
+
+    @numba.njit(cache=True, nogil=True, fastmath=True)
+    def squared_error_numba(log_D, log_min, log_max, fractions, q):
+        # One curve, valid rows only, with D ** q computed as exp(q * log D) from precomputed logarithms
+        base = np.exp(q * log_min)
+        denominator = np.exp(q * log_max) - base
+        total = 0.0
+        for row in range(log_D.shape[0]):
+            error = (np.exp(q * log_D[row]) - base) / denominator - fractions[row]
+            total += error * error
+        return total
+
+    @numba.njit(cache=True, nogil=True)
+    def golden_section_q_numba(D, D_min, D_max, valid, fractions, low, high, iterations):
+        ratio = (np.sqrt(5.0) - 1) / 2
+        q = np.empty(fractions.shape[0])
+        log_D = np.empty(fractions.shape[1])
+        curve_fractions = np.empty(fractions.shape[1])
+        for curve in range(fractions.shape[0]):
+            count = 0
+            for row in range(fractions.shape[1]):
+                if valid[curve, row]:
+                    log_D[count] = np.log(D[curve, row])
+                    curve_fractions[count] = fractions[curve, row]
+                    count += 1
+            log_min, log_max = np.log(D_min[curve]), np.log(D_max[curve])
+
+            # Golden-section steps keep one of the two inner points, so only one new error per step
+            lower, upper = low, high
+            left, right = upper - ratio * (upper - lower), lower + ratio * (upper - lower)
+            error_left = squared_error_numba(log_D[:count], log_min, log_max, curve_fractions[:count], left)
+            error_right = squared_error_numba(log_D[:count], log_min, log_max, curve_fractions[:count], right)
+            for _ in range(iterations):
+                if error_left < error_right:
+                    upper, right, error_right = right, left, error_left
+                    left = upper - ratio * (upper - lower)
+                    error_left = squared_error_numba(log_D[:count], log_min, log_max, curve_fractions[:count], left)
+                else:
+                    lower, left, error_left = left, right, error_right
+                    right = lower + ratio * (upper - lower)
+                    error_right = squared_error_numba(log_D[:count], log_min, log_max, curve_fractions[:count], right)
+            q[curve] = (lower + upper) / 2
+        return q
+
+    @numba.njit(cache=True, nogil=True)
+    def mean_absolute_error_numba(D, D_min, D_max, valid, pct_CPFT, q):
+        mae = np.empty(pct_CPFT.shape[0])
+        for curve in range(pct_CPFT.shape[0]):
+            denominator = D_max[curve] ** q[curve] - D_min[curve] ** q[curve]
+            total, count = 0.0, 0
+            for row in range(pct_CPFT.shape[1]):
+                if valid[curve, row]:
+                    calculated = (D[curve, row] ** q[curve] - D_min[curve] ** q[curve]) / denominator * 100
+                    total += abs(pct_CPFT[curve, row] - calculated)
+                    count += 1
+            mae[curve] = total / count if count else np.nan
+        return mae
+
+    @numba.njit(cache=True, nogil=True)
+    def carry_forward_numba(pct_CPFT, carry, start=100.0):
+        for curve in range(pct_CPFT.shape[0]):
+            previous = start
+            for row in range(pct_CPFT.shape[1]):
+                if carry[curve, row]:
+                    pct_CPFT[curve, row] = previous
+                if pct_CPFT[curve, row] != 0:
+                    previous = pct_CPFT[curve, row]
+        return pct_CPFT
+
+
+kernel_names = ["andreasen_cpft", "golden_section_q", "mean_absolute_error", "carry_forward"]
+
+
+def available_backends():
+    return ["numpy", "numba"] if numba is not None else ["numpy"]
+
+
+def use_backend(name):
+    """
+    Points the module level kernels (`andreasen_cpft`, `golden_section_q`, `mean_absolute_error`,
+    `carry_forward`) to the NumPy or numba versions.
+
+    Args:
+        name (str): "numpy", "numba" or "auto" (numba when installed, NumPy otherwise).
+
+    Returns:
+        str: Backend in use.
+
+    Raises:
+        ValueError: If the backend is unknown or numba is requested but not installed.
+    """
+    global backend
+    if name == "auto":
+        name = available_backends()[-1]
+    if name not in ("numpy", "numba"):
+        raise ValueError(f"Unknown kernel backend '{name}', expected 'numpy', 'numba' or 'auto'.")
+    if name not in available_backends():
+        raise ValueError("The numba kernel backend was requested but numba is not installed.")
+
+    for kernel in kernel_names:
+        globals()[kernel] = globals()[f"{kernel}_{name}"]
+    backend = name
+    return backend
+
+
+backend = use_backend(os.getenv("KERNEL_BACKEND", "auto"))
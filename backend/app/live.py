@@ -0,0 +1,110 @@
+import numpy as np
+
+from app.updated_model import (
+    get_sheet_constants_from_proportions, add_columns_stack, linear_fit_batch, optimize_q_batch,
+    calculate_mae_batch, double_modified_q_batch, double_modified_packing_density
+)
+
+
+# Summary values sent back to the dashboard, in the order of the summary rows
+result_names = ["total_volume", "specific_gravity", "gbd", "q_value", "r_squared", "modified_q", "mae", "double_modified_q"]
+
+
+class LivePipeline:
+    """
+    Pipeline state of one live dashboard session: the cube rows of the selected date and the output of
+    every stage. An update only reruns the stages depending (directly or through another stage) on an
+    input that changed, e.g. a new porosity reruns the GBD scaling and the Modified Andreasen fit but
+    not the table or the other fits.
+    """
+
+    # Inputs and stages every stage depends on, in computation order
+    stages = {
+        "rows": ("selected_date",),
+        "volume": ("rows", "proportions"),
+        "table": ("rows", "proportions"),
+        "gbd": ("volume", "packing_density"),
+        "andreasen": ("table",),
+        "modified_andreasen": ("table", "packing_density"),
+        "double_modified": ("table",),
+    }
+
+    def __init__(self, cube, selected_date, proportions, packing_density):
+        self.cube = cube
+        self.inputs = {"selected_date": selected_date, "proportions": proportions, "packing_density": packing_density}
+        self.outputs = {}
+
+    def update(self, **inputs):
+        """
+        Applies the given inputs (selected_date, proportions, packing_density) and reruns the stages that
+        depend on the changed ones. The inputs are left as they were when a stage fails.
+
+        Returns:
+            list: Names of the stages that were recomputed.
+        """
+        changed = {name for name, value in inputs.items() if self.inputs[name] != value}
+        previous = dict(self.inputs)
+        self.inputs.update(inputs)
+
+        recomputed = []
+        for stage, dependencies in self.stages.items():
+            if stage in self.outputs and not changed.intersection(dependencies):
+                continue
+            try:
+                self.outputs[stage] = getattr(self, f"_{stage}")()
+            except Exception:
+                # The failed update is not applied, and as outputs may now be inconsistent the next
+                # update recomputes everything
+                self.inputs = previous
+                self.outputs.clear()
+                raise
+            changed.add(stage)
+            recomputed.append(stage)
+
+        return recomputed
+
+    def results(self):
+        """
+        Current GBD and q-values, rounded like the summary rows. None for values that could not be fitted.
+        """
+        total_volume, density = self.outputs["volume"]
+        q_value, r_squared = self.outputs["andreasen"]
+        modified_q, mae = self.outputs["modified_andreasen"]
+        values = [total_volume, density, self.outputs["gbd"], q_value, r_squared, modified_q, mae, self.outputs["double_modified"]]
+        return {name: round(float(value), 4) if np.isfinite(value) else None for name, value in zip(result_names, values)}
+
+    def _rows(self):
+        return self.cube.rows_for(self.inputs["selected_date"])
+
+    def _volume(self):
+        total_volume, density = self.cube.gbd(self.outputs["rows"], self.inputs["proportions"])
+        return float(total_volume[0]), float(density[0])
+
+    def _table(self):
+        proportions = self.inputs["proportions"]
+        sheet_cpft, sheet_proportions = self.cube.cpft_rows(self.outputs["rows"], proportions)
+        D_values, normalized_d, pct_CPFT, keep = add_columns_stack(
+            sheet_cpft, self.cube.mesh_plan, sheet_proportions, proportions, get_sheet_constants_from_proportions(proportions))
+        return D_values, normalized_d, pct_CPFT, keep
+
+    def _gbd(self):
+        return self.outputs["volume"][1] * self.inputs["packing_density"]
+
+    def _andreasen(self):
+        _, normalized_d, pct_CPFT, keep = self.outputs["table"]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            q_value, _, r_squared = linear_fit_batch(np.log(normalized_d), np.log(pct_CPFT), keep)
+        return q_value[0], r_squared[0]
+
+    def _modified_andreasen(self):
+        D_values, _, pct_CPFT, keep = self.outputs["table"]
+        pct_poros_CPFT = pct_CPFT * self.inputs["packing_density"]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            modified_q = optimize_q_batch(D_values, pct_poros_CPFT, mask=keep)
+            mae = calculate_mae_batch(D_values, pct_poros_CPFT, modified_q, mask=keep)
+        return modified_q[0], mae[0]
+
+    def _double_modified(self):
+        D_values, _, pct_CPFT, keep = self.outputs["table"]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return double_modified_q_batch(D_values, pct_CPFT * double_modified_packing_density, mask=keep)[0]
@@ -0,0 +1,183 @@
+import json
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+
+# Version of the stored results. Bump it whenever a change to a calculation (fitting, rounding, mesh
+# handling) or to the shape of a stored response makes the results already stored outdated: a store
+# written with another version is emptied when it is opened.
+RESULT_SCHEMA_VERSION = 1
+
+schema = """
+CREATE TABLE IF NOT EXISTS results (
+    dataset_hash TEXT NOT NULL,
+    method TEXT NOT NULL,
+    date TEXT NOT NULL,
+    proportions TEXT NOT NULL,
+    packing_density TEXT NOT NULL,
+    window_days INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    response TEXT,
+    computed_at REAL NOT NULL,
+    PRIMARY KEY (dataset_hash, method, proportions, packing_density, window_days, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_by_date ON results (dataset_hash, date, method);
+"""
+
+key_columns = ("dataset_hash", "method", "date", "proportions", "packing_density", "window_days")
+
+
+def result_key(dataset_hash, method, date, proportions, packing_density=None, window_days=None):
+    """
+    Key of one stored result, with every part in the text form stored in the database: the date as
+    yyyy-mm-dd, the proportions comma separated in sheet order, an empty packing density for methods
+    that do not use one and 0 for no rolling window.
+
+    Args:
+        dataset_hash (str): SHA-256 of the uploaded workbook.
+        method (str): Calculation, e.g. the endpoint name or "summary" for the per-date summary rows.
+        date (pd.Timestamp): Calculated date.
+        proportions (dict or list): Proportions, in sheet order.
+        packing_density (float): Packing density, None when the method does not use it.
+        window_days (int): Rolling window in days, None for the daily means.
+    """
+    return (dataset_hash, method, pd.Timestamp(date).strftime("%Y-%m-%d"), format_proportions(proportions),
+            format_packing_density(packing_density), window_days or 0)
+
+
+def format_proportions(proportions):
+    values = proportions.values() if isinstance(proportions, dict) else proportions
+    return ",".join(repr(float(value)) for value in values)
+
+
+def format_packing_density(packing_density):
+    return "" if packing_density is None else repr(float(packing_density))
+
+
+class ResultStore:
+    """
+    Computed results kept in a local SQLite database, so that a scenario computed once (for a workbook,
+    date, proportions, packing density, method and rolling window) is read back from the primary key
+    index instead of being recomputed, also after a restart. Every result keeps a small summary of its
+    values, queryable as history, and optionally the full response of its endpoint.
+
+    One connection is shared by the worker threads, SQLite calls are serialized with a lock. The
+    `RESULT_SCHEMA_VERSION` of the stored results is kept in `PRAGMA user_version`, results stored by
+    another version are dropped on opening.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            if path != ":memory:":
+                self._connection.execute("PRAGMA journal_mode=WAL")
+            stored_version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+            if stored_version != RESULT_SCHEMA_VERSION:
+                self._connection.execute("DROP TABLE IF EXISTS results")
+                self._connection.execute(f"PRAGMA user_version = {RESULT_SCHEMA_VERSION}")
+            self._connection.executescript(schema)
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def get(self, key):
+        """
+        Stored response of a result, None when it has not been computed yet.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT response FROM results WHERE {' AND '.join(f'{column} = ?' for column in key_columns)}", key).fetchone()
+            if row is None or row[0] is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def get_summaries(self, keys):
+        """
+        Stored summaries of many results of the same scenario, by key. Keys not stored are left out.
+        """
+        if not keys:
+            return {}
+        dataset_hash, method, _, proportions, packing_density, window_days = keys[0]
+        dates = {key[2]: key for key in keys}
+
+        summaries = {}
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT date, summary FROM results WHERE dataset_hash = ? AND method = ? AND proportions = ? "
+                "AND packing_density = ? AND window_days = ? AND date BETWEEN ? AND ?",
+                (dataset_hash, method, proportions, packing_density, window_days, min(dates), max(dates)))
+            for date, summary in cursor:
+                if date in dates:
+                    summaries[dates[date]] = json.loads(summary)
+            self.hits += len(summaries)
+            self.misses += len(keys) - len(summaries)
+        return summaries
+
+    def put(self, key, summary, response=None):
+        self.put_many([(key, summary, response)])
+
+    def put_many(self, results):
+        """
+        Stores (key, summary, response) results, replacing any result stored with the same key.
+        """
+        now = time.time()
+        rows = [(*key, json.dumps(summary), None if response is None else json.dumps(response), now)
+                for key, summary, response in results]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO results ({', '.join(key_columns)}, summary, response, computed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.writes += len(rows)
+
+    def query(self, dataset_hash, method=None, start=None, end=None, proportions=None, packing_density=None,
+              window_days=None, limit=100, offset=0):
+        """
+        Stored results of a workbook ordered by date, filtered by any of the other key parts (in the
+        form of `result_key`).
+
+        Returns:
+            tuple: (number of matching results, list of result dicts for the requested page).
+        """
+        conditions, parameters = ["dataset_hash = ?"], [dataset_hash]
+        for column, operator, value in (("method", "=", method), ("date", ">=", start), ("date", "<=", end),
+                                        ("proportions", "=", proportions), ("packing_density", "=", packing_density),
+                                        ("window_days", "=", window_days)):
+            if value is not None:
+                conditions.append(f"{column} {operator} ?")
+                parameters.append(value)
+        where = " AND ".join(conditions)
+
+        with self._lock:
+            total = self._connection.execute(f"SELECT COUNT(*) FROM results WHERE {where}", parameters).fetchone()[0]
+            rows = self._connection.execute(
+                f"SELECT date, method, proportions, packing_density, window_days, summary, computed_at FROM results "
+                f"WHERE {where} ORDER BY date, method, proportions, packing_density, window_days LIMIT ? OFFSET ?",
+                [*parameters, limit, offset]).fetchall()
+
+        results = []
+        for date, method, proportions, packing_density, window_days, summary, computed_at in rows:
+            results.append({
+                "Date": pd.Timestamp(date).strftime("%d-%m-%Y"),
+                "method": method,
+                "proportions": [float(value) for value in proportions.split(",")],
+                "packing_density": float(packing_density) if packing_density else None,
+                "window_days": window_days or None,
+                "computed_at": pd.Timestamp(computed_at, unit="s").isoformat(timespec="seconds"),
+                **json.loads(summary),
+            })
+        return total, results
+
+    def stats(self):
+        with self._lock:
+            stored = self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {"path": self.path, "schema_version": RESULT_SCHEMA_VERSION, "stored": stored, "hits": self.hits, "misses": self.misses, "writes": self.writes,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0}
@@ -0,0 +1,363 @@
+import copy
+
+import numpy as np
+import pandas as pd
+
+from app.updated_model import average_samples_per_date, compile_mesh_plan
+
+
+class SieveCube:
+    """
+    Averaged sieve data of all sheets held as dense arrays indexed by (date, sheet, mesh column).
+
+    The cube is built once when a workbook is uploaded. GBD, cumulative weights and sheet CPFT are then
+    whole-array operations over any set of dates instead of per-sheet DataFrame lookups.
+
+    Attributes:
+        dates (np.ndarray): Sorted datetime64 union of the received dates of all sheets, shape (D,).
+        sheets (list): Sheet names (S), in workbook order.
+        mesh_columns (list): Mesh column names of each sheet.
+        fractions (np.ndarray): Averaged mesh fractions, shape (D, S, M). NaN where a sheet has no
+            sample on a date or fewer than M mesh columns.
+        total (np.ndarray): Averaged 'Total' per date and sheet, shape (D, S).
+        sp_gravity (np.ndarray): Averaged 'Sp. gravity' per date and sheet, shape (D, S).
+        available (np.ndarray): True where the sheet has a sample on the date, shape (D, S).
+        nearest (np.ndarray): Row holding the exact or nearest past sample of each sheet, -1 when the
+            sheet has no sample on or before the date, shape (D, S).
+        cumulative (np.ndarray): Cumulative weights, the sum of all finer mesh fractions, for the
+            columns `cumsum_<mesh>` of `calculate_cumulative_weights`, shape (D, S, M - 1).
+        d_values (np.ndarray): Particle size of each cumulative column, shape (S, M - 1), NaN padded.
+        mesh_plan (MeshPlan): Layout rearranging the sheet CPFT table by particle size, compiled and
+            validated when the cube is built.
+        replicates (list): Per sheet, the individual samples behind the averages as a tuple
+            (dates, fractions, total, sp_gravity) sorted by date, or None when not kept.
+        dataset_hash (str): SHA-256 of the workbook the cube was built from, set at upload, None otherwise.
+        window_days (int): Rolling window of the cube in days, None for the daily means.
+    """
+
+    def __init__(self, dates, sheets, mesh_columns, fractions, total, sp_gravity, available, d_values, replicates=None):
+        self.dates = dates
+        self.sheets = sheets
+        self.mesh_columns = mesh_columns
+        self.fractions = fractions
+        self.total = total
+        self.sp_gravity = sp_gravity
+        self.available = available
+        self.d_values = d_values
+        self.replicates = replicates
+        self.dataset_hash = None
+        self.window_days = None
+
+        # Exact or nearest past available row of every sheet (forward fill of row numbers)
+        row_numbers = np.where(available, np.arange(len(dates))[:, None], -1)
+        self.nearest = np.maximum.accumulate(row_numbers, axis=0)
+
+        # cumulative[..., k] = sum of fractions[..., k + 1:], missing fractions count as 0 like DataFrame.sum
+        filled = np.nan_to_num(fractions)
+        reverse_cumsum = np.cumsum(filled[..., ::-1], axis=-1)[..., ::-1]
+        self.cumulative = reverse_cumsum[..., 1:].copy()
+        self.cumulative[~available] = np.nan
+        self.cumulative[:, ~self.cumulative_mask] = np.nan
+
+        self.mesh_plan = compile_mesh_plan(d_values[self.cumulative_mask])
+        self._rolling_cubes = {}
+
+    @property
+    def cumulative_mask(self):
+        """
+        True for the cumulative columns that exist in each sheet, shape (S, M - 1).
+        """
+        counts = np.array([len(columns) - 1 for columns in self.mesh_columns])
+        return np.arange(self.fractions.shape[2] - 1)[None, :] < counts[:, None]
+
+    @classmethod
+    def from_sheets(cls, cleaned_sheets, d_values, excluded_columns):
+        """
+        Builds the cube from the cleaned sheets of a workbook.
+
+        Args:
+            cleaned_sheets (dict): Cleaned sheets from `clean_data`.
+            d_values (list): Particle sizes of the cumulative columns of all sheets, in sheet order.
+            excluded_columns (list): Non mesh columns (Total, Loose Bulk Density, Sp. gravity).
+
+        Returns:
+            SieveCube: The cube of averaged samples.
+        """
+        averaged = average_samples_per_date(cleaned_sheets)
+
+        sheets = list(averaged)
+        mesh_columns = [
+            [col for col in df.select_dtypes(include=['number']).columns if col not in excluded_columns]
+            for df in averaged.values()
+        ]
+
+        dates = np.unique(np.concatenate([df.index.values for df in averaged.values()])).astype('datetime64[ns]')
+        n_dates, n_sheets = len(dates), len(sheets)
+        n_mesh = max(len(columns) for columns in mesh_columns)
+
+        fractions = np.full((n_dates, n_sheets, n_mesh), np.nan)
+        total = np.full((n_dates, n_sheets), np.nan)
+        sp_gravity = np.full((n_dates, n_sheets), np.nan)
+        available = np.zeros((n_dates, n_sheets), dtype=bool)
+
+        for s, (sheet_name, df) in enumerate(averaged.items()):
+            rows = np.searchsorted(dates, df.index.values)
+            available[rows, s] = True
+            fractions[rows, s, :len(mesh_columns[s])] = df[mesh_columns[s]].to_numpy(dtype=float)
+            if 'Total' in df.columns:
+                total[rows, s] = df['Total'].to_numpy(dtype=float)
+            if 'Sp. gravity' in df.columns:
+                sp_gravity[rows, s] = df['Sp. gravity'].to_numpy(dtype=float)
+
+        # d_values are listed positionally over the cumulative columns of all sheets
+        n_cumulative = sum(max(len(columns) - 1, 0) for columns in mesh_columns)
+        if n_cumulative != len(d_values):
+            raise ValueError(f"The sheets have {n_cumulative} cumulative mesh columns in total, expected {len(d_values)} to match the particle sizes.")
+
+        sheet_d_values = np.full((n_sheets, max(n_mesh - 1, 0)), np.nan)
+        position = 0
+        for s, columns in enumerate(mesh_columns):
+            count = max(len(columns) - 1, 0)
+            sizes = d_values[position:position + count]
+            sheet_d_values[s, :len(sizes)] = sizes
+            position += count
+
+        # Individual samples, averaged per date above, kept for resampling
+        replicates = []
+        for sheet_name, columns in zip(sheets, mesh_columns):
+            df = cleaned_sheets[sheet_name]
+            df = df[df['Received Date'].notna()].sort_values('Received Date', kind='stable')
+            numeric = df.reindex(columns=columns + ['Total', 'Sp. gravity']).apply(pd.to_numeric, errors='coerce')
+            replicates.append((
+                df['Received Date'].values.astype('datetime64[ns]'),
+                numeric[columns].to_numpy(dtype=float),
+                numeric['Total'].to_numpy(dtype=float),
+                numeric['Sp. gravity'].to_numpy(dtype=float),
+            ))
+
+        return cls(dates, sheets, mesh_columns, fractions, total, sp_gravity, available, sheet_d_values, replicates)
+
+    def sheet_dates(self, sheet_name):
+        """
+        Dates on which `sheet_name` has samples.
+        """
+        return self.dates[self.available[:, self.sheets.index(sheet_name)]]
+
+    def rolling(self, window_days):
+        """
+        Cube of rolling-window means: on every date, the fractions, 'Total' and 'Sp. gravity' of each sheet
+        are averaged over its daily averages in the last `window_days` calendar days (the date included).
+
+        Window sums are differences of running sums over the dates, so building the cube is linear in the
+        number of dates whatever the window length. Rolling cubes are cached per window length.
+
+        Returns:
+            SieveCube: Cube with the same dates and layout, usable by every calculation of the cube.
+        """
+        if window_days in self._rolling_cubes:
+            return self._rolling_cubes[window_days]
+
+        first_rows = np.searchsorted(self.dates, self.dates - np.timedelta64(window_days, 'D'), side='right')
+        last_rows = np.arange(1, len(self.dates) + 1)
+
+        def window_mean(values):
+            valid = ~np.isnan(values)
+            sums = np.cumsum(np.where(valid, values, 0), axis=0)
+            counts = np.cumsum(valid, axis=0)
+            sums = np.concatenate([np.zeros_like(sums[:1]), sums])
+            counts = np.concatenate([np.zeros_like(counts[:1]), counts])
+
+            window_counts = counts[last_rows] - counts[first_rows]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(window_counts > 0, (sums[last_rows] - sums[first_rows]) / window_counts, np.nan)
+
+        fractions = np.where(self.available[..., None], self.fractions, np.nan)
+        available_counts = np.concatenate([np.zeros((1, len(self.sheets)), dtype=int), np.cumsum(self.available, axis=0)])
+        available = available_counts[last_rows] - available_counts[first_rows] > 0
+
+        cube = SieveCube(self.dates, self.sheets, self.mesh_columns, window_mean(fractions), window_mean(self.total),
+                         window_mean(self.sp_gravity), available, self.d_values)
+        cube.dataset_hash = self.dataset_hash
+        cube.window_days = window_days
+        self._rolling_cubes[window_days] = cube
+        return cube
+
+    def without_replicates(self):
+        """
+        Shallow copy of the cube without the individual samples and the cached rolling cubes, what a
+        worker process needs to calculate from the averages, so that sending it pickles the averaged
+        arrays only.
+        """
+        cube = copy.copy(self)
+        cube.replicates = None
+        cube._rolling_cubes = {}
+        return cube
+
+    def rows_for(self, dates):
+        """
+        Returns the cube rows holding the exact or nearest past sample of every sheet for each date.
+
+        Args:
+            dates: One or more dates (Timestamp, datetime64 or DatetimeIndex).
+
+        Returns:
+            np.ndarray: Row numbers, shape (N, S).
+
+        Raises:
+            ValueError: If a sheet has no sample on or before one of the dates.
+        """
+        dates = pd.DatetimeIndex(np.atleast_1d(dates)).values.astype('datetime64[ns]')
+        rows = self._nearest_rows(dates)
+
+        missing = np.argwhere(rows < 0)
+        if len(missing):
+            date_index, sheet_index = missing[0]
+            raise ValueError(f"No valid date found before or equal to {pd.Timestamp(dates[date_index])} in sheet '{self.sheets[sheet_index]}'")
+
+        return rows
+
+    def input_dates(self, dates):
+        """
+        Date of the sample every sheet resolves to (exact or nearest past) for each date, NaT when a sheet
+        has no sample on or before the date, shape (N, S).
+        """
+        dates = pd.DatetimeIndex(np.atleast_1d(dates)).values.astype('datetime64[ns]')
+        rows = self._nearest_rows(dates)
+        return np.where(rows >= 0, self.dates[np.maximum(rows, 0)], np.datetime64('NaT', 'ns'))
+
+    def _nearest_rows(self, dates):
+        positions = np.searchsorted(self.dates, dates, side='right') - 1
+        return np.where(positions[:, None] >= 0, self.nearest[np.maximum(positions, 0)], -1)
+
+    def replicates_for(self, rows):
+        """
+        Individual samples averaged into the given cube row of every sheet.
+
+        Args:
+            rows (np.ndarray): Row numbers of one date, shape (S,).
+
+        Returns:
+            list: Per sheet, a tuple (fractions, total, sp_gravity) of shapes (R, M), (R,) and (R,).
+        """
+        if self.replicates is None:
+            raise ValueError("The individual samples were not kept for this dataset.")
+
+        samples = []
+        for (dates, fractions, total, sp_gravity), row in zip(self.replicates, rows):
+            start, stop = np.searchsorted(dates, self.dates[row], side='left'), np.searchsorted(dates, self.dates[row], side='right')
+            samples.append((fractions[start:stop], total[start:stop], sp_gravity[start:stop]))
+        return samples
+
+    def proportion_vector(self, proportions, default=0):
+        """
+        Proportions as an array in sheet order, shape (S,).
+        """
+        return np.array([proportions.get(sheet_name, default) for sheet_name in self.sheets], dtype=float)
+
+    def gbd(self, rows, proportions):
+        """
+        Total volume and density (specific gravity of the mix) for each set of rows, as computed by
+        `process_sheets_and_calculate_gbd`.
+
+        Args:
+            rows (np.ndarray): Row numbers from `rows_for`, shape (N, S).
+            proportions (dict): Proportions keyed by sheet name.
+
+        Returns:
+            tuple: (total_volume, density), arrays of shape (N,).
+        """
+        sheet_index = np.arange(len(self.sheets))
+        weights = self.total[rows, sheet_index] * self.proportion_vector(proportions)
+        total_volume = (weights / self.sp_gravity[rows, sheet_index]).sum(axis=1)
+        return total_volume, 100 / total_volume
+
+    def gbd_batch(self, rows, proportion_matrix):
+        """
+        Total volume and density for every combination of date and proportion vector, in one matrix
+        product instead of one `gbd` call per proportion vector.
+
+        Args:
+            rows (np.ndarray): Row numbers from `rows_for`, shape (N, S).
+            proportion_matrix (np.ndarray): Proportion vectors in sheet order, shape (K, S).
+
+        Returns:
+            tuple: (total_volume, density), arrays of shape (N, K).
+        """
+        sheet_index = np.arange(len(self.sheets))
+        volume_per_unit = self.total[rows, sheet_index] / self.sp_gravity[rows, sheet_index]
+        total_volume = volume_per_unit @ np.asarray(proportion_matrix, dtype=float).T
+        return total_volume, 100 / total_volume
+
+    def sheet_cpft(self, rows, proportions):
+        """
+        Cumulative weights weighted by the sheet proportions (the 'Sheet CPFT' of `Calculate_Sheet_CPFT`).
+
+        Returns:
+            np.ndarray: Shape (N, S, M - 1), NaN for cumulative columns a sheet does not have.
+        """
+        sheet_index = np.arange(len(self.sheets))
+        return self.cumulative[rows, sheet_index] * self.proportion_vector(proportions, default=1)[None, :, None]
+
+    def cpft_rows(self, rows, proportions):
+        """
+        Sheet CPFT of many dates in the row order of the rearranged table (`mesh_plan`), with the sheet
+        proportion of every row, ready for `add_columns_batch`.
+
+        Args:
+            rows (np.ndarray): Row numbers from `rows_for`, shape (N, S).
+            proportions (dict): Proportions keyed by sheet name.
+
+        Returns:
+            tuple: (sheet_cpft, sheet_proportions), shapes (N, R) and (R,).
+        """
+        mask = self.cumulative_mask
+        sheet_index, _ = np.nonzero(mask)
+        sheet_cpft = self.sheet_cpft(rows, proportions)[:, mask]
+        sheet_proportions = self.proportion_vector(proportions, default=1)[sheet_index]
+        return sheet_cpft[:, self.mesh_plan.gather], sheet_proportions[self.mesh_plan.gather]
+
+    def cpft_rows_grid(self, rows, proportion_matrix):
+        """
+        `cpft_rows` of one date for many proportion vectors, ready for `add_columns_grid`.
+
+        Args:
+            rows (np.ndarray): Row numbers of one date, shape (S,).
+            proportion_matrix (np.ndarray): Proportion vectors in sheet order, shape (K, S).
+
+        Returns:
+            tuple: (sheet_cpft, sheet_proportions), both of shape (K, R).
+        """
+        mask = self.cumulative_mask
+        sheet_index, _ = np.nonzero(mask)
+        cumulative = self.cumulative[np.asarray(rows), np.arange(len(self.sheets))][mask]
+        sheet_proportions = np.asarray(proportion_matrix, dtype=float)[:, sheet_index]
+        sheet_cpft = cumulative[None, :] * sheet_proportions
+        return sheet_cpft[:, self.mesh_plan.gather], sheet_proportions[:, self.mesh_plan.gather]
+
+    def cpft_table(self, rows, proportions):
+        """
+        Sheet CPFT table for one date, in the layout returned by `Calculate_Sheet_CPFT`.
+
+        Args:
+            rows (np.ndarray): Row numbers of one date, shape (S,).
+            proportions (dict): Proportions keyed by sheet name.
+
+        Returns:
+            pd.DataFrame: Columns 'Sheet Name', 'Column Name', 'Sheet CPFT', 'sheet_proportion' and 'D_value'.
+        """
+        mask = self.cumulative_mask
+        sheet_cpft = self.sheet_cpft(np.asarray(rows)[None, :], proportions)[0]
+        sheet_index, column_index = np.nonzero(mask)
+        proportion_values = self.proportion_vector(proportions, default=1)
+
+        d_values = self.d_values[mask]
+        if not np.isnan(d_values).any():
+            d_values = d_values.astype(int)
+
+        return pd.DataFrame({
+            'Sheet Name': np.array(self.sheets, dtype=object)[sheet_index],
+            'Column Name': [f"cumsum_{self.mesh_columns[s][c]}" for s, c in zip(sheet_index, column_index)],
+            'Sheet CPFT': sheet_cpft[mask],
+            'sheet_proportion': proportion_values[sheet_index],
+            'D_value': d_values,
+        })
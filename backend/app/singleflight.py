@@ -0,0 +1,63 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Runs identical concurrent computations once. The first request for a key starts the computation in
+    the default thread pool, requests arriving with the same key while it runs await the same future
+    and share its result (or its exception). Nothing is kept once the computation has finished, so
+    this is deduplication of in-flight work, not a cache.
+
+    Only used from the event loop, so the bookkeeping needs no lock.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self._counters = {}
+
+    async def run(self, name, key, func, *args):
+        """
+        Runs `func(*args)` unless a computation of the same name and key is already running, and returns
+        its result.
+
+        Args:
+            name (str): Kind of computation (e.g. the endpoint), counters are kept per name.
+            key (tuple): Hashable description of the inputs, identical keys must give identical results.
+            func (callable): Blocking function computing the result.
+        """
+        counters = self._counters.setdefault(name, {"executed": 0, "coalesced": 0, "failed": 0})
+        flight_key = (name, key)
+
+        future = self._in_flight.get(flight_key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(None, func, *args)
+            self._in_flight[flight_key] = future
+            future.add_done_callback(lambda done: self._finish(flight_key, done, counters))
+            counters["executed"] += 1
+        else:
+            counters["coalesced"] += 1
+
+        # A waiter going away (client disconnected) must not cancel the computation of the others
+        return await asyncio.shield(future)
+
+    def _finish(self, flight_key, future, counters):
+        if self._in_flight.get(flight_key) is future:
+            del self._in_flight[flight_key]
+        if future.cancelled() or future.exception() is not None:
+            counters["failed"] += 1
+
+    def stats(self):
+        """
+        Counters per computation name: computations executed, requests coalesced into a running
+        computation, failed computations and computations currently running.
+        """
+        in_flight = {}
+        for name, _ in self._in_flight:
+            in_flight[name] = in_flight.get(name, 0) + 1
+
+        stats = {}
+        for name, counters in self._counters.items():
+            requests = counters["executed"] + counters["coalesced"]
+            stats[name] = {**counters, "in_flight": in_flight.get(name, 0), "requests": requests,
+                           "coalesced_ratio": round(counters["coalesced"] / requests, 4) if requests else 0.0}
+        return stats
@@ -1,16 +1,43 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from fastapi.responses import JSONResponse 
-from io import BytesIO
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from app.admission import AdmissionLimiter, AdmissionMiddleware
+from app.export import write_results_workbook, iter_file_chunks, XLSX_MEDIA_TYPE
+from app.bootstrap import bootstrap_confidence_intervals
+from app.compare import compare_dataset
+from app.invalidation import same_layout, changed_samples, plan_recompute, format_date
+from app.live import LivePipeline
+from app.result_store import ResultStore, result_key, format_proportions, format_packing_density
+from app.jobs import JobManager, FINISHED_STATES, COMPLETED, FAILED, CANCELLED
+from app.sieve_cube import SieveCube
+from app.singleflight import SingleFlight
+from app.validation import validate_workbook
 from app.updated_model import (
-    read_excel_file, clean_data, view_sheets,
+    read_excel_file, read_excel_file_streaming, clean_data, view_sheets,
     get_available_date_range, get_sample_data_for_date,
     average_samples_per_date, process_sheets_and_calculate_gbd,
-    calculate_cumulative_weights, get_sheet_constants_from_proportions, Calculate_Sheet_CPFT, rearrange_mess_sizes, add_columns, q_value_prediction,
+    calculate_cumulative_weights, get_sheet_constants_from_proportions, Calculate_Sheet_CPFT, rearrange_mess_sizes, compile_mesh_plan, add_columns, q_value_prediction,
     optimize_q, calculate_errors_and_mae,
-    calculate_Q_value_and_plot
+    calculate_Q_value_and_plot, add_columns_stack, linear_fit_batch, optimize_q_batch, calculate_mae_batch,
+    double_modified_q_batch, double_modified_packing_density, add_columns_grid,
+    fit_q_values_batch, summarize_dates_batch
 )
 
 app = FastAPI()
@@ -31,9 +58,78 @@ d_values = [
     74, 63, 53, 44
 ]
 
-# Store uploaded file in memory for further processing
+# Mesh layout of d_values, the cumulative columns of the uploaded sheets must line up with its rows
+mesh_plan = compile_mesh_plan(d_values)
+
+# Defaults used for the precomputed history (same proportions as the dashboard, add_columns' default packing density)
+default_proportions = [0.35, 0.20, 0.15, 0.10, 0.20]
+default_packing_density = 0.85
+
+# Columns that are not mesh fractions and are skipped when computing cumulative weights
+excluded_columns = ['Total', 'Loose Bulk Density (gm/cc)', 'Sp. gravity']
+
+# Cleaned sheets of the uploaded file (the raw file is not kept), together with its averaged SieveCube
 file_storage = {}
 
+# Every uploaded workbook, keyed by dataset ID, for cross-workbook comparisons (oldest evicted first)
+datasets = OrderedDict()
+max_datasets = int(os.getenv("MAX_DATASETS", "20"))
+
+# Worker processes for cross-workbook comparisons, started on first use and replaced when broken
+compare_executor = None
+compare_executor_lock = threading.Lock()
+
+# Admission control per endpoint class: concurrent requests, waiting requests and the longest wait (seconds)
+admission_limits = {
+    "ingest": (int(os.getenv("INGEST_CONCURRENCY", "2")), int(os.getenv("INGEST_QUEUE", "4")), float(os.getenv("INGEST_MAX_WAIT", "30"))),
+    "single": (int(os.getenv("SINGLE_CONCURRENCY", "8")), int(os.getenv("SINGLE_QUEUE", "64")), float(os.getenv("SINGLE_MAX_WAIT", "10"))),
+    "batch": (int(os.getenv("BATCH_CONCURRENCY", "2")), int(os.getenv("BATCH_QUEUE", "8")), float(os.getenv("BATCH_MAX_WAIT", "30"))),
+}
+admission_limiters = {name: AdmissionLimiter(name, *limits) for name, limits in admission_limits.items()}
+admission_routes = {
+    "/upload/": "ingest",
+    "/get_sample_data/": "single",
+    "/calculate_gbd/": "single",
+    "/calculate_q_value/": "single",
+    "/calculate_q_value_modified_andreason/": "single",
+    "/calculate_q_value_double_modified/": "single",
+    "/calculate_all/": "single",
+    "/calculate_range/stream/": "batch",
+    "/export/xlsx/": "batch",
+    "/sensitivity/": "batch",
+    "/bootstrap/": "batch",
+    "/proportion_grid/": "batch",
+    "/scenarios/": "batch",
+    "/compare/": "batch",
+}
+app.add_middleware(AdmissionMiddleware, limiters=admission_limiters, routes=admission_routes)
+
+# Identical single-date computations running at the same time are computed once and shared
+single_flight = SingleFlight()
+
+# Computed results persisted across restarts, keyed by workbook hash, date, proportions, packing density and method.
+# The default database sits in backend/, whatever the working directory of the server
+result_store = ResultStore(os.getenv("RESULT_STORE_PATH", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "results.sqlite3")))
+
+# Background jobs for long running batch computations
+job_manager = JobManager(max_workers=int(os.getenv("JOB_WORKERS", "2")))
+
+# Dates summarized per vector pass by the background jobs (progress and cancellation are checked in between)
+batch_dates = 256
+
+# Largest proportion grid evaluated by /proportion_grid/, and the blends fitted per vector pass
+max_grid_blends = int(os.getenv("MAX_GRID_BLENDS", "200000"))
+grid_chunk = 20000
+
+# Largest scenario list accepted by /scenarios/, and the threads evaluating its dates
+max_scenarios = int(os.getenv("MAX_SCENARIOS", "20000"))
+scenario_workers = int(os.getenv("SCENARIO_WORKERS", str(os.cpu_count() or 1)))
+scenario_executor = ThreadPoolExecutor(max_workers=scenario_workers, thread_name_prefix="scenario-worker")
+
+# Per-date results for the default proportions, built in the background after every upload
+# (rows hold (date, summary row, input date of every sheet), `update` reports what the last upload recomputed)
+materialized_history = {"dataset_hash": None, "cube": None, "job": None, "rows": [], "update": None}
+
 cached_final_df = {}
 cached_q_values = {}
 global_cache={}
@@ -41,16 +137,22 @@ global_cache={}
 # Endpoint to upload the Excel file
 
 @app.post("/upload/")
-async def upload_file(file: UploadFile = File(...)):
+def upload_file(file: UploadFile = File(...)):
     try:
-        contents = await file.read()
-        file_obj = BytesIO(contents)
-        file_obj.seek(0)
-        file_storage["file"] = file_obj
+        # ✅ The upload is spooled to a temporary file by the server, it is hashed and parsed from there
+        # in chunks and rows instead of being read into memory, and only the parsed sheets are kept
+        file_obj = file.file
+        dataset_hash = hash_file(file_obj)
+        layout_warnings = []
 
         # Check if it's an Excel file
         if file.filename.endswith(".xlsx"):
-            sheets = read_excel_file(file_obj, required_sheets)
+            # ✅ Reject a wrong layout from the header rows alone, before parsing the sheets
+            problems, layout_warnings = validate_workbook(file_obj, required_sheets, mesh_plan, excluded_columns)
+            if problems:
+                raise HTTPException(status_code=400, detail={"message": "Invalid workbook layout", "problems": problems})
+
+            sheets = read_excel_file_streaming(file_obj, required_sheets)
 
             # ✅ Validate that required sheets exist
             missing_sheets = [sheet for sheet in required_sheets if sheet not in sheets]
@@ -74,33 +176,61 @@ async def upload_file(file: UploadFile = File(...)):
    
         
         min_date, max_date = get_available_date_range(cleaned_sheets, updated_sheets)
-        
-        return {"message": "File uploaded successfully", "date_range": [str(min_date.date()), str(max_date.date())]}
-     
+
+        # ✅ Average all samples once, every calculation reads from the cube
+        cube = SieveCube.from_sheets(cleaned_sheets, d_values, excluded_columns)
+        cube.dataset_hash = dataset_hash
+        file_storage["cube"] = cube
+        file_storage["sheets"] = cleaned_sheets
+        file_storage["dataset_hash"] = dataset_hash
+        dataset_id = register_dataset(dataset_hash, file.filename, cube)
+
+        # ✅ Precompute the per-date history in the background
+        history_job = start_history_build(cube)
+
+        return {
+            "message": "File uploaded successfully",
+            "date_range": [str(min_date.date()), str(max_date.date())],
+            "dataset_id": dataset_id,
+            "history_job_id": history_job.id,
+            "history_update": summarize_history_update(materialized_history["update"]),
+            "warnings": layout_warnings
+        }
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
 
+def hash_file(file_obj, chunk_size=1 << 20):
+    """
+    SHA-256 of a file read in chunks, the file is rewound afterwards.
+    """
+    digest = hashlib.sha256()
+    file_obj.seek(0)
+    while chunk := file_obj.read(chunk_size):
+        digest.update(chunk)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
 # Endpoint to get the sample data for a selected date
 
 @app.get("/get_sample_data/")
 async def get_sample_data(selected_date: str = Query(..., description="Selected date from user")):
     try:
-        if "file" not in file_storage:
+        if "sheets" not in file_storage:
             raise HTTPException(status_code=400, detail="No file uploaded. Please upload a file first.")
 
-        file_obj = file_storage["file"]
-        file_obj.seek(0)  # Reset file pointer before reading
-        
-        sheets = read_excel_file(file_obj, required_sheets)
-        cleaned_sheets = clean_data(sheets)
-        
+        cleaned_sheets = file_storage["sheets"]
 
         # Get the available date range
         min_date, max_date = get_available_date_range(cleaned_sheets, updated_sheets)
 
         # ✅ Convert the user-selected date to `datetime`
-        selected_date_obj = pd.to_datetime(selected_date, format="%d-%m-%Y", errors="coerce")
+        target_date = parse_selected_date(selected_date)
+        selected_date_obj = target_date
 
         # ✅ Check if the selected date is within the range
         if selected_date_obj < min_date:
@@ -108,7 +238,7 @@ async def get_sample_data(selected_date: str = Query(..., description="Selected
         elif selected_date_obj > max_date:
             selected_date_obj = max_date  # Auto-select nearest past date
 
-        sample_data = get_sample_data_for_date(cleaned_sheets, updated_sheets, selected_date)
+        sample_data = get_sample_data_for_date(cleaned_sheets, updated_sheets, target_date)
         # sample_data = get_sample_data_for_date(standardized_sheets, required_sheets, selected_date)
 
         # ✅ Ensure sample data is not empty before proceeding
@@ -122,7 +252,8 @@ async def get_sample_data(selected_date: str = Query(..., description="Selected
             "sample_data": {k: v.to_dict(orient="records") for k, v in sample_data.items() if v is not None}
         }
 
-    
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
@@ -138,72 +269,42 @@ async def calculate_gbd( selected_date: str = Query(...),
     Calculate GBD values dynamically for user-entered packing density values.
     """
     try:
-        if "file" not in file_storage:
-            raise HTTPException(status_code=400, detail="No file uploaded. Please upload a file first.")
-
-        file_obj = file_storage["file"]
-        file_obj.seek(0)  # Reset file pointer before reading
-
-        # Read and clean data
-        sheets = read_excel_file(file_obj, required_sheets)
-        cleaned_sheets = clean_data(sheets)
-
-        # ✅ Convert the user-selected date to `datetime`
-        selected_date_obj = pd.to_datetime(selected_date, format="%d-%m-%Y", errors="coerce")
-
-        
-        # Get sample data for selected date
-        sample_data = get_sample_data_for_date(cleaned_sheets, updated_sheets, selected_date)
-
-        if not sample_data or all(df is None or df.empty for df in sample_data.values()):
-            raise HTTPException(status_code=400, detail=f"No sample data found for {selected_date}")
+        cube = load_cube()
+        target_date = parse_selected_date(selected_date)
 
         # ✅ Convert user-input proportions to a dictionary
-        proportions_list = [float(value.strip()) for value in updated_proportions.split(",")]
-        proportions_dict = dict(zip(updated_sheets, proportions_list))  # Assign proportions to correct sheets
-        # print(proportions_dict)
+        proportions_dict = parse_proportions(updated_proportions)
 
         # ✅ Ensure proportions sum up to 1
         if round(sum(proportions_dict.values()), 4) != 1.0:
             raise HTTPException(status_code=400, detail="Proportions must sum up to 1. Please check input values.")
 
-        processed_data = average_samples_per_date(cleaned_sheets)
-
-        # view_sheets(processed_data)
-
-
-        # ✅ Convert packing density input (supports single or multiple values)
-        try:
-            packing_density = float(packing_density.strip())
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid packing density input. Please enter valid numbers.")
-
-        density_water = 1
-      
-        # Convert selected_date from "dd-mm-yyyy" to "dd.mm.yy"
-        formatted_date = datetime.strptime(selected_date, "%d-%m-%Y").strftime("%d.%m.%y")
-
-        # Convert to pandas Timestamp before passing
-        received_date = pd.to_datetime(formatted_date, format='%d.%m.%y', errors='coerce')
-
-        if pd.isna(received_date):
-            return {"error": "Invalid date format conversion"}
-
-        # print(f"Formatted Date: {formatted_date}, Timestamp: {received_date} (Type: {type(received_date)})")
-        total_volume, density = process_sheets_and_calculate_gbd(processed_data, density_water, formatted_date, proportions_dict)
-        print(total_volume, density)
-        GBD = density * packing_density
-        gbd_result = {str(packing_density): round(GBD, 4)}
-        print(gbd_result)
-        
-
-        return {
-            "message": f"GBD Calculation for {selected_date}",
-            "total_volume": round(total_volume, 4),
-            "specific_gravity": round(density, 4),
-            "gbd_values": gbd_result
-        }
+        packing_density = parse_packing_density(packing_density)
+        selected_date = target_date.strftime("%d-%m-%Y")
+
+        def compute():
+            # Exact or nearest past sample of every sheet
+            rows = cube.rows_for(target_date)
+            total_volume, density = cube.gbd(rows, proportions_dict)
+            total_volume, density = float(total_volume[0]), float(density[0])
+
+            GBD = density * packing_density
+            gbd_result = {str(packing_density): round(GBD, 4)}
+
+            summary = {"total_volume": round(total_volume, 4), "specific_gravity": round(density, 4), "gbd": round(GBD, 4)}
+            return {
+                "message": f"GBD Calculation for {selected_date}",
+                "total_volume": round(total_volume, 4),
+                "specific_gravity": round(density, 4),
+                "gbd_values": gbd_result
+            }, summary
+
+        key = store_key(cube, "calculate_gbd", target_date, proportions_dict, packing_density)
+        return await single_flight.run("calculate_gbd", flight_key(cube, selected_date, proportions_dict, packing_density),
+                                       stored_or_computed(key, compute))
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
@@ -217,310 +318,1486 @@ async def calculate_q_value(
     """
     Calculate q-value using Andreasen Equation for a given date.
     """
-    global cached_final_df, cached_q_values  # Allow modification of global variable
+    try:
+        cube = load_cube()
+        target_date = parse_selected_date(selected_date)
 
+        # ✅ Convert proportions from query string to dictionary
+        proportions_dict = parse_proportions(updated_proportions)
+        selected_date = target_date.strftime("%d-%m-%Y")
+
+        def compute():
+            rows = cube.rows_for(target_date)[0]
+            sorted_df = build_sorted_df(cube, rows, proportions_dict)
+
+            # Predict q values
+            q_value = q_value_prediction(sorted_df, selected_date)
+
+            summary = {"q_value": float(q_value["q-value"].iloc[0]), "r_squared": float(q_value["r-squared"].iloc[0])}
+            return {
+                "message": f"q-value Calculation for {selected_date}",
+                "intermediate_table": sorted_df.to_dict(orient="records"),
+                "q_values": q_value.to_dict(orient="records")
+            }, summary
+
+        key = store_key(cube, "calculate_q_value", target_date, proportions_dict)
+        return await single_flight.run("calculate_q_value", flight_key(cube, selected_date, proportions_dict),
+                                       stored_or_computed(key, compute))
+
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"Value Error: {str(ve)}")
+
+# Endpoint to calculate modified q values
+
+@app.get("/calculate_q_value_modified_andreason/")
+async def calculate_q_value_modified_andreason(
+    selected_date: str = Query(...),
+    packing_density: str = Query(...),
+    updated_proportions: str = Query(None)
+):
+    """
+    Calculate q-value using Andreasen Equation for a given date.
+    """
     try:
+        cube = load_cube()
+        target_date = parse_selected_date(selected_date)
 
-        if "file" not in file_storage:
-            raise HTTPException(status_code=400, detail="No file uploaded. Please upload a file first.")
+        # ✅ Convert proportions from query string to dictionary
+        proportions_dict = parse_proportions(updated_proportions)
 
-        file_obj = file_storage["file"]
-        file_obj.seek(0)
+        # ✅ Convert packing density input
+        packing_density = parse_packing_density(packing_density)
+        selected_date = target_date.strftime("%d-%m-%Y")
+
+        def compute():
+            rows = cube.rows_for(target_date)[0]
+            sorted_df = build_sorted_df(cube, rows, proportions_dict, packing_density)
+
+            # Create the modified DataFrame with specific columns
+            modified_df = sorted_df[['Sheet Name', 'Column Name', 'D_value', 'pct_CPFT_interpolation', 'pct_poros_CPFT']].copy()
+
+            # Step 1: Optimize q-value for a single packing density
+            optimal_q = optimize_q(modified_df, D_col='D_value', pct_CPFT_col='pct_poros_CPFT')
+
+            q_results = {"Date": selected_date,
+                         f'q_{int(packing_density * 100)}': np.round(optimal_q, 4)}
+            q_df = pd.DataFrame([q_results])
+
+            # Step 2: Calculate errors and MAE for the single q-value
+            modified_andreasen_df, mae = calculate_errors_and_mae(modified_df, D_col='D_value', pct_CPFT_col='pct_poros_CPFT', q=optimal_q)
+
+            summary = {"modified_q": round(float(optimal_q), 4), "mae": round(float(mae), 4)}
+            return {
+                "message": f"q-value Calculation using Modified Andreasen Eq. for {selected_date}",
+                "q_values": q_df.to_dict(orient="records"),
+                "cpft_error_table": modified_andreasen_df.to_dict(orient="records")
+            }, summary
+
+        key = store_key(cube, "calculate_q_value_modified_andreason", target_date, proportions_dict, packing_density)
+        return await single_flight.run("calculate_q_value_modified_andreason",
+                                       flight_key(cube, selected_date, proportions_dict, packing_density),
+                                       stored_or_computed(key, compute))
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}   This is the error")
+    
+# Endpoint to calculate modified q values
+
+# ✅ **New API Endpoint for Double Modified q-values**
+@app.get("/calculate_q_value_double_modified/")
+async def calculate_q_value_double_modified(
+    selected_date: str = Query(...), 
+    updated_proportions: str = Query(None)
+):
+    """
+    Calculate q-values using the **Double Modified Andreasen Equation** for a given date.
+    """
+    try:
+        cube = load_cube()
+        target_date = parse_selected_date(selected_date)
 
-        sheets = read_excel_file(file_obj, required_sheets)
-        cleaned_sheets = clean_data(sheets)
-        
-        # selected_date = pd.to_datetime(selected_date, format="%d-%m-%Y", errors="coerce")
-        sample_data = get_sample_data_for_date(cleaned_sheets, updated_sheets, selected_date)
-        if not sample_data or all(df is None or df.empty for df in sample_data.values()):
-            raise HTTPException(status_code=400, detail=f"No sample data found for {selected_date}")
-        
         # ✅ Convert proportions from query string to dictionary
+        proportions_dict = parse_proportions(updated_proportions)
+        selected_date = target_date.strftime("%d-%m-%Y")
+
+        def compute():
+            rows = cube.rows_for(target_date)[0]
+            sorted_df = build_sorted_df(cube, rows, proportions_dict)
+
+            # Call the function with the sorted DataFrame
+            Q_value, modified_df = calculate_Q_value_and_plot(sorted_df, pct_CPFT_col='pct_poros_CPFT')
+
+            q_results = {"Date": selected_date,
+                         f'q_value': np.round(Q_value, 4)}
+            q_df = pd.DataFrame([q_results])
+
+            summary = {"double_modified_q": round(float(Q_value), 4)}
+            return {
+                "message": f"Double Modified q-value Calculation for {selected_date}",
+                "double_modified_q_values": q_df.to_dict(orient="records"),
+                "intermediate_table": modified_df.to_dict(orient="records") # ✅ Pass the intermediate table for regression
+            }, summary
+
+        key = store_key(cube, "calculate_q_value_double_modified", target_date, proportions_dict)
+        return await single_flight.run("calculate_q_value_double_modified", flight_key(cube, selected_date, proportions_dict),
+                                       stored_or_computed(key, compute))
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+
+@app.get("/stats/coalescing/")
+async def get_coalescing_stats():
+    """
+    Per endpoint, how many single-date computations ran and how many requests were served by joining
+    an identical computation already in flight.
+    """
+    return single_flight.stats()
+
+
+@app.get("/stats/admission/")
+async def get_admission_stats():
+    """
+    Per endpoint class, the limits, running and queued requests, admitted and rejected counts and wait times.
+    """
+    return {name: limiter.stats() for name, limiter in admission_limiters.items()}
+
+
+@app.get("/stats/result_store/")
+def get_result_store_stats():
+    """
+    Results stored, and how many lookups were answered from the store instead of being computed.
+    """
+    return result_store.stats()
+
+
+# Helpers shared by the combined and range calculations
+
+def flight_key(cube, selected_date, proportions_dict, packing_density=None):
+    """
+    Key of a single-date computation for `single_flight`. The workbook hash and rolling window of the
+    cube identify its data (object ids are reused once a replaced cube is collected), the date is kept
+    as sent since it is echoed in the responses.
+    """
+    return cube.dataset_hash, cube.window_days, selected_date, tuple(proportions_dict.values()), packing_density
+
+
+def store_key(cube, method, target_date, proportions_dict, packing_density=None):
+    """
+    Key of a result computed from `cube` in `result_store`, with the workbook hash and rolling window
+    of the cube itself, so that a result is never stored under the hash of a workbook uploaded meanwhile.
+    """
+    return result_key(cube.dataset_hash, method, target_date, proportions_dict, packing_density, cube.window_days)
+
+
+def stored_or_computed(key, compute, *args):
+    """
+    Blocking function returning the response stored under `key`, or running `compute(*args)` (which
+    returns the response and its summary) and storing the result when it has not been computed before.
+    """
+    def run():
+        response = result_store.get(key)
+        if response is None:
+            response, summary = compute(*args)
+            response = jsonable_encoder(response)
+            result_store.put(key, summary, response)
+        return response
+
+    return run
+
+
+def summarize_dates_stored(cube, dates, proportions_dict, packing_density):
+    """
+    `summarize_dates_batch` reading the summary rows already in `result_store` and only computing (and
+    storing) the others. Error rows are not stored.
+    """
+    keys = [store_key(cube, "summary", target_date, proportions_dict, packing_density) for target_date in dates]
+    stored = result_store.get_summaries(keys)
+
+    missing = pd.DatetimeIndex([target_date for target_date, key in zip(dates, keys) if key not in stored])
+    computed = summarize_dates_batch(cube, missing, proportions_dict, packing_density) if len(missing) else []
+    result_store.put_many([(key, row, None) for key, row in zip((key for key in keys if key not in stored), computed)
+                           if "error" not in row])
+
+    computed = iter(computed)
+    return [stored[key] if key in stored else next(computed) for key in keys]
+
+
+def load_cube(window_days=None):
+    """
+    Returns the SieveCube of the uploaded workbook, or its rolling-window means over `window_days` days.
+    """
+    if "cube" not in file_storage:
+        raise HTTPException(status_code=400, detail="No file uploaded. Please upload a file first.")
+    cube = file_storage["cube"]
+    return cube.rolling(window_days) if window_days else cube
+
+
+def parse_selected_date(selected_date):
+    """
+    Converts a dd-mm-yyyy date from the query string to a Timestamp.
+    """
+    target_date = pd.to_datetime(selected_date, format="%d-%m-%Y", errors="coerce")
+    if pd.isna(target_date):
+        raise HTTPException(status_code=400, detail=f"Invalid date '{selected_date}'. Please use dd-mm-yyyy.")
+    return target_date
+
+
+def parse_proportions(updated_proportions):
+    """
+    Converts the comma separated proportions query string to a dictionary keyed by sheet name.
+    """
+    try:
         proportions_list = [float(value.strip()) for value in updated_proportions.split(",")]
-        proportions_dict = dict(zip(updated_sheets, proportions_list))
-        
-        print(proportions_dict)
+    except (AttributeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid proportions input. Please enter comma separated numbers.")
 
-        processed_data = average_samples_per_date(cleaned_sheets)
-        print("Average calculation Done!")
+    if len(proportions_list) != len(updated_sheets):
+        raise HTTPException(status_code=400, detail=f"Expected {len(updated_sheets)} proportions, got {len(proportions_list)}.")
 
-        # Define the columns you want to exclude from numeric calculations
-        excluded_columns = ['Total', 'Loose Bulk Density (gm/cc)', 'Sp. gravity']
+    return dict(zip(updated_sheets, proportions_list))
 
-        # Call the function to calculate cumulative weights
-        cumulative_sheets = calculate_cumulative_weights(processed_data, excluded_columns)
 
-        # ✅ Compute sheet constants dynamically
-        sheet_multipliers = get_sheet_constants_from_proportions(proportions_dict)
-        print(sheet_multipliers)
-        
-        # Process the data and consolidate the results from all sheets
-        sheet_CPFT_df = Calculate_Sheet_CPFT(cumulative_sheets, selected_date, proportions_dict, d_values)
+def parse_packing_density(packing_density):
+    """
+    Converts the packing density query string to a float.
+    """
+    try:
+        return float(packing_density.strip())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid packing density input. Please enter valid numbers.")
 
-        # Call the function
-        updated_df = rearrange_mess_sizes(sheet_CPFT_df)
 
-        packing_density = None
-        # Add columns to the DataFrame
-        sorted_df = add_columns(updated_df, proportions_dict, sheet_multipliers, packing_density)
+def build_sorted_df(cube, rows, proportions_dict, packing_density=None):
+    """
+    Runs the sheet CPFT, mesh rearrangement and add_columns stages for the cube rows of one date and
+    returns the table shared by all q-value methods.
+    """
+    sheet_multipliers = get_sheet_constants_from_proportions(proportions_dict)
 
-        sorted_df['Log_D/Dmax_value'] = np.log(sorted_df['Normalized_D'])
-        sorted_df['Log_pct_CPFT'] = np.log(sorted_df['pct_CPFT_interpolation'])
-        
-        # Predict q values
-        q_value = q_value_prediction(sorted_df, selected_date)  
-        
+    sheet_CPFT_df = cube.cpft_table(rows, proportions_dict)
+    updated_df = rearrange_mess_sizes(sheet_CPFT_df, cube.mesh_plan)
 
-        # ===================================Debug statements======================================
-        # view_sheets(cumulative_sheets)
+    sorted_df = add_columns(updated_df, proportions_dict, sheet_multipliers, packing_density)
+    sorted_df['Log_D/Dmax_value'] = np.log(sorted_df['Normalized_D'])
+    sorted_df['Log_pct_CPFT'] = np.log(sorted_df['pct_CPFT_interpolation'])
 
-        # for sheet_name, df in cumulative_sheets.items():
-        #     print(f"Index dtype for sheet '{sheet_name}': {df.index.dtype}")
+    return sorted_df
 
-        # print(cumulative_sheets['H(7-12)'].index) 
 
-        # print(f"\n{sheet_multipliers}")
-        # print(f"\n{proportions_dict}")
+def run_all_methods(cube, target_date, proportions_dict, packing_density):
+    """
+    Calculates GBD and the Andreasen, Modified Andreasen and Double Modified Andreasen q-values for
+    one date.
 
-        # print("\nNow view the dataframe with CPFT values for each sheet:")
-        # print(sheet_CPFT_df)
+    Args:
+        cube (SieveCube): Averaged samples of the uploaded workbook.
+        target_date (pd.Timestamp): Date to calculate, the nearest past sample of each sheet is used.
+        proportions_dict (dict): Proportions keyed by sheet name.
+        packing_density (float): Packing density used for GBD and the Modified Andreasen method.
 
-        # print("\nFinal DataFrame after assigning 'Sheet Name' based on 'D_value':")
-        # print(updated_df)
+    Returns:
+        dict: Scalar results and the intermediate DataFrames of every method.
+    """
+    rows = cube.rows_for(target_date)
+
+    # GBD
+    total_volume, density = cube.gbd(rows, proportions_dict)
+    total_volume, density = float(total_volume[0]), float(density[0])
+
+    # Shared intermediate table (default packing density, as used by the Andreasen and Double Modified methods)
+    sorted_df = build_sorted_df(cube, rows[0], proportions_dict)
+
+    # Andreasen
+    q_df = q_value_prediction(sorted_df, target_date.strftime("%d-%m-%Y"))
+
+    # Modified Andreasen, using the user-entered packing density
+    modified_df = sorted_df[['Sheet Name', 'Column Name', 'D_value', 'pct_CPFT_interpolation']].copy()
+    modified_df['pct_poros_CPFT'] = modified_df['pct_CPFT_interpolation'] * packing_density
+    optimal_q = optimize_q(modified_df, D_col='D_value', pct_CPFT_col='pct_poros_CPFT')
+    modified_andreasen_df, mae = calculate_errors_and_mae(modified_df, D_col='D_value', pct_CPFT_col='pct_poros_CPFT', q=optimal_q)
+
+    # Double Modified Andreasen
+    Q_value, double_modified_df = calculate_Q_value_and_plot(sorted_df, pct_CPFT_col='pct_poros_CPFT')
+
+    return {
+        "total_volume": total_volume,
+        "specific_gravity": density,
+        "gbd": density * packing_density,
+        "sorted_df": sorted_df,
+        "q_df": q_df,
+        "modified_q": optimal_q,
+        "mae": mae,
+        "modified_andreasen_df": modified_andreasen_df,
+        "double_modified_q": Q_value,
+        "double_modified_df": double_modified_df,
+    }
+
+
+def fit_q_values_grid(cube, rows, proportion_matrix, packing_density):
+    """
+    Andreasen, Modified Andreasen and Double Modified Andreasen q-values of one date for many proportion
+    vectors. Unlike `fit_q_values_batch`, the tables of all vectors are built as whole arrays too, so
+    tens of thousands of vectors need no Python loop.
+
+    Args:
+        cube (SieveCube): Averaged samples of the uploaded workbook.
+        rows (np.ndarray): Row numbers of one date, shape (S,).
+        proportion_matrix (np.ndarray): Proportion vectors in `updated_sheets` order, shape (K, S).
+        packing_density (float or np.ndarray): Packing density used for the Modified Andreasen method,
+            one for all vectors or one per vector, shape (K,).
+
+    Returns:
+        dict: Unrounded arrays of shape (K,) for q_value, r_squared, modified_q, mae and double_modified_q.
+    """
+    packing_density = np.reshape(np.asarray(packing_density, dtype=float), (-1, 1))
+    cube_order = [updated_sheets.index(sheet_name) for sheet_name in cube.sheets]
+    sheet_cpft, sheet_proportions = cube.cpft_rows_grid(rows, proportion_matrix[:, cube_order])
+    D_values, normalized_d, pct_CPFT, keep = add_columns_grid(
+        sheet_cpft, cube.mesh_plan, sheet_proportions, proportion_matrix, updated_sheets)
 
-        print("\nFinal dataframe")
-        print(sorted_df)
-    
-        print(f"\nq value : {q_value}")
+    with np.errstate(invalid='ignore', divide='ignore'):
+        q_value, _, r_squared = linear_fit_batch(np.log(normalized_d), np.log(pct_CPFT), keep)
+        modified_q = optimize_q_batch(D_values, pct_CPFT * packing_density, mask=keep)
+        mae = calculate_mae_batch(D_values, pct_CPFT * packing_density, modified_q, mask=keep)
+        double_modified_q = double_modified_q_batch(D_values, pct_CPFT * double_modified_packing_density, mask=keep)
 
-        q_values={}
-        q_values[selected_date] = q_value
-        # print(q_values)
-        # print(type(q_values))
+    return {"q_value": q_value, "r_squared": r_squared, "modified_q": modified_q, "mae": mae, "double_modified_q": double_modified_q}
 
-        final_df={}
-        final_df[selected_date] = sorted_df
 
-        return {
-            "message": f"q-value Calculation for {selected_date}",
-            "intermediate_table": final_df[selected_date].to_dict(orient="records"),
-            "q_values": q_values[selected_date].to_dict(orient="records")
-        }
+def summarize_all_methods(target_date, results):
+    """
+    Flattens the output of `run_all_methods` to one row per date, without the intermediate tables.
+    """
+    q_row = results["q_df"].iloc[0]
+    return {
+        "Date": target_date.strftime("%d-%m-%Y"),
+        "total_volume": round(float(results["total_volume"]), 4),
+        "specific_gravity": round(float(results["specific_gravity"]), 4),
+        "gbd": round(float(results["gbd"]), 4),
+        "q_value": float(q_row["q-value"]),
+        "r_squared": float(q_row["r-squared"]),
+        "modified_q": round(float(results["modified_q"]), 4),
+        "mae": round(float(results["mae"]), 4),
+        "double_modified_q": round(float(results["double_modified_q"]), 4),
+    }
+
+
+def get_dates_in_range(cube, start_date, end_date):
+    """
+    Returns the received dates of the main sheet between `start_date` and `end_date` (dd-mm-yyyy, inclusive)
+    as a sorted DatetimeIndex.
+    """
+    start = pd.to_datetime(start_date, format="%d-%m-%Y", errors="coerce")
+    end = pd.to_datetime(end_date, format="%d-%m-%Y", errors="coerce")
+    if pd.isna(start) or pd.isna(end):
+        raise HTTPException(status_code=400, detail="Invalid date format. Please use dd-mm-yyyy.")
+    if start > end:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date.")
+
+    main_dates = pd.DatetimeIndex(cube.sheet_dates(updated_sheets[0]))
+    return main_dates[(main_dates >= start) & (main_dates <= end)]
+
+
+# Endpoint to calculate GBD and all q values in one pass
+
+@app.get("/calculate_all/")
+async def calculate_all(
+    selected_date: str = Query(...),
+    packing_density: str = Query(...),
+    updated_proportions: str = Query(...),
+    window_days: int = Query(None, ge=1, le=366, description="Average each sheet over this many days before calculating (rolling window)")
+):
+    """
+    Calculate GBD and the Andreasen, Modified Andreasen and Double Modified Andreasen q-values
+    for a given date, reading the workbook and building the intermediate table only once.
+    """
+    try:
+        cube = load_cube(window_days)
+        target_date = parse_selected_date(selected_date)
+
+        proportions_dict = parse_proportions(updated_proportions)
+        if round(sum(proportions_dict.values()), 4) != 1.0:
+            raise HTTPException(status_code=400, detail="Proportions must sum up to 1. Please check input values.")
+
+        packing_density = parse_packing_density(packing_density)
+        selected_date = target_date.strftime("%d-%m-%Y")
+
+        key = store_key(cube, "calculate_all", target_date, proportions_dict, packing_density)
+        return await single_flight.run("calculate_all", flight_key(cube, selected_date, proportions_dict, packing_density),
+                                       stored_or_computed(key, all_methods_response, cube, target_date, selected_date,
+                                                          proportions_dict, packing_density))
 
+    except HTTPException:
+        raise
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=f"Value Error: {str(ve)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-    # except Exception as e:
-    #     raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-# Endpoint to calculate modified q values
+def all_methods_response(cube, target_date, selected_date, proportions_dict, packing_density):
+    """
+    Response of /calculate_all/ for one date, with its summary row.
+    """
+    results = run_all_methods(cube, target_date, proportions_dict, packing_density)
+
+    summary = summarize_all_methods(target_date, results)
+    del summary["Date"]
+    return {
+        "message": f"All calculations for {selected_date}",
+        "gbd": {
+            "total_volume": round(results["total_volume"], 4),
+            "specific_gravity": round(results["specific_gravity"], 4),
+            "gbd_values": {str(packing_density): round(results["gbd"], 4)}
+        },
+        "andreasen": {
+            "q_values": results["q_df"].to_dict(orient="records"),
+            "intermediate_table": results["sorted_df"].to_dict(orient="records")
+        },
+        "modified_andreasen": {
+            "q_values": [{"Date": selected_date, f'q_{int(packing_density * 100)}': np.round(results["modified_q"], 4)}],
+            "mae": round(results["mae"], 4),
+            "cpft_error_table": results["modified_andreasen_df"].to_dict(orient="records")
+        },
+        "double_modified": {
+            "double_modified_q_values": [{"Date": selected_date, 'q_value': np.round(results["double_modified_q"], 4)}],
+            "intermediate_table": results["double_modified_df"].to_dict(orient="records")
+        }
+    }, summary
 
-@app.get("/calculate_q_value_modified_andreason/")
-async def calculate_q_value_modified_andreason(
-    selected_date: str = Query(...),
+
+def prepare_range_request(start_date, end_date, packing_density, updated_proportions, window_days=None):
+    """
+    Validates the query parameters shared by the range computations and loads the uploaded workbook.
+
+    Returns:
+        tuple: (cube, dates, proportions_dict, packing_density)
+    """
+    proportions_dict = parse_proportions(updated_proportions)
+    if round(sum(proportions_dict.values()), 4) != 1.0:
+        raise HTTPException(status_code=400, detail="Proportions must sum up to 1. Please check input values.")
+    packing_density = parse_packing_density(packing_density)
+
+    cube = load_cube(window_days)
+    dates = get_dates_in_range(cube, start_date, end_date)
+    if len(dates) == 0:
+        raise HTTPException(status_code=400, detail=f"No sample data found between {start_date} and {end_date}")
+
+    return cube, dates, proportions_dict, packing_density
+
+
+def iter_all_methods(cube, dates, proportions_dict, packing_density):
+    """
+    Yields (target_date, results of `run_all_methods`, error) for every date, one date at a time. Dates
+    that cannot be computed are yielded with their error instead of stopping the iteration.
+    """
+    for target_date in dates:
+        try:
+            yield target_date, run_all_methods(cube, target_date, proportions_dict, packing_density), None
+        except Exception as e:
+            yield target_date, None, str(e)
+
+
+def iter_range_results(cube, dates, proportions_dict, packing_density):
+    """
+    Yields one summary row per date as soon as that date has been computed. Dates that cannot be
+    computed are yielded with their error instead of stopping the iteration.
+    """
+    for target_date, results, error in iter_all_methods(cube, dates, proportions_dict, packing_density):
+        if error is None:
+            yield summarize_all_methods(target_date, results)
+        else:
+            yield {"Date": target_date.strftime("%d-%m-%Y"), "error": error}
+
+
+# Endpoint to stream GBD and q values for a range of dates
+
+@app.get("/calculate_range/stream/")
+def stream_range(
+    start_date: str = Query(...),
+    end_date: str = Query(...),
     packing_density: str = Query(...),
-    updated_proportions: str = Query(None)
+    updated_proportions: str = Query(...),
+    window_days: int = Query(None, ge=1, le=366, description="Average each sheet over this many days before calculating (rolling window)")
 ):
     """
-    Calculate q-value using Andreasen Equation for a given date.
+    Stream GBD and all q-values for every date between start_date and end_date (dd-mm-yyyy) as
+    newline-delimited JSON, one line per date, written as soon as that date is computed.
     """
-    global cached_final_df, cached_q_values, sorted_df  # Allow modification of global variable
+    cube, dates, proportions_dict, packing_density = prepare_range_request(
+        start_date, end_date, packing_density, updated_proportions, window_days)
+
+    def ndjson_lines():
+        for row in iter_range_results(cube, dates, proportions_dict, packing_density):
+            yield json.dumps(row) + "\n"
 
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
+# Endpoint to export GBD and q values for a range of dates to Excel
+
+@app.get("/export/xlsx/")
+def export_xlsx(
+    start_date: str = Query(None, description="First date (dd-mm-yyyy), defaults to the first available date"),
+    end_date: str = Query(None, description="Last date (dd-mm-yyyy), defaults to the last available date"),
+    packing_density: str = Query(None, description="Defaults to the packing density of the history"),
+    updated_proportions: str = Query(None, description="Defaults to the proportions of the history"),
+    include_intermediate: bool = Query(False, description="Add the intermediate table of every date as its own sheet"),
+    window_days: int = Query(None, ge=1, le=366, description="Average each sheet over this many days before calculating (rolling window)")
+):
+    """
+    Download GBD and all q-values per date as an .xlsx workbook with one sheet per method, and
+    optionally one sheet per date with its intermediate table. The workbook is written row by row
+    to a temporary file and streamed from disk.
+    """
+    cube = load_cube(window_days)
+    main_dates = pd.DatetimeIndex(cube.sheet_dates(updated_sheets[0]))
+    start_date = start_date or main_dates[0].strftime("%d-%m-%Y")
+    end_date = end_date or main_dates[-1].strftime("%d-%m-%Y")
+
+    cube, dates, proportions_dict, packing_density = prepare_range_request(
+        start_date, end_date, packing_density or str(default_packing_density),
+        updated_proportions or ",".join(map(str, default_proportions)), window_days)
+
+    def date_results():
+        for target_date, results, error in iter_all_methods(cube, dates, proportions_dict, packing_density):
+            if error is not None:
+                yield {"Date": target_date.strftime("%d-%m-%Y")}, None, error
+            else:
+                yield summarize_all_methods(target_date, results), results["sorted_df"], None
+
+    file_descriptor, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(file_descriptor)
     try:
+        write_results_workbook(path, date_results(), include_intermediate)
+    except Exception as e:
+        os.remove(path)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+    filename = f"gbd_q_values_{start_date}_{end_date}.xlsx"
+    return StreamingResponse(iter_file_chunks(path), media_type=XLSX_MEDIA_TYPE,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+# Background jobs for long running computations
+
+def run_range_job(job, cube, dates, proportions_dict, packing_density):
+    """
+    Job function computing GBD and all q-values for every date in `dates`, dates computed before are
+    read from the result store.
+    """
+    rows = []
+    job.check_cancelled()
+    for start in range(0, len(dates), batch_dates):
+        for row in summarize_dates_stored(cube, dates[start:start + batch_dates], proportions_dict, packing_density):
+            rows.append(row)
+            job.advance(current=row["Date"])
+        job.check_cancelled()
+
+    return rows
+
+
+@app.post("/jobs/range/")
+async def submit_range_job(
+    start_date: str = Query(...),
+    end_date: str = Query(...),
+    packing_density: str = Query(...),
+    updated_proportions: str = Query(...),
+    window_days: int = Query(None, ge=1, le=366, description="Average each sheet over this many days before calculating (rolling window)")
+):
+    """
+    Submit a background job calculating GBD and all q-values for every date between start_date and
+    end_date (dd-mm-yyyy). Returns the job ID to poll `/jobs/{job_id}` or stream `/jobs/{job_id}/events`.
+    """
+    cube, dates, proportions_dict, packing_density = prepare_range_request(
+        start_date, end_date, packing_density, updated_proportions, window_days)
+
+    job = job_manager.submit(
+        "range",
+        lambda job: run_range_job(job, cube, dates, proportions_dict, packing_density),
+        total=len(dates),
+        params={"start_date": start_date, "end_date": end_date, "packing_density": packing_density,
+                "updated_proportions": updated_proportions, "window_days": window_days}
+    )
+    return job.to_dict()
+
+
+def get_job_or_404(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """
+    Current status and progress (dates processed, ETA) of a job.
+    """
+    return get_job_or_404(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, interval: float = Query(0.5, gt=0)):
+    """
+    Server-sent events stream of job progress. A `progress` event is sent whenever the status or
+    progress changes, and a final `done` event once the job has finished.
+    """
+    job = get_job_or_404(job_id)
+
+    async def event_stream():
+        last_state = None
+        while True:
+            status = job.to_dict()
+            state = (status["status"], status["processed"])
+            if state != last_state:
+                yield f"event: progress\ndata: {json.dumps(status)}\n\n"
+                last_state = state
+            if status["status"] in FINISHED_STATES:
+                yield f"event: done\ndata: {json.dumps(status)}\n\n"
+                return
+            await asyncio.sleep(interval)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """
+    Result of a completed job.
+    """
+    job = get_job_or_404(job_id)
+    if job.status != COMPLETED:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}, no result available")
+    return {"job": job.to_dict(), "results": job.result}
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    Cancel a queued or running job.
+    """
+    get_job_or_404(job_id)
+    return job_manager.cancel(job_id).to_dict()
+
+
+# Precomputed history of q-values and GBD for the default proportions
+
+def run_history_job(job, cube, dates, rows):
+    """
+    Job function filling `rows` with (date, summary row, input dates) for every date, so that the
+    history can be queried while it is still being built. The input dates (the sample each sheet
+    resolves to) let a later upload tell which rows are still valid. Rows of a workbook summarized
+    before (e.g. before a restart) are read from the result store.
+    """
+    proportions_dict = dict(zip(updated_sheets, default_proportions))
+    inputs = cube.input_dates(dates)
 
-        if "file" not in file_storage:
+    job.check_cancelled()
+    for start in range(0, len(dates), batch_dates):
+        chunk = dates[start:start + batch_dates]
+        results = summarize_dates_stored(cube, chunk, proportions_dict, default_packing_density)
+        for target_date, row, date_inputs in zip(chunk, results, inputs[start:start + batch_dates]):
+            rows.append((target_date, row, date_inputs))
+            job.advance(current=row["Date"])
+        job.check_cancelled()
+
+    return {"dates": len(rows)}
+
+
+def plan_history_update(cube, dates):
+    """
+    Compares the new cube with the one the current history was built from and returns the rows that
+    can be kept, the dates to recompute and a report of the changes.
+    """
+    previous_cube = materialized_history["cube"]
+    report = {"previous_dataset_hash": materialized_history["dataset_hash"]}
+
+    if previous_cube is None or not same_layout(previous_cube, cube):
+        report.update({"mode": "full", "reason": "no previous history" if previous_cube is None else "mesh layout changed",
+                       "reused": 0, "recomputed": [{"Date": format_date(date), "reasons": ["full rebuild"]} for date in dates]})
+        return [], dates, report
+
+    previous_rows = {date.to_datetime64(): (date, row, inputs) for date, row, inputs in list(materialized_history["rows"])}
+    changes = changed_samples(previous_cube, cube)
+    reused, recompute = plan_recompute(cube, dates, {date: entry[2] for date, entry in previous_rows.items()}, changes)
+
+    report.update({
+        "mode": "incremental",
+        "changed_samples": [{"sheet": sheet_name, "date": format_date(date), "change": change}
+                            for (sheet_name, date), change in sorted(changes.items(), key=lambda item: (item[0][1], item[0][0]))],
+        "reused": len(reused),
+        "recomputed": [{"Date": format_date(date), "reasons": reasons} for date, reasons in recompute.items()],
+        "removed": [format_date(date) for date in sorted(set(previous_rows) - set(dates.values))],
+    })
+    return [previous_rows[date] for date in reused], pd.DatetimeIndex(list(recompute)), report
+
+
+def start_history_build(cube):
+    """
+    Starts materializing the history for a newly uploaded workbook. Re-uploading the same workbook
+    keeps the existing history; uploading a changed version of it only recomputes the dates whose
+    samples changed or now resolve to a different nearest past sample.
+    """
+    dataset_hash = cube.dataset_hash
+    current_job = materialized_history["job"]
+    if (materialized_history["dataset_hash"] == dataset_hash and current_job is not None
+            and current_job.status not in (FAILED, CANCELLED)):
+        return current_job
+
+    if current_job is not None:
+        job_manager.cancel(current_job.id)
+
+    dates = pd.DatetimeIndex(cube.sheet_dates(updated_sheets[0]))
+    rows, recompute_dates, report = plan_history_update(cube, dates)
+    job = job_manager.submit(
+        "history",
+        lambda job: run_history_job(job, cube, recompute_dates, rows),
+        total=len(recompute_dates),
+        params={"proportions": default_proportions, "packing_density": default_packing_density}
+    )
+
+    materialized_history.update({"dataset_hash": dataset_hash, "cube": cube, "job": job, "rows": rows, "update": report})
+    return job
+
+
+def summarize_history_update(report):
+    if report is None:
+        return None
+    return {key: len(value) if isinstance(value, list) else value for key, value in report.items()}
+
+
+@app.get("/history/")
+async def get_history(
+    start_date: str = Query(None, description="First date (dd-mm-yyyy), defaults to the first available date"),
+    end_date: str = Query(None, description="Last date (dd-mm-yyyy), defaults to the last available date"),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(100, ge=1, le=1000)
+):
+    """
+    Precomputed Andreasen q / R², Modified Andreasen q, Double Modified q and GBD per date for the
+    default proportions and packing density. Rows are available while the history is still being
+    built, the `build` field reports its progress.
+    """
+    job = materialized_history["job"]
+    if job is None:
+        raise HTTPException(status_code=400, detail="No file uploaded. Please upload a file first.")
+
+    start = pd.to_datetime(start_date, format="%d-%m-%Y", errors="coerce") if start_date else None
+    end = pd.to_datetime(end_date, format="%d-%m-%Y", errors="coerce") if end_date else None
+    if (start_date and pd.isna(start)) or (end_date and pd.isna(end)):
+        raise HTTPException(status_code=400, detail="Invalid date format. Please use dd-mm-yyyy.")
+
+    rows = [row for date, row, _ in sorted(list(materialized_history["rows"]), key=lambda entry: entry[0])
+            if (start is None or date >= start) and (end is None or date <= end)]
+
+    offset = (page - 1) * page_size
+    return {
+        "build": job.to_dict(),
+        "update": summarize_history_update(materialized_history["update"]),
+        "proportions": dict(zip(updated_sheets, default_proportions)),
+        "packing_density": default_packing_density,
+        "total": len(rows),
+        "page": page,
+        "page_size": page_size,
+        "rows": rows[offset:offset + page_size]
+    }
+
+
+@app.get("/history/changes/")
+async def get_history_changes():
+    """
+    What the last upload changed: the samples added, modified or removed compared with the previous
+    upload, and every recomputed date with the reason it was invalidated.
+    """
+    if materialized_history["job"] is None:
+        raise HTTPException(status_code=400, detail="No file uploaded. Please upload a file first.")
+    return materialized_history["update"]
+
+
+# Results computed before, persisted in the result store
+
+@app.get("/results/")
+def get_stored_results(
+    method: str = Query(None, description="Endpoint name (e.g. calculate_all) or 'summary' for the range and history rows"),
+    start_date: str = Query(None, description="First date (dd-mm-yyyy)"),
+    end_date: str = Query(None, description="Last date (dd-mm-yyyy)"),
+    updated_proportions: str = Query(None),
+    packing_density: str = Query(None),
+    window_days: int = Query(None, ge=1, le=366),
+    dataset_hash: str = Query(None, description="Workbook SHA-256, defaults to the uploaded workbook"),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(100, ge=1, le=1000)
+):
+    """
+    Summary values (GBD, q-values, R², MAE) of every result stored for a workbook, including results
+    computed before a restart, filtered by method, date range, proportions, packing density and rolling
+    window and ordered by date.
+    """
+    if dataset_hash is None:
+        if "dataset_hash" not in file_storage:
             raise HTTPException(status_code=400, detail="No file uploaded. Please upload a file first.")
+        dataset_hash = file_storage["dataset_hash"]
 
-        file_obj = file_storage["file"]
-        file_obj.seek(0)
+    start = parse_selected_date(start_date).strftime("%Y-%m-%d") if start_date else None
+    end = parse_selected_date(end_date).strftime("%Y-%m-%d") if end_date else None
+    proportions = format_proportions(parse_proportions(updated_proportions)) if updated_proportions else None
+    density = format_packing_density(parse_packing_density(packing_density)) if packing_density else None
 
-        sheets = read_excel_file(file_obj, required_sheets)
-        cleaned_sheets = clean_data(sheets)
-        
-        # selected_date = pd.to_datetime(selected_date, format="%d-%m-%Y", errors="coerce")
-        sample_data = get_sample_data_for_date(cleaned_sheets, updated_sheets, selected_date)
-        if not sample_data or all(df is None or df.empty for df in sample_data.values()):
-            raise HTTPException(status_code=400, detail=f"No sample data found for {selected_date}")
-        
-        # ✅ Convert proportions from query string to dictionary
-        proportions_list = [float(value.strip()) for value in updated_proportions.split(",")]
-        proportions_dict = dict(zip(updated_sheets, proportions_list))
-        
-        processed_data = average_samples_per_date(cleaned_sheets)
-        print("Average calculation Done!")
+    total, rows = result_store.query(dataset_hash, method, start, end, proportions, density, window_days,
+                                     limit=page_size, offset=(page - 1) * page_size)
 
-        # Define the columns you want to exclude from numeric calculations
-        excluded_columns = ['Total', 'Loose Bulk Density (gm/cc)', 'Sp. gravity']
+    return {
+        "dataset_hash": dataset_hash,
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "rows": rows
+    }
 
-        # Call the function to calculate cumulative weights
-        cumulative_sheets = calculate_cumulative_weights(processed_data, excluded_columns)
 
-        # ✅ Compute sheet constants dynamically
-        sheet_multipliers = get_sheet_constants_from_proportions(proportions_dict)
-        
-        # Process the data and consolidate the results from all sheets
-        sheet_CPFT_df = Calculate_Sheet_CPFT(cumulative_sheets, selected_date, proportions_dict, d_values)
+# Sensitivity of the q-values and GBD to the mixing proportions
 
-        # Call the function
-        updated_df = rearrange_mess_sizes(sheet_CPFT_df)
+def perturbed_proportions(proportions_dict, step):
+    """
+    Builds the proportion vectors needed for the finite difference of every sheet proportion while
+    keeping the proportions summing to 1: the proportion of one sheet is moved by `step` and the other
+    sheets are rescaled so that they keep their relative shares.
 
-        # ✅ Convert packing density input (supports single or multiple values)
-        try:
-            packing_density = float(packing_density.strip())
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid packing density input. Please enter valid numbers.")
+    A proportion is only moved down when it stays above 0 and only moved up when it stays below 1, since
+    a sheet reaching 0 drops its rows from the table. A one-sided difference is used in those cases.
 
-        print(packing_density)
-        # Add columns to the DataFrame
-        sorted_df = add_columns(updated_df, proportions_dict, sheet_multipliers, packing_density)
+    Returns:
+        tuple: (vectors, lower_steps, upper_steps). `vectors` holds the base proportions followed by the
+        lower and upper vector of every sheet, shape (1 + 2 * S, S) in `updated_sheets` order.
+    """
+    base = np.array([proportions_dict[sheet] for sheet in updated_sheets], dtype=float)
+    lower_steps = np.where(base - step > 0, step, 0.0)
+    upper_steps = np.where(base + step < 1, step, 0.0)
 
-        sorted_df['Log_D/Dmax_value'] = np.log(sorted_df['Normalized_D'])
-        sorted_df['Log_pct_CPFT'] = np.log(sorted_df['pct_CPFT_interpolation'])
+    vectors = [base]
+    for i in range(len(base)):
+        others = np.arange(len(base)) != i
+        for moved in (base[i] - lower_steps[i], base[i] + upper_steps[i]):
+            vector = base.copy()
+            vector[i] = moved
+            rest = base[others].sum()
+            vector[others] = base[others] * (1 - moved) / rest if rest > 0 else (1 - moved) / others.sum()
+            vectors.append(vector)
 
-        print(sorted_df[["Column Name", 'pct_poros_CPFT']])
+    return np.array(vectors), lower_steps, upper_steps
 
-    
-        # Create the modified DataFrame with specific columns
-        modified_df = sorted_df[['Sheet Name', 'Column Name', 'D_value', 'pct_CPFT_interpolation', 'pct_poros_CPFT']]
-        print(f"\nDF for modified andreason:{modified_df}")
 
-        # Step 1: Optimize q-value for a single packing density
-        optimal_q = optimize_q(modified_df, D_col='D_value', pct_CPFT_col='pct_poros_CPFT')
-        print(f"Optimal q-value: q = {optimal_q}")
+@app.get("/sensitivity/")
+def calculate_sensitivity(
+    packing_density: str = Query(...),
+    updated_proportions: str = Query(...),
+    selected_date: str = Query(None, description="Single date (dd-mm-yyyy)"),
+    start_date: str = Query(None, description="First date of a range (dd-mm-yyyy), used with end_date"),
+    end_date: str = Query(None, description="Last date of a range (dd-mm-yyyy), used with start_date"),
+    step: float = Query(0.01, gt=0, le=0.2, description="Change of each proportion, 0.01 matches the 1 % resolution of the sheet constants")
+):
+    """
+    Sensitivity of the Andreasen q, Modified Andreasen q and GBD to each of the five proportions, for
+    one date or every date of a range. Each value is the change of the result per unit change of that
+    proportion, the other proportions being rescaled so that they still sum to 1.
 
-        q_results = {"Date": selected_date,
-                     f'q_{int(packing_density * 100)}': np.round(optimal_q, 4)}
+    All perturbed proportion vectors are evaluated in one batch: GBD for every date and vector in a
+    single matrix product, the q-values by fitting the stacked tables of every date and vector at once.
+    """
+    if selected_date:
+        cube = load_cube()
+        dates = pd.DatetimeIndex([parse_selected_date(selected_date)])
+        proportions_dict = parse_proportions(updated_proportions)
+        if round(sum(proportions_dict.values()), 4) != 1.0:
+            raise HTTPException(status_code=400, detail="Proportions must sum up to 1. Please check input values.")
+        packing_density = parse_packing_density(packing_density)
+    elif start_date and end_date:
+        cube, dates, proportions_dict, packing_density = prepare_range_request(
+            start_date, end_date, packing_density, updated_proportions)
+    else:
+        raise HTTPException(status_code=400, detail="Please provide selected_date, or start_date and end_date.")
+
+    vectors, lower_steps, upper_steps = perturbed_proportions(proportions_dict, step)
+    vector_dicts = [dict(zip(updated_sheets, vector)) for vector in vectors]
+    widths = lower_steps + upper_steps
+
+    def differences(values):
+        # values: (..., 1 + 2 * S) -> derivative per sheet, (..., S)
+        lower, upper = values[..., 1::2], values[..., 2::2]
+        return (upper - lower) / widths
 
-        # q_results[f'q_{int(packing_density * 100)}'] = np.round(optimal_q, 4)
+    try:
+        rows = cube.rows_for(dates)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"Value Error: {str(ve)}")
 
-        print(q_results)
-        print(type(q_results))
+    _, density = cube.gbd_batch(rows, np.array([cube.proportion_vector(vector) for vector in vector_dicts]))
+    gbd = density * packing_density
+    fits = fit_q_values_batch(cube, rows, vector_dicts, packing_density)
 
-        q_df = pd.DataFrame([q_results])
-        print(q_df)
-        print(type(q_df))
+    results = []
+    for date_index, target_date in enumerate(dates):
+        row = {"Date": target_date.strftime("%d-%m-%Y")}
+        values_by_name = (("gbd", gbd[date_index]), ("q_value", fits["q_value"][:, date_index]),
+                          ("modified_q", fits["modified_q"][:, date_index]))
+        if not all(np.isfinite(values).all() for _, values in values_by_name):
+            row["error"] = "The q-values could not be fitted for this date."
+            results.append(row)
+            continue
 
+        for name, values in values_by_name:
+            row[name] = round(float(values[0]), 4)
+            row[f"{name}_sensitivity"] = dict(zip(updated_sheets, (np.round(differences(values), 4) + 0.0).tolist()))
+        results.append(row)
 
-        # Step 2: Calculate errors and MAE for the single q-value
-        modified_andreasen_df, mae = calculate_errors_and_mae(modified_df, D_col='D_value', pct_CPFT_col='pct_poros_CPFT', q=optimal_q)
+    return {
+        "proportions": proportions_dict,
+        "packing_density": packing_density,
+        "step": step,
+        "results": results
+    }
 
-        # Print the updated DataFrame and MAE
-        print(f"Updated DataFrame:\n{modified_andreasen_df}")
-        print(f"Mean Absolute Error (MAE): {mae}")
 
-        cpft_error_dict={}
-        cpft_error_dict[selected_date] = modified_andreasen_df
+# GBD and q-values over a grid of blend proportions
 
-        print(cpft_error_dict)
-        print(cpft_error_dict[selected_date])
+def simplex_grid(free_count, divisions):
+    """
+    Every vector of `free_count` non-negative integers summing to `divisions`, i.e. the points of the
+    simplex lattice (stars and bars), shape (comb(divisions + free_count - 1, free_count - 1), free_count).
+    """
+    slots = divisions + free_count - 1
+    bars = np.array(list(itertools.combinations(range(slots), free_count - 1)), dtype=int).reshape(-1, free_count - 1)
+    edges = np.hstack([np.full((len(bars), 1), -1), bars, np.full((len(bars), 1), slots)])
+    return np.diff(edges, axis=1) - 1
 
-        return {
-            "message": f"q-value Calculation using Modified Andreasen Eq. for {selected_date}",
-            "q_values": q_df.to_dict(orient="records"),
-            "cpft_error_table": cpft_error_dict[selected_date].to_dict(orient="records")
-        }
-    
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}   This is the error")
-    
-# Endpoint to calculate modified q values
 
-# ✅ **New API Endpoint for Double Modified q-values**
-@app.get("/calculate_q_value_double_modified/")
-async def calculate_q_value_double_modified(
-    selected_date: str = Query(...), 
-    updated_proportions: str = Query(None)
+def parse_fixed_proportions(fixed_proportions):
+    """
+    Converts the fixed proportions query string (one entry per sheet, empty for the free sheets, e.g.
+    "0.35,,,,0.2") to a dictionary of the fixed sheets.
+    """
+    values = [value.strip() for value in fixed_proportions.split(",")] if fixed_proportions else [""] * len(updated_sheets)
+    if len(values) != len(updated_sheets):
+        raise HTTPException(status_code=400, detail=f"Expected {len(updated_sheets)} fixed proportions (empty for free sheets), got {len(values)}.")
+    try:
+        fixed = {sheet: float(value) for sheet, value in zip(updated_sheets, values) if value}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid fixed proportions input. Please enter comma separated numbers, empty for free sheets.")
+
+    if any(not 0 <= value <= 1 for value in fixed.values()) or round(sum(fixed.values()), 4) > 1:
+        raise HTTPException(status_code=400, detail="Fixed proportions must be between 0 and 1 and sum up to at most 1.")
+    if len(fixed) == len(updated_sheets) and round(sum(fixed.values()), 4) != 1.0:
+        raise HTTPException(status_code=400, detail="Proportions must sum up to 1. Please check input values.")
+    return fixed
+
+
+@app.get("/proportion_grid/")
+def calculate_proportion_grid(
+    selected_date: str = Query(...),
+    packing_density: str = Query(...),
+    step: float = Query(0.05, gt=0, le=0.5, description="Grid spacing of the free proportions"),
+    fixed_proportions: str = Query(None, description="Proportions kept fixed, one entry per sheet and empty for the free sheets (e.g. 0.35,,,,0.2)")
 ):
     """
-    Calculate q-values using the **Double Modified Andreasen Equation** for a given date.
+    GBD, Andreasen q and R², Modified Andreasen q and MAE and Double Modified q for every blend of a
+    grid over the proportion simplex, for one date. The free sheets share what the fixed ones leave in
+    multiples of `step`. Every blend is evaluated in a few vector passes (GBD as one matrix product, the
+    tables and fits stacked), and the result is returned column by column, ready to be plotted as
+    heatmaps or slices.
     """
-    global cached_final_df, sorted_df # Use cached final_df instead of recomputing
+    cube = load_cube()
+    target_date = parse_selected_date(selected_date)
+    packing_density = parse_packing_density(packing_density)
+    fixed = parse_fixed_proportions(fixed_proportions)
+
+    free = [sheet for sheet in updated_sheets if sheet not in fixed]
+    remaining = max(0.0, 1 - sum(fixed.values()))
+    divisions = round(remaining / step)
+    if free and remaining > 0 and divisions == 0:
+        raise HTTPException(status_code=400, detail=f"The step {step} is larger than the {round(remaining, 4)} left for the free sheets.")
+
+    count = math.comb(divisions + len(free) - 1, len(free) - 1) if free else 1
+    if count > max_grid_blends:
+        raise HTTPException(status_code=400, detail=f"The grid has {count} blends, at most {max_grid_blends} are evaluated. Please use a larger step or fix more sheets.")
+
+    # Blends in updated_sheets order, rounded so that lattice points read like typed proportions
+    proportion_matrix = np.zeros((count, len(updated_sheets)))
+    for sheet, value in fixed.items():
+        proportion_matrix[:, updated_sheets.index(sheet)] = value
+    if free and divisions > 0:
+        proportion_matrix[:, [updated_sheets.index(sheet) for sheet in free]] = simplex_grid(len(free), divisions) * (remaining / divisions)
+    proportion_matrix = np.round(proportion_matrix, 10)
 
     try:
+        rows = cube.rows_for(target_date)[0]
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"Value Error: {str(ve)}")
 
+    cube_order = [updated_sheets.index(sheet_name) for sheet_name in cube.sheets]
+    _, density = cube.gbd_batch(rows[None, :], proportion_matrix[:, cube_order])
+    results = {"gbd": density[0] * packing_density}
+
+    fits = [fit_q_values_grid(cube, rows, proportion_matrix[start:start + grid_chunk], packing_density)
+            for start in range(0, count, grid_chunk)]
+    for name in ("q_value", "r_squared", "modified_q", "mae", "double_modified_q"):
+        results[name] = np.concatenate([fit[name] for fit in fits])
+
+    def column(values):
+        values = np.round(values, 4)
+        return [None if not np.isfinite(value) else value for value in values.tolist()]
+
+    best = int(np.nanargmax(results["gbd"])) if np.isfinite(results["gbd"]).any() else None
+    return {
+        "selected_date": target_date.strftime("%d-%m-%Y"),
+        "packing_density": packing_density,
+        "step": step,
+        "fixed": fixed,
+        "free": free,
+        "count": count,
+        "proportions": {sheet: column(proportion_matrix[:, i]) for i, sheet in enumerate(updated_sheets)},
+        "results": {name: column(values) for name, values in results.items()},
+        "best_gbd": None if best is None else {
+            "proportions": dict(zip(updated_sheets, column(proportion_matrix[best]))),
+            **{name: column(values[best:best + 1])[0] for name, values in results.items()}
+        }
+    }
 
-        if "file" not in file_storage:
-            raise HTTPException(status_code=400, detail="No file uploaded. Please upload a file first.")
 
-        file_obj = file_storage["file"]
-        file_obj.seek(0)
+# Bulk evaluation of (date, proportions, packing density) scenarios
 
-        sheets = read_excel_file(file_obj, required_sheets)
-        cleaned_sheets = clean_data(sheets)
-        
-        # selected_date = pd.to_datetime(selected_date, format="%d-%m-%Y", errors="coerce")
-        sample_data = get_sample_data_for_date(cleaned_sheets, updated_sheets, selected_date)
-        if not sample_data or all(df is None or df.empty for df in sample_data.values()):
-            raise HTTPException(status_code=400, detail=f"No sample data found for {selected_date}")
-        
-        # ✅ Convert proportions from query string to dictionary
-        proportions_list = [float(value.strip()) for value in updated_proportions.split(",")]
-        proportions_dict = dict(zip(updated_sheets, proportions_list))
-        
-        processed_data = average_samples_per_date(cleaned_sheets)
-        print("Average calculation Done!")
+scenario_result_names = ["total_volume", "specific_gravity", "gbd", "q_value", "r_squared", "modified_q", "mae", "double_modified_q"]
 
-        # Define the columns you want to exclude from numeric calculations
-        excluded_columns = ['Total', 'Loose Bulk Density (gm/cc)', 'Sp. gravity']
 
-        # Call the function to calculate cumulative weights
-        cumulative_sheets = calculate_cumulative_weights(processed_data, excluded_columns)
+def read_scenarios(body, content_type):
+    """
+    Reads the scenario list of a /scenarios/ request body, either JSON (a list of objects, or an object
+    with a "scenarios" list) or CSV (one row per scenario). A scenario has a date (dd-mm-yyyy), the
+    proportions (a list or comma separated string in sheet order, an object keyed by sheet name, or one
+    CSV column per sheet), an optional packing density and an optional id.
 
-        # ✅ Compute sheet constants dynamically
-        sheet_multipliers = get_sheet_constants_from_proportions(proportions_dict)
-        
-        # Process the data and consolidate the results from all sheets
-        sheet_CPFT_df = Calculate_Sheet_CPFT(cumulative_sheets, selected_date, proportions_dict, d_values)
+    Returns:
+        list: Raw scenario dicts with the keys id, date, proportions and packing_density.
+    """
+    if "csv" in content_type:
+        try:
+            table = pd.read_csv(io.BytesIO(body), dtype=str, keep_default_na=False, skipinitialspace=True)
+        except (ValueError, pd.errors.ParserError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid CSV scenario list: {str(e)}")
+        table.columns = [column.strip() for column in table.columns]
+        sheet_columns = [sheet for sheet in updated_sheets if sheet in table.columns]
+        if "date" not in table.columns or ("proportions" not in table.columns and len(sheet_columns) != len(updated_sheets)):
+            raise HTTPException(status_code=400, detail=f"CSV scenarios need a 'date' column and a 'proportions' column or one column per sheet ({', '.join(updated_sheets)}).")
+        records = table.to_dict(orient="records")
+        return [{"id": record.get("id") or None, "date": record["date"],
+                 "proportions": record["proportions"] if "proportions" in record else [record[sheet] for sheet in updated_sheets],
+                 "packing_density": record.get("packing_density") or None} for record in records]
+
+    try:
+        scenarios = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON scenario list: {str(e)}")
+    if isinstance(scenarios, dict):
+        scenarios = scenarios.get("scenarios")
+    if not isinstance(scenarios, list) or not all(isinstance(scenario, dict) for scenario in scenarios):
+        raise HTTPException(status_code=400, detail="Please send a list of scenario objects, or an object with a 'scenarios' list.")
+    return [{"id": scenario.get("id"), "date": scenario.get("date"), "proportions": scenario.get("proportions"),
+             "packing_density": scenario.get("packing_density")} for scenario in scenarios]
+
+
+def parse_scenario(scenario):
+    """
+    Validates one raw scenario like the query parameters of the single-date endpoints.
 
-        # Call the function
-        updated_df = rearrange_mess_sizes(sheet_CPFT_df)
+    Returns:
+        tuple: (target_date, proportions in `updated_sheets` order, packing_density), or raises ValueError.
+    """
+    target_date = pd.to_datetime(scenario["date"], format="%d-%m-%Y", errors="coerce") if isinstance(scenario["date"], str) else pd.NaT
+    if pd.isna(target_date):
+        raise ValueError(f"Invalid date '{scenario['date']}'. Please use dd-mm-yyyy.")
+
+    proportions = scenario["proportions"]
+    if isinstance(proportions, dict):
+        proportions = [proportions.get(sheet, 0) for sheet in updated_sheets]
+    elif isinstance(proportions, str):
+        proportions = proportions.split(",")
+    try:
+        proportions = [float(str(value).strip()) for value in proportions]
+    except (TypeError, ValueError):
+        raise ValueError("Invalid proportions. Please enter numbers.")
+    if len(proportions) != len(updated_sheets):
+        raise ValueError(f"Expected {len(updated_sheets)} proportions, got {len(proportions)}.")
+    if round(sum(proportions), 4) != 1.0:
+        raise ValueError("Proportions must sum up to 1. Please check input values.")
+
+    packing_density = scenario["packing_density"]
+    try:
+        packing_density = default_packing_density if packing_density is None else float(str(packing_density).strip())
+    except ValueError:
+        raise ValueError("Invalid packing density. Please enter a number.")
 
-        # # ✅ Convert packing density input (supports single or multiple values)
-        # try:
-        #     packing_density = float(packing_density.strip())
-        # except ValueError:
-        #     raise HTTPException(status_code=400, detail="Invalid packing density input. Please enter valid numbers.")
+    return target_date, proportions, packing_density
 
-        packing_density = None
-        # Add columns to the DataFrame
-        sorted_df = add_columns(updated_df, proportions_dict, sheet_multipliers, packing_density)
 
-        sorted_df['Log_D/Dmax_value'] = np.log(sorted_df['Normalized_D'])
-        sorted_df['Log_pct_CPFT'] = np.log(sorted_df['pct_CPFT_interpolation'])
+def evaluate_date_scenarios(cube, target_date, proportion_matrix, packing_densities):
+    """
+    GBD and all q-values of every scenario of one date. The cube rows (the averaged and cumulative
+    stages) are looked up once, the scenarios are evaluated together as a proportion grid.
 
-        
-        print("Before main function call")
-        # Call the function with the sorted DataFrame
-        Q_value, modified_df = calculate_Q_value_and_plot(sorted_df, pct_CPFT_col='pct_poros_CPFT')
-        print("After main function call")
-        print(f"The optimal Q-value using the Modified Andreasen Equation is: {Q_value}")
+    Returns:
+        dict: Arrays of shape (K,) for every name of `scenario_result_names`.
+    """
+    rows = cube.rows_for(target_date)[0]
+    cube_order = [updated_sheets.index(sheet_name) for sheet_name in cube.sheets]
+    total_volume, density = cube.gbd_batch(rows[None, :], proportion_matrix[:, cube_order])
 
-        # Print the updated DataFrame
-        # print(f"Modified DataFrame:\n{modified_df}")
+    results = {"total_volume": total_volume[0], "specific_gravity": density[0], "gbd": density[0] * packing_densities}
+    fits = [fit_q_values_grid(cube, rows, proportion_matrix[start:start + grid_chunk], packing_densities[start:start + grid_chunk])
+            for start in range(0, len(proportion_matrix), grid_chunk)]
+    for name in ("q_value", "r_squared", "modified_q", "mae", "double_modified_q"):
+        results[name] = np.concatenate([fit[name] for fit in fits])
+    return results
 
-        print("\nq results:")
-        q_results = {"Date": selected_date,
-                     f'q_value': np.round(Q_value, 4)}
 
-        print(q_results)
-        print(type(q_results))
+def evaluate_scenarios(cube, scenarios):
+    """
+    Result table of a scenario list, in input order. Scenarios are grouped by date and the dates are
+    evaluated in parallel on the shared `scenario_executor`, so concurrent requests share its threads. Invalid scenarios and dates that cannot be computed get an
+    error instead of failing the whole list.
+    """
+    table = [{"id": scenario["id"] if scenario["id"] is not None else index, "date": scenario["date"]}
+             for index, scenario in enumerate(scenarios)]
 
-        q_df = pd.DataFrame([q_results])
-        print(q_df)
-        print(type(q_df))
+    groups = {}
+    for index, scenario in enumerate(scenarios):
+        try:
+            target_date, proportions, packing_density = parse_scenario(scenario)
+        except ValueError as ve:
+            table[index]["error"] = str(ve)
+            continue
+        table[index].update({"date": target_date.strftime("%d-%m-%Y"), **dict(zip(updated_sheets, proportions)),
+                             "packing_density": packing_density})
+        groups.setdefault(target_date, []).append((index, proportions, packing_density))
+
+    def evaluate_group(item):
+        target_date, members = item
+        try:
+            return members, evaluate_date_scenarios(cube, target_date, np.array([proportions for _, proportions, _ in members]),
+                                                    np.array([packing_density for _, _, packing_density in members])), None
+        except ValueError as ve:
+            return members, None, str(ve)
+
+    for members, results, error in scenario_executor.map(evaluate_group, groups.items()):
+        for position, (index, _, _) in enumerate(members):
+            row = table[index]
+            if error is not None:
+                row["error"] = error
+                continue
+            values = [results[name][position] for name in scenario_result_names]
+            if not np.isfinite(values).all():
+                row["error"] = "The q-values could not be fitted for this scenario."
+                continue
+            row.update({name: round(float(value), 4) for name, value in zip(scenario_result_names, values)})
+
+    return table, len(groups)
+
+
+@app.post("/scenarios/")
+async def calculate_scenarios(
+    request: Request,
+    format: str = Query("json", pattern="^(json|csv)$", description="Result table as JSON or CSV")
+):
+    """
+    Evaluate a list of (date, proportions, packing density) scenarios in one request, sent as JSON
+    (Content-Type: application/json) or CSV (Content-Type: text/csv). Scenarios of the same date share
+    the cube lookup and are fitted together, dates are evaluated in parallel. Returns one row per
+    scenario, in input order, with GBD and all q-values or the error of that scenario.
+    """
+    cube = load_cube()
+    scenarios = read_scenarios(await request.body(), request.headers.get("content-type", ""))
+    if not scenarios:
+        raise HTTPException(status_code=400, detail="The scenario list is empty.")
+    if len(scenarios) > max_scenarios:
+        raise HTTPException(status_code=400, detail=f"Got {len(scenarios)} scenarios, at most {max_scenarios} are evaluated per request.")
 
-        print("\nFinal_df")
-        final_df={}
-        final_df[selected_date] = modified_df
+    try:
+        table, dates = await asyncio.get_running_loop().run_in_executor(None, evaluate_scenarios, cube, scenarios)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-        print(final_df)
-        print(final_df[selected_date])
+    if format == "csv":
+        columns = ["id", "date", *updated_sheets, "packing_density", *scenario_result_names, "error"]
+        return Response(pd.DataFrame(table, columns=columns).to_csv(index=False), media_type="text/csv",
+                        headers={"Content-Disposition": 'attachment; filename="scenarios.csv"'})
 
-        return {
-            "message": f"Double Modified q-value Calculation for {selected_date}",
-            "double_modified_q_values": q_df.to_dict(orient="records"),
-            "intermediate_table": final_df[selected_date].to_dict(orient="records") # ✅ Pass the intermediate table for regression
-        }
+    return {
+        "count": len(table),
+        "dates": dates,
+        "errors": sum("error" in row for row in table),
+        "results": table
+    }
 
+
+# Bootstrap confidence intervals from the individual samples
+
+@app.get("/bootstrap/")
+def calculate_bootstrap(
+    selected_date: str = Query(...),
+    packing_density: str = Query(...),
+    updated_proportions: str = Query(...),
+    n_resamples: int = Query(2000, ge=100, le=20000),
+    confidence: float = Query(0.95, gt=0, lt=1),
+    seed: int = Query(None, description="Random seed, for reproducible intervals")
+):
+    """
+    Confidence intervals of GBD, the Andreasen q (and R²), Modified Andreasen q and Double Modified q for
+    a given date, from bootstrap resamples of the individual samples averaged into that date.
+    """
+    cube = load_cube()
+    target_date = parse_selected_date(selected_date)
+
+    proportions_dict = parse_proportions(updated_proportions)
+    if round(sum(proportions_dict.values()), 4) != 1.0:
+        raise HTTPException(status_code=400, detail="Proportions must sum up to 1. Please check input values.")
+    packing_density = parse_packing_density(packing_density)
+
+    try:
+        rows = cube.rows_for(target_date)[0]
+        intervals = bootstrap_confidence_intervals(
+            cube, rows, proportions_dict, packing_density, n_resamples=n_resamples, confidence=confidence, seed=seed)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"Value Error: {str(ve)}")
+
+    return {
+        "message": f"Bootstrap confidence intervals for {selected_date}",
+        "n_resamples": n_resamples,
+        "confidence": confidence,
+        **intervals
+    }
+
+
+# Cross-workbook comparison of uploaded datasets
+
+def register_dataset(dataset_hash, filename, cube):
+    """
+    Keeps the cube of an uploaded workbook for later comparisons and returns its dataset ID. Uploading
+    the same workbook again returns the same ID.
+    """
+    dataset_id = dataset_hash[:16]
+    datasets.pop(dataset_id, None)
+    datasets[dataset_id] = {"filename": filename, "cube": cube, "uploaded_at": time.time()}
+    while len(datasets) > max_datasets:
+        datasets.popitem(last=False)
+    return dataset_id
+
+
+def get_compare_executor():
+    global compare_executor
+    with compare_executor_lock:
+        if compare_executor is None:
+            compare_executor = ProcessPoolExecutor(
+                max_workers=int(os.getenv("COMPARE_WORKERS", str(os.cpu_count() or 1))),
+                mp_context=multiprocessing.get_context("spawn"))
+        return compare_executor
+
+
+def discard_compare_executor(executor):
+    """
+    Drops a broken worker pool (a worker process died), the next comparison starts a new one.
+    """
+    global compare_executor
+    with compare_executor_lock:
+        if compare_executor is executor:
+            compare_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+@app.get("/datasets/")
+async def list_datasets():
+    """
+    Uploaded datasets available for comparison.
+    """
+    return {"datasets": [
+        {"dataset_id": dataset_id, "filename": entry["filename"], "uploaded_at": entry["uploaded_at"],
+         "date_range": [str(pd.Timestamp(entry["cube"].dates[0]).date()), str(pd.Timestamp(entry["cube"].dates[-1]).date())]}
+        for dataset_id, entry in datasets.items()
+    ]}
+
+
+@app.get("/compare/")
+def compare_datasets(
+    dataset_ids: str = Query(..., description="Comma separated dataset IDs returned by /upload/"),
+    start_date: str = Query(...),
+    end_date: str = Query(...),
+    packing_density: str = Query(...),
+    updated_proportions: str = Query(...)
+):
+    """
+    Calculate GBD and all q-values of several uploaded datasets between start_date and end_date
+    (dd-mm-yyyy), one dataset per worker process.
+
+    Every dataset is evaluated on the same dates, the union of the main sheet dates of all datasets in
+    the range, so the results are aligned: each value list has one entry per date, None where a dataset
+    could not be calculated (e.g. no sample on or before that date).
+    """
+    ids = [dataset_id.strip() for dataset_id in dataset_ids.split(",") if dataset_id.strip()]
+    unknown = [dataset_id for dataset_id in ids if dataset_id not in datasets]
+    if not ids or unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset IDs: {unknown}. Please upload the files first.")
+
+    proportions_dict = parse_proportions(updated_proportions)
+    if round(sum(proportions_dict.values()), 4) != 1.0:
+        raise HTTPException(status_code=400, detail="Proportions must sum up to 1. Please check input values.")
+    packing_density = parse_packing_density(packing_density)
+
+    cubes = {dataset_id: datasets[dataset_id]["cube"] for dataset_id in ids}
+    dates = pd.DatetimeIndex(sorted(set().union(*(get_dates_in_range(cube, start_date, end_date) for cube in cubes.values()))))
+    if len(dates) == 0:
+        raise HTTPException(status_code=400, detail=f"No sample data found between {start_date} and {end_date}")
+
+    executor = get_compare_executor()
+    metrics = ["total_volume", "specific_gravity", "gbd", "q_value", "r_squared", "modified_q", "mae", "double_modified_q"]
+    results = {}
+    try:
+        futures = {dataset_id: executor.submit(compare_dataset, cube.without_replicates(), dates, proportions_dict, packing_density)
+                   for dataset_id, cube in cubes.items()}
+        dataset_rows = {dataset_id: future.result() for dataset_id, future in futures.items()}
+    except BrokenProcessPool:
+        discard_compare_executor(executor)
+        raise HTTPException(status_code=503, detail="A comparison worker process stopped unexpectedly, please retry.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+    for dataset_id, rows in dataset_rows.items():
+        results[dataset_id] = {
+            "filename": datasets[dataset_id]["filename"],
+            **{metric: [row.get(metric) for row in rows] for metric in metrics},
+            "errors": {row["Date"]: row["error"] for row in rows if "error" in row}
+        }
+
+    return {
+        "dates": [date.strftime("%d-%m-%Y") for date in dates],
+        "proportions": proportions_dict,
+        "packing_density": packing_density,
+        "datasets": results
+    }
+
+
+# Live recompute while the dashboard edits proportions and porosity
+
+def apply_live_update(pipeline, update):
+    """
+    Applies one merged update of a live session and returns the pipeline (created on the first valid
+    update, rebuilt when a new workbook was uploaded) with the message to send back.
+
+    The update holds any of selected_date (dd-mm-yyyy), updated_proportions (comma separated or a list)
+    and packing_density, parsed like the query parameters of the other endpoints.
+    """
+    inputs = {}
+    if "selected_date" in update:
+        inputs["selected_date"] = parse_selected_date(update["selected_date"])
+    if "updated_proportions" in update:
+        proportions = update["updated_proportions"]
+        if isinstance(proportions, list):
+            proportions = ",".join(map(str, proportions))
+        inputs["proportions"] = parse_proportions(proportions)
+        if round(sum(inputs["proportions"].values()), 4) != 1.0:
+            raise HTTPException(status_code=400, detail="Proportions must sum up to 1. Please check input values.")
+    if "packing_density" in update:
+        inputs["packing_density"] = parse_packing_density(str(update["packing_density"]))
+
+    cube = load_cube()
+    if pipeline is None or pipeline.cube is not cube:
+        if pipeline is None and "selected_date" not in inputs:
+            raise HTTPException(status_code=400, detail="Please send selected_date first.")
+        previous = pipeline.inputs if pipeline is not None else {}
+        pipeline = LivePipeline(
+            cube,
+            inputs.get("selected_date", previous.get("selected_date")),
+            inputs.get("proportions", previous.get("proportions", dict(zip(updated_sheets, default_proportions)))),
+            inputs.get("packing_density", previous.get("packing_density", default_packing_density))
+        )
+
+    started = time.perf_counter()
+    try:
+        recomputed = pipeline.update(**inputs)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"Value Error: {str(ve)}")
+
+    return pipeline, {
+        "type": "result",
+        "selected_date": format_date(pipeline.inputs["selected_date"]),
+        "proportions": pipeline.inputs["proportions"],
+        "packing_density": pipeline.inputs["packing_density"],
+        "recomputed": recomputed,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+        "results": pipeline.results()
+    }
+
+
+@app.websocket("/ws/live/")
+async def live_recompute(websocket: WebSocket):
+    """
+    Live GBD and q-values for one date while the user edits the inputs. The client sends JSON messages
+    with any of selected_date, updated_proportions and packing_density, the server keeps the pipeline
+    state of the connection and answers every update with the recomputed results, rerunning only the
+    stages that depend on the changed inputs.
+
+    Messages arriving while a computation runs are merged and computed together, so a client sending
+    on every keystroke gets the results of its latest inputs without a backlog. Invalid messages are
+    answered with {"type": "error", "detail": ...} and leave the state unchanged.
+    """
+    await websocket.accept()
+    received = []
+    arrived = asyncio.Event()
+
+    async def receive_messages():
+        while True:
+            received.append(await websocket.receive_text())
+            arrived.set()
+
+    receiver = asyncio.create_task(receive_messages())
+    pipeline = None
+    try:
+        while True:
+            waiter = asyncio.create_task(arrived.wait())
+            await asyncio.wait({receiver, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver.done():
+                waiter.cancel()
+                receiver.result()  # Raises WebSocketDisconnect when the client went away
+
+            arrived.clear()
+            messages, received[:] = list(received), []
+
+            update, errors = {}, []
+            for message in messages:
+                try:
+                    message = json.loads(message)
+                    if not isinstance(message, dict):
+                        raise ValueError("expected a JSON object")
+                    update.update(message)
+                except ValueError as e:
+                    errors.append(f"Invalid message: {str(e)}")
+            for error in errors:
+                await websocket.send_json({"type": "error", "detail": error})
+            if not update:
+                continue
+
+            try:
+                pipeline, reply = await asyncio.to_thread(apply_live_update, pipeline, update)
+            except HTTPException as e:
+                reply = {"type": "error", "detail": e.detail}
+            except Exception as e:
+                reply = {"type": "error", "detail": f"Internal Server Error: {str(e)}"}
+            await websocket.send_json(reply)
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
@@ -1,16 +1,12 @@
 import pandas as pd
 import numpy as np
-from datetime import datetime
-from scipy.stats import linregress
-from scipy import interpolate
-import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
+from openpyxl import load_workbook
+from app import kernels
 
 
 # Function to read the excel file 
 
-import pandas as pd
-
 def read_excel_file(file, required_sheets):
     """
     Reads the Excel file and returns the required sheets as DataFrames.
@@ -35,26 +31,99 @@ def read_excel_file(file, required_sheets):
     return sheets
 
 
+def read_excel_file_streaming(file, required_sheets, header=2, drop_columns=('Samples No.',), chunk_size=10000):
+    """
+    Reads the required sheets row by row with openpyxl's read-only mode, keeping only the columns used
+    by the calculations. Gives the same DataFrames as `read_excel_file` (without `drop_columns` and
+    unnamed columns) while the workbook itself is never loaded in memory. Rows are collected into
+    typed DataFrame chunks of `chunk_size` rows, so at most one chunk is held as Python objects.
+
+    Parameters:
+        file (str or file): Path or binary file object of the Excel file.
+        required_sheets (list): List of sheet names to be read.
+        header (int): Row (0-indexed) holding the column names.
+        drop_columns (tuple): Columns that are not kept.
+        chunk_size (int): Rows converted to a DataFrame at a time.
+
+    Returns:
+        dict: Dictionary of DataFrames for each required sheet.
+    """
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        missing_sheets = [sheet for sheet in required_sheets if sheet not in workbook.sheetnames]
+        if missing_sheets:
+            raise ValueError(f"Missing required sheets: {', '.join(missing_sheets)}. Please upload a valid file.")
+
+        sheets = {}
+        for sheet in required_sheets:
+            rows = workbook[sheet].iter_rows(values_only=True)
+            for _ in range(header):
+                next(rows, None)
+            header_values = next(rows, None) or ()
+
+            keep = [i for i, name in enumerate(header_values)
+                    if name is not None and str(name).strip() not in drop_columns]
+            columns, seen = [], {}
+            for i in keep:
+                name = header_values[i]
+                columns.append(name if name not in seen else f"{name}.{seen[name]}")  # Same as pandas for duplicates
+                seen[name] = seen.get(name, 0) + 1
+
+            chunks, data, empty_rows = [], [], []
+            for row in rows:
+                values = [row[i] if i < len(row) else None for i in keep]
+                # Whole numbers are read as integers, like pd.read_excel
+                values = [int(value) if isinstance(value, float) and value.is_integer() else value for value in values]
+
+                # Empty rows are only part of the table when followed by data
+                if all(value is None for value in values):
+                    empty_rows.append(values)
+                    continue
+                data.extend(empty_rows)
+                empty_rows = []
+                data.append(values)
+
+                if len(data) >= chunk_size:
+                    chunks.append(pd.DataFrame(data, columns=columns))
+                    data = []
+
+            if data or not chunks:
+                chunks.append(pd.DataFrame(data, columns=columns))
+            sheets[sheet] = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    finally:
+        workbook.close()
+
+    return sheets
+
+
+# Named columns recognised whatever their case and inner spacing, e.g. 'Sp. Gravity'
+named_columns = ['Sp. gravity', 'Loose Bulk Density (gm/cc)']
+
+
+def standard_column_name(name):
+    """
+    Standardizes a column name the way `clean_data` does: stripped, without "+" symbols, and with the
+    received date, total and `named_columns` spelled one way.
+    """
+    name = str(name).strip().replace("+", "")
+    folded = " ".join(name.split()).lower()
+    if "received" in folded and "date" in folded:
+        return "Received Date"
+    if "total" in folded:
+        return "Total"
+    return next((column for column in named_columns if column.lower() == folded), name)
+
+
 # Function to clean the data
 
 def clean_data(sheets):
     clean_data = {}
 
     for sheet_name, df in sheets.items():
-        df.columns = df.columns.str.strip()
-
         # Standardize column names
-        df.columns = df.columns.astype(str)  # Ensure all column names are strings
-        df.rename(columns=lambda x: x.replace("+", ""), inplace=True)  # Remove "+" symbols if present
-        for col in df.columns:
-            if "Received" in col and "Date" in col:
-                df.rename(columns={col: "Received Date"}, inplace=True)
-                df['Received Date'] = pd.to_datetime(df['Received Date'], format='%d.%m.%y', errors='coerce')
-
-            if "Total" in col or "total" in col:
-                df.rename(columns={col: "Total"}, inplace=True)
-
-        
+        df.columns = [standard_column_name(col) for col in df.columns]
+        if 'Received Date' in df.columns:
+            df['Received Date'] = pd.to_datetime(df['Received Date'], format='%d.%m.%y', errors='coerce')
 
         # Drop 'Samples No.' column if it exists
         if 'Samples No.' in df.columns:
@@ -108,6 +177,8 @@ def get_available_date_range(cleaned_sheets, required_sheets):
 def get_sample_data_for_date(cleaned_sheets, required_sheets, selected_date):
     """
     Finds the exact or nearest past date in each sheet based on user-selected date.
+
+    `selected_date` is a Timestamp (or datetime64), parsed once from the request.
     """
     all_dates = {}
     for sheet_name in required_sheets:
@@ -115,7 +186,7 @@ def get_sample_data_for_date(cleaned_sheets, required_sheets, selected_date):
         all_dates[sheet_name] = pd.to_datetime(dates)
 
     matched_dates = {}
-    selected_date = pd.to_datetime(selected_date, format="%d-%m-%Y", dayfirst=True, errors="coerce")
+    selected_date = pd.Timestamp(selected_date)
 
     for sheet_name, dates in all_dates.items():
         possible_dates = dates[dates <= selected_date]
@@ -139,7 +210,8 @@ def average_samples_per_date(sheets_data):
       sheets_data: A dictionary where keys are sheet names and values are their corresponding DataFrames.
 
     Returns:
-      processed_dataframes: A dictionary where keys are sheet names and values are the processed DataFrames.
+      processed_dataframes: A dictionary where keys are sheet names and values are the processed DataFrames,
+        indexed by 'Received Date' (DatetimeIndex).
     """
 
     processed_dataframes = {}
@@ -155,11 +227,9 @@ def average_samples_per_date(sheets_data):
 
         # Group by 'Received Date' and calculate the average if 'Received Date' exists
         if 'Received Date' in PSD_df_processed.columns:
+            # Keep the dates as a sorted DatetimeIndex, rows without a valid date are dropped by groupby
             avg_samples = PSD_df_processed.groupby('Received Date').mean()
 
-            # Format the date to 'dd.mm.yy'
-            avg_samples.index = avg_samples.index.strftime('%d.%m.%y')
-
             # **Remove columns with all NaN values**
             avg_samples = avg_samples.dropna(axis=1, how="all")
 
@@ -180,7 +250,7 @@ def process_sheets_and_calculate_gbd(processed_dataframes, density_water, receiv
     Args:
     processed_dataframes: Dictionary of DataFrames corresponding to the sheets.
     density_water: Density of water.
-    received_date: If provided, the function uses the specified date or the nearest past date.
+    received_date: Timestamp of the date to use, the nearest past date is used if it has no sample.
     proportions: Dictionary of proportions for each sheet.
 
     Returns:
@@ -189,13 +259,10 @@ def process_sheets_and_calculate_gbd(processed_dataframes, density_water, receiv
 
     total_volume_of_sample = 0  # Initialize total volume of the sample
 
-    # Ensure that received_date is a pandas Timestamp (already passed as string in dd.mm.yy format)
-    received_date = pd.to_datetime(received_date, format='%d.%m.%y', errors='coerce')
+    received_date = pd.Timestamp(received_date)
 
     for sheet_name, df in processed_dataframes.items():
         # Handle received_date or nearest past date
-        df.index = pd.to_datetime(df.index, format='%d.%m.%y', errors='coerce') # Ensure index is Timestamps
-
         if received_date in df.index:
             nearest_date = received_date
         else:
@@ -248,8 +315,6 @@ def calculate_cumulative_weights(sheets_data, excluded_columns):
 
     for sheet_name, df in sheets_data.items():
         # Copy the DataFrame to avoid altering the original
-        df.index = pd.to_datetime(df.index, format='%d.%m.%y', errors='coerce') # Ensure index is Timestamps
-
         df_processed = df.copy()
 
         # Identify numeric columns excluding specific ones
@@ -312,128 +377,170 @@ def Calculate_Sheet_CPFT(cumulative_sheets, target_date, sheet_proportions, d_va
 
     Args:
         cumulative_sheets (dict): A dictionary where keys are sheet names and values are DataFrames.
-        target_date (datetime): The target date for selecting the row.
+        target_date (Timestamp or list): The target date for selecting the row, or a list of target dates.
         sheet_proportions (dict): A dictionary where keys are sheet names and values are proportions (already in decimal form).
         d_values (list): A list of D_value values to be added to the result DataFrame.
 
     Returns:
-        pd.DataFrame: Consolidated DataFrame with weighted values for each sheet and column.
+        pd.DataFrame: Consolidated DataFrame with weighted values for each sheet and column. When a list of
+        target dates is given, the tables of all dates are stacked with a leading 'Date' column.
     """
+    single_date = np.ndim(target_date) == 0
+    target_dates = pd.DatetimeIndex(np.atleast_1d(target_date))
 
-    consolidated_data = []
+    sheet_names, column_names, proportions, blocks = [], [], [], []
 
-    # Loop through each sheet in the cumulative_sheets dictionary
     for sheet_name, sheet_df in cumulative_sheets.items():
-        sheet_df.index = pd.to_datetime(sheet_df.index, format='%d.%m.%y', errors='coerce')
-
-        # print(f"Processing sheet: {sheet_name}")
+        values_df = sheet_df.drop(columns=['Received Date'], errors='ignore')
+        index = values_df.index
 
-        # Print out the first few rows of the index ('Received Date') for inspection
-        # print(f"First few rows in 'Received Date' (index) for sheet {sheet_name}:")
-        # print(sheet_df.index[:5])  # Access the first few values of the index
+        # Exact or nearest past date of every target date
+        order = np.argsort(index.values, kind='stable')
+        positions = np.searchsorted(index.values[order], target_dates.values, side='right') - 1
+        if single_date and positions[0] < 0:
+            continue  # Skip this sheet if no past date is found
 
-        # Ensure that the index (Received Date) is already in datetime64 format, as confirmed
-        # No need to reformat, assuming the index is already datetime64[ns] after initial processing
-
-        # Check if the target_date exists in the index
-        if target_date in sheet_df.index:
-            print(f"Target date {target_date} found in sheet {sheet_name}.")
-            # Select the row for the target date
-            selected_row = sheet_df.loc[target_date]
-        else:
-            print(f"Target date {target_date} not found in sheet {sheet_name}. Searching for the nearest past date.")
-            # Find the nearest past date (before target_date)
-            past_dates = sheet_df[sheet_df.index < target_date]
-
-            # Check if there are any past dates
-            if not past_dates.empty:
-                # Sort the past dates and get the most recent one
-                nearest_past_date = past_dates.index.max()
-                print(f"Nearest past date for target {target_date} is {nearest_past_date}.")
-                # Select the row for the nearest past date
-                selected_row = sheet_df.loc[nearest_past_date]
-            else:
-                print(f"No past dates available for target date {target_date} in sheet {sheet_name}.")
-                continue  # Skip this sheet if no past date is found
+        values = values_df.to_numpy(dtype=float)[order]
+        selected = np.where((positions >= 0)[:, None], values[np.maximum(positions, 0)], np.nan)
 
         # Get the proportion for the current sheet from the dictionary
         sheet_proportion = sheet_proportions.get(sheet_name, 1)  # Default to 1 if proportion is not found
 
-        # Store Sheet Name, Column Name, and the weighted value (Sheet CPFT) in the consolidated data
-        for column in selected_row.index:
-            if column != 'Received Date':  # Skip 'Received Date' column (which is the index now)
-                # Multiply by the proportion
-                sheet_cpft_value = selected_row[column] * sheet_proportion
-                consolidated_data.append({
-                    'Sheet Name': sheet_name,
-                    'Column Name': column,
-                    'Sheet CPFT': sheet_cpft_value,
-                    'sheet_proportion': sheet_proportion
-                })
-
-    # Create a DataFrame from the consolidated data
-    result_df = pd.DataFrame(consolidated_data)
-    
-    # Add D_value column from the d_values list
-    result_df['D_value'] = d_values[:len(result_df)]  # Add the corresponding D_values based on the DataFrame length
- 
-    # Filter out rows where proportion is zero
-    # result_df = result_df[result_df['sheet_proportion'] != 0]
+        sheet_names.extend([sheet_name] * values.shape[1])
+        column_names.extend(values_df.columns)
+        proportions.extend([sheet_proportion] * values.shape[1])
+        blocks.append(selected * sheet_proportion)
+
+    n_dates, n_rows = len(target_dates), len(column_names)
+    sheet_cpft = np.hstack(blocks) if blocks else np.empty((n_dates, 0))
+
+    if len(d_values) < n_rows:
+        raise ValueError(f"Got {len(d_values)} D_values for {n_rows} cumulative columns.")
+
+    result_df = pd.DataFrame({
+        'Sheet Name': np.tile(np.array(sheet_names, dtype=object), n_dates),
+        'Column Name': np.tile(np.array(column_names, dtype=object), n_dates),
+        'Sheet CPFT': sheet_cpft.ravel(),
+        'sheet_proportion': np.tile(np.array(proportions, dtype=float), n_dates),
+        'D_value': np.tile(np.asarray(d_values[:n_rows]), n_dates),
+    })
+
+    if not single_date:
+        result_df.insert(0, 'Date', np.repeat(target_dates.values, n_rows))
 
     return result_df
 
-import pandas as pd
+
+# Particle size range (in microns, inclusive) of the mesh sizes belonging to each sheet,
+# mesh sizes finer than the last range belong to the 220 sheet
+mesh_sheet_ranges = [
+    ('H(7-12)', 1680, 3360),
+    ('H(14-30)', 595, 1410),
+    ('H(36-70)', 210, 420),
+    ('H(80-180)', 105, 177),
+]
+finest_sheet = 'H(220)'
+
+# Rows of the sheet CPFT table that repeat a mesh size already measured on a coarser sheet
+duplicate_mesh_rows = [9, 13, 14, 17]
+
+# Rows used as interpolation anchors by add_columns
+min_mesh_rows = 16
+
+
+class MeshPlan:
+    """
+    Precompiled layout turning the sheet CPFT table (rows in sheet and column order) into the table
+    sorted by particle size with duplicate mesh sizes removed and sheets reassigned by particle size.
+
+    Attributes:
+        gather (np.ndarray): Row positions of the sheet CPFT table, in output order.
+        keep_mask (np.ndarray): False for the duplicate rows that are dropped, in input order.
+        d_values (np.ndarray): Particle size of every output row.
+        sheet_names (np.ndarray): Sheet assigned to every output row.
+    """
+
+    def __init__(self, gather, keep_mask, d_values, sheet_names):
+        self.gather = gather
+        self.keep_mask = keep_mask
+        self.d_values = d_values
+        self.sheet_names = sheet_names
+
+    def __len__(self):
+        return len(self.gather)
+
+
+def assign_sheet_names(d_values):
+    """
+    Assigns a sheet name to every particle size based on `mesh_sheet_ranges`, 'Unknown' when no range matches.
+    """
+    d_values = np.asarray(d_values, dtype=float)
+    conditions = [(d_values >= low) & (d_values <= high) for _, low, high in mesh_sheet_ranges]
+    conditions.append(d_values < mesh_sheet_ranges[-1][1])
+    choices = [sheet_name for sheet_name, _, _ in mesh_sheet_ranges] + [finest_sheet]
+    return np.select(conditions, choices, default='Unknown').astype(object)
+
+
+def compile_mesh_plan(d_values, drop_rows=duplicate_mesh_rows):
+    """
+    Compiles the mesh layout once for a list of particle sizes (one per row of the sheet CPFT table).
+
+    Args:
+        d_values (list): Particle size of every row of the sheet CPFT table.
+        drop_rows (list): Rows repeating a mesh size of another row.
+
+    Returns:
+        MeshPlan: The compiled layout.
+
+    Raises:
+        ValueError: If the layout cannot be used by `rearrange_mess_sizes` and `add_columns`.
+    """
+    d_values = np.asarray(d_values, dtype=float)
+    if np.isnan(d_values).any():
+        raise ValueError("Every mesh column needs a particle size (D_value).")
+
+    out_of_range = [row for row in drop_rows if not 0 <= row < len(d_values)]
+    if out_of_range:
+        raise ValueError(f"Mesh layout has {len(d_values)} rows, duplicate rows {out_of_range} do not exist.")
+
+    keep_mask = np.ones(len(d_values), dtype=bool)
+    keep_mask[list(drop_rows)] = False
+
+    not_duplicates = [row for row in drop_rows if d_values[row] not in d_values[keep_mask]]
+    if not_duplicates:
+        raise ValueError(f"Rows {not_duplicates} of the mesh layout are not duplicate mesh sizes.")
+
+    kept_rows = np.flatnonzero(keep_mask)
+    gather = kept_rows[np.argsort(-d_values[kept_rows], kind='stable')]
+    if len(gather) < min_mesh_rows:
+        raise ValueError(f"Mesh layout has {len(gather)} distinct mesh sizes, at least {min_mesh_rows} are required.")
+
+    return MeshPlan(gather, keep_mask, d_values[gather], assign_sheet_names(d_values[gather]))
+
 
 # Function to update dataframe based on particle size
 
-def rearrange_mess_sizes(df):
+def rearrange_mess_sizes(df, mesh_plan=None):
     """
-    This function adds a 'd_values' column to the DataFrame, sorts the DataFrame by 'D_value',
-    removes duplicates based on specific indices, and rearranges the 'Sheet Name' column
-    based on particle size ranges. Finally, it returns the updated DataFrame.
+    This function sorts the DataFrame by 'D_value', removes the duplicate mesh sizes and reassigns the
+    'Sheet Name' column based on particle size ranges, using a precompiled MeshPlan.
     
     Args:
         df (pd.DataFrame): DataFrame to rearrange.
+        mesh_plan (MeshPlan): Layout compiled with `compile_mesh_plan`, compiled from df['D_value'] if not given.
         
     Returns:
         pd.DataFrame: Updated DataFrame with 'Sheet Name' column rearranged based on particle size.
     """
+    if mesh_plan is None:
+        mesh_plan = compile_mesh_plan(df['D_value'].to_numpy())
 
-    # Step 1: Sort the dataframe by 'D_value'
-    df = df.sort_values(by='D_value', ascending=False)
-
-    # =======Print the dataframe before removing duplicates=======
-    # print("DataFrame before removing duplicates:")
-    # print(df)
-    
-    # Remove duplicates at specific indices (e.g., 9, 13, 14, 17)
-    df = df.drop(index=[9, 13, 14, 17]).reset_index(drop=True)
-
-    # =======Print the dataframe after removing duplicates=======
-    # print("\nDataFrame after removing duplicates:")
-    # print(df)
-
-    # Step 2: Define the function to assign Sheet Name based on 'D_value' (or particle size)
-    def assign_sheet_name(d_value):
-        if 1680 <= d_value <= 3360:
-            return 'H(7-12)'
-        elif 595 <= d_value <= 1410:
-            return 'H(14-30)'
-        elif 210 <= d_value <= 420:
-            return 'H(36-70)'
-        elif 105 <= d_value <= 177:
-            return 'H(80-180)'
-        elif d_value < 105:
-            return 'H(220)'
-        else:
-            return 'Unknown'  # In case d_value is outside expected range
-
-    # Step 3: Apply the function to the 'D_value' column to assign 'Sheet Name'
-    df['Sheet Name'] = df['D_value'].apply(assign_sheet_name)
+    if len(df) != len(mesh_plan.keep_mask):
+        raise ValueError(f"Mesh plan expects {len(mesh_plan.keep_mask)} rows, got {len(df)}.")
 
-    # =======Print the final dataframe for verification=======
-    # print("\nFinal DataFrame after assigning 'Sheet Name' based on 'D_value':")
-    # print(df)
+    # Single gather: sort by particle size and drop the duplicates
+    df = df.iloc[mesh_plan.gather].reset_index(drop=True)
+    df['Sheet Name'] = mesh_plan.sheet_names
 
     return df
 
@@ -458,31 +565,13 @@ def add_columns(df, proportions, sheet_constants, packing_density):
     # Add 'sheet_constant' column based on 'Sheet Name' using the sheet_constants dictionary
     df['sheet_constant'] = df['Sheet Name'].apply(lambda x: sheet_constants.get(x, 0))
 
-    # Initialize previous pct_CPFT to 100 (default value)
-    prev_pct_CPFT = 100
-
-    # Function to calculate pct_CPFT with exceptions
-    def calculate_pct_CPFT(row):
-        nonlocal prev_pct_CPFT
-        
-        # If proportion is 0 and Sheet CPFT is not zero, apply exceptions
-        if row['proportion'] == 0 and row['Sheet CPFT'] != 0:
-            if row['Sheet Name'] == 'H(7/12)':
-                row['pct_CPFT'] = 100
-            else:
-                row['pct_CPFT'] = prev_pct_CPFT
-        else:
-            # Default case: Calculate pct_CPFT as Sheet CPFT + sheet constant
-            row['pct_CPFT'] = row['Sheet CPFT'] + sheet_constants.get(row['Sheet Name'], 0)
-        
-        # Update prev_pct_CPFT if the current pct_CPFT is non-zero
-        if row['pct_CPFT'] != 0:
-            prev_pct_CPFT = row['pct_CPFT']
-        
-        return row
-
-    # Apply the function to calculate 'pct_CPFT'
-    df = df.apply(calculate_pct_CPFT, axis=1)
+    # Rows of zero proportion sheets with a non-zero Sheet CPFT carry the previous non-zero pct_CPFT
+    # (H(7/12) rows restart at 100), run as one kernel instead of a row-wise apply
+    sheet_cpft = df['Sheet CPFT'].to_numpy(dtype=float)
+    carry = (df['proportion'].to_numpy() == 0) & (sheet_cpft != 0)
+    first_sheet = (df['Sheet Name'] == 'H(7/12)').to_numpy()
+    pct_CPFT = np.where(carry & first_sheet, 100.0, sheet_cpft + df['sheet_constant'].to_numpy(dtype=float))
+    df['pct_CPFT'] = kernels.carry_forward(pct_CPFT[None, :], (carry & ~first_sheet)[None, :])[0]
 
     # Create a new column 'pct_CPFT_interpolation' initialized to 'pct_CPFT'
     df['pct_CPFT_interpolation'] = df['pct_CPFT']
@@ -519,8 +608,6 @@ def add_columns(df, proportions, sheet_constants, packing_density):
 
     # Only create and insert new sample if the proportion for 'H(7/12)' is non-zero
     # Only create and insert new sample if the proportion for 'H(7/12)' is non-zero
-    print("For 7/12", proportions.get('H(7/12)', 0))
-    print("For 7-12", proportions.get('H(7-12)', 0))
     if proportions.get('H(7-12)', 0) != 0:
         new_sample = pd.DataFrame({
             'Sheet Name': ['H(7-12)'],
@@ -535,10 +622,8 @@ def add_columns(df, proportions, sheet_constants, packing_density):
             
                 # Proportion for the new sample
         })
-        print(new_sample)
         # Insert the new sample at the beginning (index 0)
         df = pd.concat([new_sample, df], ignore_index=True)
-        print(df)
 
     if packing_density is None:
         packing_density = 0.85
@@ -557,6 +642,136 @@ def add_columns(df, proportions, sheet_constants, packing_density):
     return df_filtered
 
 
+# Rows of the rearranged table interpolated by add_columns, with the rows they are interpolated between
+interpolated_rows = {3: (2, 6), 4: (2, 6), 5: (2, 6), 8: (7, 9), 12: (11, 13), 14: (13, 15)}
+
+
+def add_columns_batch(sheet_cpft, mesh_plan, sheet_proportions, proportions, sheet_constants):
+    """
+    Vectorised `add_columns` for many Sheet CPFT tables sharing one mesh layout, e.g. bootstrap resamples
+    of one date.
+
+    Args:
+        sheet_cpft (np.ndarray): 'Sheet CPFT' of the rearranged tables, shape (B, R).
+        mesh_plan (MeshPlan): Layout of the rearranged tables (D_value and Sheet Name of every row).
+        sheet_proportions (np.ndarray): 'sheet_proportion' of every rearranged row, shape (R,).
+        proportions (dict): Dictionary with sheet names and corresponding proportions.
+        sheet_constants (dict): Dictionary with sheet names and corresponding constants.
+
+    Returns:
+        tuple: (d_values, normalized_d, pct_CPFT_interpolation) of the rows kept by `add_columns`,
+        shapes (R',), (R',) and (B, R').
+    """
+    d_values, normalized_d, interpolation, keep = add_columns_stack(
+        sheet_cpft, mesh_plan, sheet_proportions, proportions, sheet_constants)
+
+    return d_values[keep], normalized_d[keep], interpolation[:, keep]
+
+
+def add_columns_stack(sheet_cpft, mesh_plan, sheet_proportions, proportions, sheet_constants):
+    """
+    `add_columns_batch` without dropping any row: the 3500 row is always first and `keep` tells which
+    rows `add_columns` keeps. Tables of different proportions then share one shape and can be stacked
+    and fitted together with `keep` as mask.
+
+    Returns:
+        tuple: (d_values, normalized_d, pct_CPFT_interpolation, keep), shapes (R + 1,), (R + 1,),
+        (B, R + 1) and (R + 1,).
+    """
+    sheet_cpft = np.atleast_2d(np.asarray(sheet_cpft, dtype=float))
+    d_values = np.asarray(mesh_plan.d_values, dtype=float)
+    sheet_proportions = np.asarray(sheet_proportions, dtype=float)
+    row_proportions = np.array([proportions.get(name, 0) for name in mesh_plan.sheet_names], dtype=float)
+    row_constants = np.array([sheet_constants.get(name, 0) for name in mesh_plan.sheet_names], dtype=float)
+
+    pct_CPFT = sheet_cpft + row_constants
+
+    # Rows of zero proportion sheets with a non-zero Sheet CPFT carry the previous non-zero pct_CPFT
+    carry = (row_proportions == 0) & (sheet_cpft != 0)
+    if carry.any():
+        pct_CPFT = kernels.carry_forward(pct_CPFT, carry)
+
+    interpolation = pct_CPFT.copy()
+    for row, (low, high) in interpolated_rows.items():
+        if row_proportions[row] > 0:
+            interpolation[:, row] = pct_CPFT[:, low] + (d_values[row] - d_values[low]) * (pct_CPFT[:, high] - pct_CPFT[:, low]) / (d_values[high] - d_values[low])
+
+    # The 3500 row is only part of the table (and of its maximum size) when H(7-12) is used
+    first_row = proportions.get('H(7-12)', 0)
+    normalized_d = np.concatenate([[3500], d_values]) / (max(3500, d_values.max()) if first_row != 0 else d_values.max())
+    d_values = np.concatenate([[3500], d_values])
+    keep = np.concatenate([[first_row], sheet_proportions]) != 0
+    interpolation = np.hstack([np.full((len(interpolation), 1), 100.0), interpolation])
+
+    return d_values, normalized_d, interpolation, keep
+
+
+def sheet_constants_grid(proportion_matrix):
+    """
+    `get_sheet_constants_from_proportions` for many proportion vectors, shape (B, S) in sheet order.
+    The remaining proportions are summed left to right as in the original, so the rounding to whole
+    percents is the same.
+    """
+    proportion_matrix = np.atleast_2d(np.asarray(proportion_matrix, dtype=float))
+    constants = np.zeros_like(proportion_matrix)
+    for i in range(proportion_matrix.shape[1] - 1):
+        remaining = proportion_matrix[:, i + 1].copy()
+        for j in range(i + 2, proportion_matrix.shape[1]):
+            remaining += proportion_matrix[:, j]
+        constants[:, i] = np.round(remaining * 100)
+    return constants
+
+
+def add_columns_grid(sheet_cpft, mesh_plan, sheet_proportions, proportion_matrix, sheet_names):
+    """
+    `add_columns_stack` with its own proportion vector for every table instead of one for all, e.g.
+    every blend of a proportion grid for one date.
+
+    Args:
+        sheet_cpft (np.ndarray): 'Sheet CPFT' of the rearranged tables, shape (B, R).
+        mesh_plan (MeshPlan): Layout of the rearranged tables (D_value and Sheet Name of every row).
+        sheet_proportions (np.ndarray): 'sheet_proportion' of every rearranged row of every table, shape (B, R).
+        proportion_matrix (np.ndarray): Proportions of every table, shape (B, S).
+        sheet_names (list): Sheet name of every proportion column, in the order of the proportion dicts.
+
+    Returns:
+        tuple: (d_values, normalized_d, pct_CPFT_interpolation, keep), shapes (R + 1,), (B, R + 1),
+        (B, R + 1) and (B, R + 1).
+    """
+    sheet_cpft = np.atleast_2d(np.asarray(sheet_cpft, dtype=float))
+    proportion_matrix = np.atleast_2d(np.asarray(proportion_matrix, dtype=float))
+    d_values = np.asarray(mesh_plan.d_values, dtype=float)
+
+    # Proportion and sheet constant of the sheet every row is assigned to, 0 for unknown sheets
+    columns = [sheet_names.index(name) if name in sheet_names else None for name in mesh_plan.sheet_names]
+    zeros = np.zeros((len(proportion_matrix), 1))
+    constants = sheet_constants_grid(proportion_matrix)
+    row_proportions = np.hstack([proportion_matrix[:, [c]] if c is not None else zeros for c in columns])
+    row_constants = np.hstack([constants[:, [c]] if c is not None else zeros for c in columns])
+
+    pct_CPFT = sheet_cpft + row_constants
+
+    # Rows of zero proportion sheets with a non-zero Sheet CPFT carry the previous non-zero pct_CPFT
+    carry = (row_proportions == 0) & (sheet_cpft != 0)
+    if carry.any():
+        pct_CPFT = kernels.carry_forward(pct_CPFT, carry)
+
+    interpolation = pct_CPFT.copy()
+    for row, (low, high) in interpolated_rows.items():
+        interpolated = pct_CPFT[:, low] + (d_values[row] - d_values[low]) * (pct_CPFT[:, high] - pct_CPFT[:, low]) / (d_values[high] - d_values[low])
+        interpolation[:, row] = np.where(row_proportions[:, row] > 0, interpolated, pct_CPFT[:, row])
+
+    # The 3500 row is only part of a table (and of its maximum size) when H(7-12) is used
+    first_row = proportion_matrix[:, sheet_names.index('H(7-12)')] if 'H(7-12)' in sheet_names else np.zeros(len(proportion_matrix))
+    d_values = np.concatenate([[3500], d_values])
+    largest = np.where(first_row != 0, max(3500, d_values[1:].max()), d_values[1:].max())
+    normalized_d = d_values[None, :] / largest[:, None]
+    keep = np.hstack([(first_row != 0)[:, None], sheet_proportions != 0])
+    interpolation = np.hstack([np.full((len(interpolation), 1), 100.0), interpolation])
+
+    return d_values, normalized_d, interpolation, keep
+
+
 # Function to predict q value
 
 def q_value_prediction(sorted_df, selected_date):
@@ -566,19 +781,60 @@ def q_value_prediction(sorted_df, selected_date):
     x = sorted_df['Log_D/Dmax_value'].values  # Independent variable (x-axis)
     y = sorted_df['Log_pct_CPFT'].values  # Dependent variable for the regression curve
 
-    # Perform linear regression using scipy
-    slope, intercept, r_value, p_value, std_err = linregress(x, y)
+    # Closed-form least squares, the same routine fits whole stacks of dates
+    slope, intercept, r_squared = linear_fit_batch(x, y)
 
     log_q_values_data.append({
             "Date": selected_date,
-            "q-value": round(slope, 4),
-            "r-squared": round(r_value**2, 4)  # ✅ Added R² value for accuracy check
+            "q-value": round(float(slope[0]), 4),
+            "r-squared": round(float(r_squared[0]), 4)  # ✅ Added R² value for accuracy check
         })
 
 
     return pd.DataFrame(log_q_values_data)
 
 
+def linear_fit_batch(x, y, mask=None):
+    """
+    Closed-form least squares slope, intercept and R² of every row of `y` against `x`, for a whole
+    stack of curves (dates, resamples, proportion vectors) in one set of array operations.
+
+    Points where `x` or `y` is NaN or `mask` is False are left out, so curves with a different number
+    of rows (e.g. zero proportion sheets dropped) can be stacked. Curves with fewer than two points get NaN.
+
+    Args:
+        x (np.ndarray): Independent variable, shape (R,) or (B, R).
+        y (np.ndarray): Dependent variable, shape (B, R).
+        mask (np.ndarray): Points to fit, shape (R,) or (B, R), all points by default.
+
+    Returns:
+        tuple: (slope, intercept, r_squared), arrays of shape (B,).
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+
+    valid = ~(np.isnan(x) | np.isnan(y))
+    if mask is not None:
+        valid &= np.broadcast_to(np.asarray(mask, dtype=bool), y.shape)
+    count = valid.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.where(valid, x, 0).sum(axis=1) / count
+        y_mean = np.where(valid, y, 0).sum(axis=1) / count
+        dx = np.where(valid, x - x_mean[:, None], 0)
+        dy = np.where(valid, y - y_mean[:, None], 0)
+        sxx = (dx ** 2).sum(axis=1)
+        syy = (dy ** 2).sum(axis=1)
+        sxy = (dx * dy).sum(axis=1)
+
+        slope = sxy / sxx
+        intercept = y_mean - slope * x_mean
+        r_squared = sxy ** 2 / (sxx * syy)
+
+    enough = count >= 2
+    return np.where(enough, slope, np.nan), np.where(enough, intercept, np.nan), np.where(enough, r_squared, np.nan)
+
+
 # ======================================================================================================================================================================
 
 # Modified Q values
@@ -601,26 +857,60 @@ def optimize_q(df, D_col, pct_CPFT_col):
     D_values = df[D_col].values
     pct_CPFT = df[pct_CPFT_col].values / 100  # Convert to fractions
 
-    # Define the Modified Andreasen equation
-    def andreasen_eq(D, q, D_min, D_max):
-        return (D**q - D_min**q) / (D_max**q - D_min**q)
-
     # Define D_min and D_max
     D_min = D_values.min()
     D_max = D_values.max()
 
-    # Optimize q for the specified packing density (single column)
+    # Optimize q for the specified packing density (single column), the Modified Andreasen equation
+    # is the compiled kernel when the numba backend is selected. The tolerances are tight so that the
+    # fit reaches the minimum found by `optimize_q_batch` (within ~1e-8, the precision of a minimum of
+    # the flat squared error) and both give the same rounded q-values and MAE
     params, _ = curve_fit(
-        lambda D, q: andreasen_eq(D, q, D_min, D_max),
+        lambda D, q: kernels.andreasen_cpft(D, q, D_min, D_max),
         D_values,
         pct_CPFT,
         bounds=(0.1, [0.5]),
-        p0=[0.3]
+        p0=[0.3],
+        ftol=1e-14, xtol=1e-14, gtol=1e-14
     )
 
     # Return the optimal q-value
     return params[0]
 
+def optimize_q_batch(D_values, pct_CPFT, bounds=(0.1, 0.5), iterations=60, mask=None):
+    """
+    Optimize the Modified Andreasen q-value for many CPFT curves sharing the same particle sizes.
+
+    Golden-section search of the squared error within `bounds` (the bounds of `optimize_q`), run for all
+    curves at once instead of one `curve_fit` per curve.
+
+    Parameters:
+        D_values (np.ndarray): Particle sizes, shape (R,).
+        pct_CPFT (np.ndarray): CPFT in percent (e.g. pct_poros_CPFT), shape (B, R).
+        mask (np.ndarray): Rows of every curve, shape (R,) or (B, R), all rows by default.
+
+    Returns:
+        np.ndarray: Optimal q-value of every curve, shape (B,).
+    """
+    pct_CPFT = np.atleast_2d(np.asarray(pct_CPFT, dtype=float)) / 100  # Convert to fractions
+    D_values, D_min, D_max, valid = masked_sizes(D_values, pct_CPFT.shape, mask)
+
+    return kernels.golden_section_q(np.ascontiguousarray(D_values), D_min[:, 0], D_max[:, 0], np.ascontiguousarray(valid),
+                                    pct_CPFT, float(bounds[0]), float(bounds[1]), iterations)
+
+
+def masked_sizes(D_values, shape, mask=None):
+    """
+    Particle sizes broadcast to `shape` with the smallest and largest size of every curve among its
+    masked rows, shapes (B, R), (B, 1), (B, 1) and the (B, R) mask.
+    """
+    D_values = np.broadcast_to(np.asarray(D_values, dtype=float), shape)
+    valid = np.ones(shape, dtype=bool) if mask is None else np.broadcast_to(np.asarray(mask, dtype=bool), shape)
+    D_min = np.where(valid, D_values, np.inf).min(axis=1, keepdims=True)
+    D_max = np.where(valid, D_values, -np.inf).max(axis=1, keepdims=True)
+    return D_values, D_min, D_max, valid
+
+
 # Function to predict CPFT and error.
 
 def calculate_errors_and_mae(df, D_col, pct_CPFT_col, q):
@@ -637,17 +927,13 @@ def calculate_errors_and_mae(df, D_col, pct_CPFT_col, q):
         DataFrame: Updated DataFrame with predicted CPFT and absolute error.
         float: Mean Absolute Error (MAE) for the specified packing density.
     """
-    # Define the Modified Andreasen equation
-    def calculate_cpft(D, q, D_min, D_max):
-        return (D**q - D_min**q) / (D_max**q - D_min**q)
-
     # Define D_min and D_max
-    D_values = df[D_col].values
+    D_values = df[D_col].to_numpy(dtype=float)
     D_min = D_values.min()
     D_max = D_values.max()
 
-    # Calculate predicted CPFT for the specified q-value
-    df['calculated_CPFT'] = df[D_col].apply(lambda D: calculate_cpft(D, q, D_min, D_max) * 100)
+    # Calculate predicted CPFT for the specified q-value (Modified Andreasen equation, whole column at once)
+    df['calculated_CPFT'] = kernels.andreasen_cpft(D_values, float(q), float(D_min), float(D_max)) * 100
 
     # Calculate absolute error for the specified packing density
     df['absolute_error'] = abs(df[pct_CPFT_col] - df['calculated_CPFT'])
@@ -658,12 +944,34 @@ def calculate_errors_and_mae(df, D_col, pct_CPFT_col, q):
     return df, mae
 
 
+def calculate_mae_batch(D_values, pct_CPFT, q, mask=None):
+    """
+    Mean absolute error of `calculate_errors_and_mae` for many CPFT curves and their q-values.
+
+    Parameters:
+        D_values (np.ndarray): Particle sizes, shape (R,).
+        pct_CPFT (np.ndarray): Actual CPFT in percent (e.g. pct_poros_CPFT), shape (B, R).
+        q (np.ndarray): q-value of every curve, shape (B,).
+        mask (np.ndarray): Rows of every curve, shape (R,) or (B, R), all rows by default.
+
+    Returns:
+        np.ndarray: MAE of every curve, shape (B,).
+    """
+    pct_CPFT = np.atleast_2d(np.asarray(pct_CPFT, dtype=float))
+    D_values, D_min, D_max, valid = masked_sizes(D_values, pct_CPFT.shape, mask)
+    return kernels.mean_absolute_error(np.ascontiguousarray(D_values), D_min[:, 0], D_max[:, 0], np.ascontiguousarray(valid),
+                                       pct_CPFT, np.asarray(q, dtype=float))
+
+
 
 
 # ======================================================================================================================================================================
 
 # Double Modified Q values
 
+# Packing density of the pct_poros_CPFT column used by the Double Modified Andreasen method (add_columns' default)
+double_modified_packing_density = 0.85
+
 
 def calculate_Q_value_and_plot(sorted_df, pct_CPFT_col='pct_poros_CPFT'):
     """
@@ -677,9 +985,8 @@ def calculate_Q_value_and_plot(sorted_df, pct_CPFT_col='pct_poros_CPFT'):
         float: The optimal Q-value.
         DataFrame: Modified DataFrame with additional calculations.
     """
-    # Step 1: Create the modified DataFrame with the necessary columns
-    double_modified_df = sorted_df[['Sheet Name', 'Column Name', pct_CPFT_col, 'D_value']]
-  
+    # Step 1: Create the modified DataFrame with the necessary columns (a copy, sorted_df is not modified)
+    double_modified_df = sorted_df[['Sheet Name', 'Column Name', pct_CPFT_col, 'D_value']].copy()
 
 
     # Step 2: Calculate Dmin and Dmax
@@ -687,7 +994,7 @@ def calculate_Q_value_and_plot(sorted_df, pct_CPFT_col='pct_poros_CPFT'):
     D_max = double_modified_df['D_value'].max()
 
     # Step 3: Remove the last row
-    double_modified_df = double_modified_df.iloc[:-1]
+    double_modified_df = double_modified_df.iloc[:-1].copy()
 
     # Step 4: Calculate log(pct_CPFT)
     double_modified_df['log_pct_CPFT'] = np.log(double_modified_df[pct_CPFT_col])
@@ -700,10 +1007,10 @@ def calculate_Q_value_and_plot(sorted_df, pct_CPFT_col='pct_poros_CPFT'):
     x = double_modified_df['x_value']
 
     # Step 7: Perform linear regression
-    slope, intercept, _, _, _ = linregress(x, y)
+    slope, intercept, _ = linear_fit_batch(x.to_numpy(), y.to_numpy())
 
     # The Q-value is the slope of the regression line
-    Q_value = slope
+    Q_value = float(slope[0])
 
     # # Print the result
     # print(f"The optimal Q-value using the Modified Andreasen Equation is: {Q_value}")
@@ -729,5 +1036,103 @@ def calculate_Q_value_and_plot(sorted_df, pct_CPFT_col='pct_poros_CPFT'):
     return Q_value, double_modified_df
 
 
+def double_modified_q_batch(D_values, pct_CPFT, mask=None):
+    """
+    Double Modified Andreasen q-value of `calculate_Q_value_and_plot` for many CPFT curves sharing the
+    same particle sizes (sorted by decreasing size, as in the sorted table).
+
+    Parameters:
+        D_values (np.ndarray): Particle sizes, shape (R,).
+        pct_CPFT (np.ndarray): CPFT in percent (e.g. pct_poros_CPFT), shape (B, R).
+        mask (np.ndarray): Rows of every curve, shape (R,) or (B, R), all rows by default.
+
+    Returns:
+        np.ndarray: Q-value of every curve, shape (B,).
+    """
+    pct_CPFT = np.atleast_2d(np.asarray(pct_CPFT, dtype=float))
+    D_values, D_min, D_max, valid = masked_sizes(D_values, pct_CPFT.shape, mask)
+
+    # The last row (smallest size) is left out, as in calculate_Q_value_and_plot
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.log(D_values - D_min) - np.log(D_max - D_min)
+        y = np.log(pct_CPFT)
+    slope, _, _ = linear_fit_batch(x, y, valid & (D_values > D_min))
+
+    return slope
+
+
+# ======================================================================================================================================================================
+
+# All methods for many dates and proportion vectors at once
+
+def fit_q_values_batch(cube, rows, proportion_dicts, packing_density):
+    """
+    Andreasen, Modified Andreasen and Double Modified Andreasen q-values for every combination of
+    proportion vector and date. The tables of all combinations are stacked with the rows dropped by
+    `add_columns` masked, and every method is fitted in one vector pass instead of one `run_all_methods`
+    per date and vector.
+
+    Args:
+        cube (SieveCube): Averaged samples of a workbook.
+        rows (np.ndarray): Row numbers from `rows_for`, shape (N, S).
+        proportion_dicts (list): K proportion dicts keyed by sheet name.
+        packing_density (float): Packing density used for the Modified Andreasen method.
 
+    Returns:
+        dict: Unrounded arrays of shape (K, N) for q_value, r_squared, modified_q, mae and double_modified_q.
+    """
+    normalized, pct_CPFT, keep = [], [], []
+    for proportions_dict in proportion_dicts:
+        sheet_cpft, sheet_proportions = cube.cpft_rows(rows, proportions_dict)
+        D_values, normalized_d, interpolation, kept = add_columns_stack(
+            sheet_cpft, cube.mesh_plan, sheet_proportions, proportions_dict,
+            get_sheet_constants_from_proportions(proportions_dict))
+        normalized.append(np.broadcast_to(normalized_d, interpolation.shape))
+        pct_CPFT.append(interpolation)
+        keep.append(np.broadcast_to(kept, interpolation.shape))
+
+    normalized, pct_CPFT, keep = np.vstack(normalized), np.vstack(pct_CPFT), np.vstack(keep)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        q_value, _, r_squared = linear_fit_batch(np.log(normalized), np.log(pct_CPFT), keep)
+        modified_q = optimize_q_batch(D_values, pct_CPFT * packing_density, mask=keep)
+        mae = calculate_mae_batch(D_values, pct_CPFT * packing_density, modified_q, mask=keep)
+        double_modified_q = double_modified_q_batch(D_values, pct_CPFT * double_modified_packing_density, mask=keep)
+
+    shape = (len(proportion_dicts), len(rows))
+    return {"q_value": q_value.reshape(shape), "r_squared": r_squared.reshape(shape), "modified_q": modified_q.reshape(shape),
+            "mae": mae.reshape(shape), "double_modified_q": double_modified_q.reshape(shape)}
+
+
+def summarize_dates_batch(cube, dates, proportions_dict, packing_density):
+    """
+    Summary rows of `summarize_all_methods` for many dates, computed in one vector pass with
+    `fit_q_values_batch` (without the intermediate tables). Dates that cannot be computed get an error
+    row, as in `iter_range_results`.
+    """
+    computable = ~np.isnat(cube.input_dates(dates)).any(axis=1)
+    if computable.any():
+        rows = cube.rows_for(dates[computable])
+        total_volume, density = cube.gbd(rows, proportions_dict)
+        fits = {name: values[0] for name, values in fit_q_values_batch(cube, rows, [proportions_dict], packing_density).items()}
+
+    summaries = []
+    for target_date, is_computable, index in zip(dates, computable, np.cumsum(computable) - 1):
+        row = {"Date": target_date.strftime("%d-%m-%Y")}
+        if not is_computable:
+            try:
+                cube.rows_for(target_date)
+            except ValueError as e:
+                row["error"] = str(e)
+            summaries.append(row)
+            continue
+
+        values = {"total_volume": total_volume[index], "specific_gravity": density[index],
+                  "gbd": density[index] * packing_density, **{name: fit[index] for name, fit in fits.items()}}
+        if not np.isfinite(list(values.values())).all():
+            row["error"] = "The q-values could not be fitted for this date."
+        else:
+            row.update({name: round(float(values[name]), 4) for name in
+                        ("total_volume", "specific_gravity", "gbd", "q_value", "r_squared", "modified_q", "mae", "double_modified_q")})
+        summaries.append(row)
 
+    return summaries
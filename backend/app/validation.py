@@ -0,0 +1,210 @@
+import posixpath
+import re
+from xml.etree.ElementTree import iterparse, ParseError
+from zipfile import ZipFile, BadZipFile
+
+from app.updated_model import standard_column_name
+
+
+# Mesh columns are sieve sizes such as '+16' or '30' (once standardized, without the "+"), and the pan
+mesh_pattern = re.compile(r"^\d+(\.\d+)?$")
+
+OFFICE_DOCUMENT = "/officeDocument"
+
+
+def local_name(tag):
+    # Tags without their namespace, so transitional and strict OOXML files read the same
+    return tag.rsplit("}", 1)[-1]
+
+
+def is_mesh_column(name):
+    return bool(mesh_pattern.match(name)) or name.lower() == "pan"
+
+
+def is_named_column(name, excluded_columns):
+    return name in ("Samples No.", "Received Date") or name in excluded_columns
+
+
+def read_relationships(archive, part):
+    """
+    Targets of the relationships of a part, by ID, as paths inside the archive.
+    """
+    folder, name = posixpath.split(part)
+    rels_path = posixpath.join(folder, "_rels", f"{name}.rels")
+    targets = {}
+    with archive.open(rels_path) as file:
+        for _, element in iterparse(file):
+            if local_name(element.tag) == "Relationship":
+                target = element.get("Target")
+                target = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(folder, target))
+                targets[element.get("Id")] = (element.get("Type", ""), target)
+    return targets
+
+
+def read_header_row(archive, sheet_part, row_number):
+    """
+    Cells of one row of a sheet as (column letters, type, raw value), the sheet XML is parsed only up
+    to that row.
+    """
+    cells, row_index = [], 0
+    with archive.open(sheet_part) as file:
+        for _, element in iterparse(file):
+            tag = local_name(element.tag)
+            if tag != "row":
+                continue
+
+            row_index = int(element.get("r", row_index + 1))
+            if row_index == row_number:
+                for cell in element:
+                    if local_name(cell.tag) != "c":
+                        continue
+                    kind = cell.get("t", "n")
+                    if kind == "inlineStr":
+                        value = "".join(t.text or "" for t in cell.iter() if local_name(t.tag) == "t")
+                    else:
+                        value = next((v.text for v in cell if local_name(v.tag) == "v"), None)
+                    cells.append((kind, value))
+            element.clear()
+            if row_index >= row_number:
+                break
+    return cells
+
+
+def read_shared_strings(archive, part, indices):
+    """
+    Shared strings at the given indices, the table is parsed only up to the largest one.
+    """
+    strings, last = {}, max(indices, default=-1)
+    if part is None or last < 0:
+        return strings
+
+    index = 0
+    with archive.open(part) as file:
+        for _, element in iterparse(file):
+            if local_name(element.tag) != "si":
+                continue
+            if index in indices:
+                strings[index] = "".join(t.text or "" for t in element.iter() if local_name(t.tag) == "t")
+            element.clear()
+            index += 1
+            if index > last:
+                break
+    return strings
+
+
+def read_headers(file, sheet_names, header=2):
+    """
+    Column names of the header row of every sheet, read from the workbook package without loading the
+    sheets (openpyxl's read-only mode still scans whole sheets when they have no dimension record).
+
+    Returns:
+        tuple: (sheet names of the workbook, {sheet name: column names} for the requested sheets present).
+    """
+    with ZipFile(file) as archive:
+        root_rels = read_relationships(archive, "")
+        workbook_part = next(target for kind, target in root_rels.values() if kind.endswith(OFFICE_DOCUMENT))
+        workbook_rels = read_relationships(archive, workbook_part)
+
+        sheet_parts = {}
+        with archive.open(workbook_part) as workbook_file:
+            for _, element in iterparse(workbook_file):
+                if local_name(element.tag) == "sheet":
+                    rel_id = next(value for key, value in element.attrib.items() if local_name(key) == "id")
+                    sheet_parts[element.get("name")] = workbook_rels[rel_id][1]
+
+        rows = {sheet: read_header_row(archive, sheet_parts[sheet], header + 1)
+                for sheet in sheet_names if sheet in sheet_parts}
+
+        shared_part = next((target for kind, target in workbook_rels.values() if kind.endswith("/sharedStrings")), None)
+        shared_indices = {int(value) for cells in rows.values() for kind, value in cells if kind == "s" and value is not None}
+        shared = read_shared_strings(archive, shared_part, shared_indices)
+
+    headers = {}
+    for sheet, cells in rows.items():
+        names = []
+        for kind, value in cells:
+            if value is None:
+                continue
+            if kind == "s":
+                value = shared[int(value)]
+            elif kind == "n":
+                number = float(value)
+                value = str(int(number)) if number.is_integer() else str(number)
+            value = value.strip()
+            if value:
+                names.append(value)
+        headers[sheet] = names
+
+    return list(sheet_parts), headers
+
+
+def validate_workbook(file, required_sheets, mesh_plan, excluded_columns, header=2):
+    """
+    Checks the layout of a workbook from its metadata and header rows only, before any full parse.
+    Column names are standardized like `clean_data` does, and only what the parser cannot load is a
+    problem: missing sheets, a sheet without a received date column, or mesh columns whose cumulative
+    columns cannot line up with the mesh layout. Reading stops at the header row of every sheet, so bad
+    files are rejected in milliseconds whatever their size.
+
+    Mesh columns are the columns left once the named ones are set aside. Sieve sizes and the pan surely
+    are, other names only when they hold numbers, which the header row does not tell, so the layout is
+    a problem only when neither count lines up.
+
+    Args:
+        file (str or file): Path or binary file object of the Excel file, rewound afterwards.
+        required_sheets (list): Sheets that must be present.
+        mesh_plan (MeshPlan): Layout compiled with `compile_mesh_plan` from the particle sizes of the
+            cumulative columns of all sheets.
+        excluded_columns (list): Non mesh columns (Total, Loose Bulk Density, Sp. gravity).
+        header (int): Row (0-indexed) holding the column names.
+
+    Returns:
+        tuple: (problems, warnings), problems are empty when the workbook can be parsed, warnings list
+            the 'Total' and 'Sp. gravity' columns missing, whose calculations will be empty.
+    """
+    try:
+        sheet_names, headers = read_headers(file, required_sheets, header)
+    except (BadZipFile, ParseError, KeyError, StopIteration, ValueError):
+        return ["The file is not a valid .xlsx workbook."], []
+    finally:
+        if hasattr(file, "seek"):
+            file.seek(0)
+
+    problems, warnings = [], []
+    missing_sheets = [sheet for sheet in required_sheets if sheet not in sheet_names]
+    if missing_sheets:
+        problems.append(f"Missing required sheets: {', '.join(missing_sheets)}.")
+
+    mesh, others = {}, {}
+    for sheet in required_sheets:
+        if sheet in missing_sheets:
+            continue
+
+        names = [standard_column_name(name) for name in headers[sheet]]
+        if not names:
+            problems.append(f"Sheet '{sheet}': no column names in row {header + 1}.")
+            continue
+
+        if "Received Date" not in names:
+            problems.append(f"Sheet '{sheet}': missing column 'Received Date' in row {header + 1}.")
+        for column in ("Total", "Sp. gravity"):
+            if column not in names:
+                warnings.append(f"Sheet '{sheet}': missing column '{column}' in row {header + 1}.")
+
+        unnamed = [name for name in names if not is_named_column(name, excluded_columns)]
+        mesh[sheet] = [name for name in unnamed if is_mesh_column(name)]
+        others[sheet] = [name for name in unnamed if not is_mesh_column(name)]
+
+    # The cumulative columns of all sheets (one less than the mesh columns of each) line up with the
+    # rows of the mesh layout
+    expected = len(mesh_plan.keep_mask)
+    fewest = sum(max(len(mesh[sheet]) - 1, 0) for sheet in mesh)
+    most = sum(max(len(mesh[sheet]) + len(others[sheet]) - 1, 0) for sheet in mesh)
+    if not problems and not fewest <= expected <= most:
+        found = "; ".join(f"'{sheet}': {mesh[sheet] + others[sheet]}" for sheet in mesh)
+        problems.append(
+            f"Expected {expected} cumulative mesh columns over all sheets (every mesh column but the pan), "
+            f"found {fewest if expected < fewest else most}. Mesh columns found: {found}."
+        )
+
+    return problems, warnings
@@ -0,0 +1,79 @@
+"""
+Peak RSS of ingesting a workbook, for the in-memory path (whole file read into memory and parsed with
+pd.read_excel) and the streaming path used by /upload/ (file read from disk row by row, raw bytes
+not kept).
+
+Every measurement runs in a fresh process so that peaks do not carry over. Run from backend/:
+
+    python benchmarks/ingest_memory.py --days 365 1825 3650
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def ingest(path, method):
+    """
+    Ingests the workbook like /upload/ and prints the peak RSS before and after, and the size of the
+    data kept afterwards.
+    """
+    from io import BytesIO
+    from app.sieve_cube import SieveCube
+    from app.updated_main import required_sheets, d_values, excluded_columns
+    from app.updated_model import read_excel_file, read_excel_file_streaming, clean_data
+
+    baseline = peak_rss_mb()
+    if method == "in-memory":
+        with open(path, "rb") as file:
+            contents = BytesIO(file.read())
+        cleaned_sheets = clean_data(read_excel_file(contents, required_sheets))
+    else:
+        with open(path, "rb") as file:
+            cleaned_sheets = clean_data(read_excel_file_streaming(file, required_sheets))
+        contents = None
+    cube = SieveCube.from_sheets(cleaned_sheets, d_values, excluded_columns)
+
+    retained = sum(df.memory_usage(deep=True).sum() for df in cleaned_sheets.values())
+    retained += cube.fractions.nbytes + cube.cumulative.nbytes + sum(array.nbytes for replicate in cube.replicates for array in replicate)
+    if contents is not None:
+        retained += contents.getbuffer().nbytes
+    print(f"{baseline:.1f} {peak_rss_mb():.1f} {retained / 2 ** 20:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, nargs="+", default=[365, 1825])
+    parser.add_argument("--samples-per-day", type=int, default=2)
+    args = parser.parse_args()
+
+    from benchmarks.synthetic_workbook import write_workbook
+
+    print(f"{'days':>6} {'file MB':>8} {'method':>10} {'peak RSS MB':>12} {'ingest MB':>10} {'retained MB':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for days in args.days:
+            path = os.path.join(directory, f"workbook_{days}.xlsx")
+            write_workbook(path, days, args.samples_per_day)
+            file_mb = os.path.getsize(path) / 2 ** 20
+
+            for method in ("in-memory", "streaming"):
+                output = subprocess.run([sys.executable, __file__, "--ingest", path, method],
+                                        capture_output=True, text=True, check=True).stdout.split()
+                baseline, peak, retained = map(float, output[-3:])
+                print(f"{days:>6} {file_mb:>8.1f} {method:>10} {peak:>12.1f} {peak - baseline:>10.1f} {retained:>12.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--ingest":
+        ingest(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,160 @@
+"""
+Parity and speed of the kernel backends (app/kernels.py): the NumPy kernels and the numba compiled
+kernels selected with KERNEL_BACKEND.
+
+The parity check runs every kernel on random inputs, then the batch fits over all dates of a synthetic
+workbook, a bootstrap and the single-date pipeline, with both backends, and fails (exit code 1) when
+they differ by more than the tolerance (the sums are accumulated in a different order, so the search
+steps on nearly flat errors can end a few 1e-8 apart, far below the 4 decimals reported). The benchmark then times the same workloads with every
+backend, after one warm-up run so that JIT compilation is not counted. Run from backend/:
+
+    python benchmarks/kernel_backends.py --days 1825 --resamples 20000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import kernels
+
+
+def random_kernel_inputs(rng, curves=2000, rows=24):
+    D = np.broadcast_to(np.sort(rng.uniform(40, 3500, rows))[::-1], (curves, rows)).copy()
+    valid = rng.random((curves, rows)) > 0.2
+    D_min = np.where(valid, D, np.inf).min(axis=1)
+    D_max = np.where(valid, D, -np.inf).max(axis=1)
+    pct_CPFT = np.sort(rng.uniform(1, 100, (curves, rows)), axis=1)[:, ::-1].copy()
+    carry = rng.random((curves, rows)) > 0.7
+    pct_CPFT[rng.random((curves, rows)) > 0.8] = 0
+    return D, D_min, D_max, valid, pct_CPFT, carry
+
+
+def run_kernels(inputs):
+    D, D_min, D_max, valid, pct_CPFT, carry = inputs
+    q = kernels.golden_section_q(D, D_min, D_max, valid, pct_CPFT / 100, 0.1, 0.5, 60)
+    return {
+        "andreasen_cpft": kernels.andreasen_cpft(D, 0.3, D_min[:, None], D_max[:, None]),
+        "golden_section_q": q,
+        "mean_absolute_error": kernels.mean_absolute_error(D, D_min, D_max, valid, pct_CPFT, q),
+        "carry_forward": kernels.carry_forward(pct_CPFT.copy(), carry),
+    }
+
+
+def run_batch(cube, proportion_dicts, packing_density):
+    from app.updated_model import fit_q_values_batch
+    rows = cube.rows_for(cube.dates[~np.isnat(cube.input_dates(cube.dates)).any(axis=1)])
+    return fit_q_values_batch(cube, rows, proportion_dicts, packing_density)
+
+
+def run_bootstrap(cube, proportions_dict, packing_density, resamples):
+    from app.bootstrap import bootstrap_confidence_intervals
+    rows = cube.rows_for(cube.dates[-1])[0]
+    return bootstrap_confidence_intervals(cube, rows, proportions_dict, packing_density, n_resamples=resamples, seed=0)
+
+
+def run_single_dates(cube, proportions_dict, packing_density, dates):
+    from app.updated_main import run_all_methods
+    results = []
+    for target_date in dates:
+        result = run_all_methods(cube, target_date, proportions_dict, packing_density)
+        results.append([result["modified_q"], result["mae"], *result["sorted_df"]["pct_CPFT"].to_numpy()])
+    return np.array(results)
+
+
+def max_difference(a, b):
+    if isinstance(a, dict):
+        return max(max_difference(a[key], b[key]) for key in a)
+    if isinstance(a, (int, str)):
+        return 0.0 if a == b else np.inf
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    both_nan = np.isnan(a) & np.isnan(b)
+    return float(np.where(both_nan, 0, np.abs(a - b)).max(initial=0))
+
+
+def timed(func, repeat):
+    func()  # Warm-up (JIT compilation, caches)
+    best = np.inf
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=730)
+    parser.add_argument("--samples-per-day", type=int, default=4)
+    parser.add_argument("--resamples", type=int, default=10000)
+    parser.add_argument("--single-dates", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    from app.sieve_cube import SieveCube
+    from app.updated_main import required_sheets, updated_sheets, d_values, excluded_columns, default_proportions, default_packing_density
+    from app.updated_model import read_excel_file_streaming, clean_data
+    from benchmarks.synthetic_workbook import write_workbook
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "workbook.xlsx")
+        write_workbook(path, args.days, args.samples_per_day)
+        with open(path, "rb") as file:
+            cube = SieveCube.from_sheets(clean_data(read_excel_file_streaming(file, required_sheets)), d_values, excluded_columns)
+
+    proportions_dict = dict(zip(updated_sheets, default_proportions))
+    # Sensitivity-like stack of vectors, the zero proportions exercise the carry-forward
+    rng = np.random.default_rng(0)
+    vectors = [default_proportions, [0.0, 0.4, 0.2, 0.2, 0.2], [0.5, 0.0, 0.3, 0.0, 0.2]]
+    vectors += [list(vector / vector.sum()) for vector in rng.random((8, len(updated_sheets)))]
+    proportion_dicts = [dict(zip(updated_sheets, vector)) for vector in vectors]
+    single_dates = pd.to_datetime(cube.dates[-args.single_dates:])
+    kernel_inputs = random_kernel_inputs(rng)
+
+    workloads = {
+        "kernels (2000 curves)": lambda: run_kernels(kernel_inputs),
+        f"batch fit ({len(proportion_dicts)} vectors x {len(cube.dates)} dates)":
+            lambda: run_batch(cube, proportion_dicts, default_packing_density),
+        f"bootstrap ({args.resamples} resamples)":
+            lambda: run_bootstrap(cube, proportions_dict, default_packing_density, args.resamples),
+        f"single dates ({len(single_dates)})":
+            lambda: run_single_dates(cube, proportions_dict, default_packing_density, single_dates),
+    }
+
+    backends = kernels.available_backends()
+    print(f"Kernel backends available: {', '.join(backends)}")
+
+    failed = False
+    if len(backends) > 1:
+        print(f"\n{'parity':<45} {'max difference':>15}")
+        for name, workload in workloads.items():
+            results = {}
+            for backend in backends:
+                kernels.use_backend(backend)
+                results[backend] = workload()
+            difference = max_difference(results["numpy"], results["numba"])
+            failed |= not difference <= args.tolerance
+            print(f"{name:<45} {difference:>15.3g}{'' if difference <= args.tolerance else '  FAILED'}")
+    else:
+        print("numba is not installed, only the NumPy backend is timed.")
+
+    print(f"\n{'workload':<45}" + "".join(f"{backend + ' s':>12}" for backend in backends) + (f"{'speed-up':>10}" if len(backends) > 1 else ""))
+    for name, workload in workloads.items():
+        seconds = []
+        for backend in backends:
+            kernels.use_backend(backend)
+            seconds.append(timed(workload, args.repeat))
+        speed_up = f"{seconds[0] / seconds[-1]:>9.1f}x" if len(backends) > 1 else ""
+        print(f"{name:<45}" + "".join(f"{value:>12.4f}" for value in seconds) + speed_up)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
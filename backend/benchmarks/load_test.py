@@ -0,0 +1,300 @@
+"""
+End-to-end load test of the dashboard endpoints against a local server.
+
+Starts the app with uvicorn on a free port (with its own empty result store), uploads a synthetic
+workbook through /upload/, waits for the history precomputation to finish, then replays a mix of
+/get_sample_data/, /calculate_gbd/ and the three q endpoints from closed-loop clients at increasing
+concurrency. Every level reports the throughput and the p50/p95/p99 latency per endpoint, and the run
+fails (exit code 1) when a latency budget or the error rate is exceeded at any level. Dates and
+proportions are drawn from the whole workbook and a pool of blends, so the mix has both result store
+hits and fresh computations. Run from backend/:
+
+    python benchmarks/load_test.py --concurrency 1 4 16 32 --duration 20 --budget calculate_q_value:p95=300
+
+Use --url to load an already running server instead (the workbook is still uploaded).
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+import pandas as pd
+
+backend_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, backend_directory)
+
+# Relative weight of every endpoint in the replayed traffic, like a dashboard user picking a date and
+# then looking at the GBD and the q-values
+endpoint_mix = {
+    "get_sample_data": 2,
+    "calculate_gbd": 3,
+    "calculate_q_value": 2,
+    "calculate_q_value_modified_andreason": 2,
+    "calculate_q_value_double_modified": 2,
+}
+
+# Latency budgets in milliseconds, per endpoint ("all" for every endpoint) and percentile
+default_budgets = {
+    ("all", "p95"): 1000.0,
+    ("all", "p99"): 2500.0,
+}
+
+percentiles = {"p50": 50, "p95": 95, "p99": 99}
+
+# Default proportions of the backend (not imported, importing the app would open a result store here)
+default_proportions = [0.35, 0.2, 0.15, 0.1, 0.2]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, directory, workers):
+    """
+    Starts uvicorn in a child process, the result store lives in `directory` so every run starts cold.
+    The server output goes to a log file next to it.
+    """
+    env = {**os.environ, "RESULT_STORE_PATH": os.path.join(directory, "results.sqlite3")}
+    command = [sys.executable, "-m", "uvicorn", "app.updated_main:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning"]
+    with open(os.path.join(directory, "server.log"), "w") as log:
+        return subprocess.Popen(command, cwd=backend_directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_until_alive(url, server=None, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"The server exited with code {server.returncode}")
+        try:
+            if httpx.get(f"{url}/ping", timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"The server did not answer /ping within {timeout} seconds")
+
+
+def upload_workbook(url, path):
+    """
+    Uploads the workbook and waits for its history precomputation, so that it does not compete with
+    the first concurrency level.
+
+    Returns:
+        list: Dates of the workbook as dd-mm-yyyy.
+    """
+    with open(path, "rb") as file:
+        response = httpx.post(f"{url}/upload/", files={"file": ("workbook.xlsx", file)}, timeout=600)
+    response.raise_for_status()
+    upload = response.json()
+
+    job_id = upload.get("history_job_id")
+    while job_id is not None:
+        status = httpx.get(f"{url}/jobs/{job_id}", timeout=10).json()["status"]
+        if status not in ("queued", "running"):
+            break
+        time.sleep(0.5)
+
+    return list(pd.date_range(*upload["date_range"]).strftime("%d-%m-%Y"))
+
+
+def request_plan(dates, blends, seed):
+    """
+    Endless stream of (endpoint, query parameters) drawn from the endpoint mix.
+    """
+    rng = np.random.default_rng(seed)
+    names = list(endpoint_mix)
+    weights = np.array(list(endpoint_mix.values()), dtype=float)
+    weights /= weights.sum()
+
+    while True:
+        name = names[rng.choice(len(names), p=weights)]
+        params = {"selected_date": dates[rng.integers(len(dates))]}
+        if name != "get_sample_data":
+            params["updated_proportions"] = blends[rng.integers(len(blends))]
+        if name in ("calculate_gbd", "calculate_q_value_modified_andreason"):
+            params["packing_density"] = str(rng.choice([0.7, 0.75, 0.8, 0.85]))
+        yield name, params
+
+
+def proportion_blends(count, seed):
+    """
+    Blends around the default proportions, as comma separated strings summing up to 1.
+    """
+    rng = np.random.default_rng(seed)
+    blends = [",".join(str(value) for value in default_proportions)]
+    for _ in range(count - 1):
+        vector = np.round(rng.dirichlet(np.array(default_proportions) * 40), 3)
+        vector[-1] = round(1 - vector[:-1].sum(), 3)
+        blends.append(",".join(str(value) for value in vector))
+    return blends
+
+
+async def run_level(url, concurrency, duration, plan, timeout):
+    """
+    Runs `concurrency` clients sending their next request as soon as the previous one is answered,
+    for `duration` seconds.
+
+    Returns:
+        tuple: (list of (endpoint, status code, seconds), elapsed seconds).
+    """
+    samples = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout) as client:
+        deadline = time.perf_counter() + duration
+
+        async def user():
+            while time.perf_counter() < deadline:
+                name, params = next(plan)
+                started = time.perf_counter()
+                try:
+                    status = (await client.get(f"/{name}/", params=params)).status_code
+                except httpx.HTTPError:
+                    status = 0
+                samples.append((name, status, time.perf_counter() - started))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return samples, elapsed
+
+
+def summarize(samples, elapsed):
+    """
+    Requests, errors (non-2xx answers and failed connections), throughput and latency percentiles in
+    milliseconds per endpoint, and for "all" endpoints together.
+    """
+    groups = {"all": samples}
+    for name in endpoint_mix:
+        groups[name] = [sample for sample in samples if sample[0] == name]
+
+    summary = {}
+    for name, group in groups.items():
+        if not group:
+            continue
+        latencies = np.array([seconds for _, _, seconds in group]) * 1000
+        summary[name] = {
+            "requests": len(group),
+            "errors": sum(not 200 <= status < 300 for _, status, _ in group),
+            "throughput": len(group) / elapsed,
+            **{label: float(np.percentile(latencies, value)) for label, value in percentiles.items()},
+        }
+    return summary
+
+
+def budget_violations(summary, budgets, max_error_rate):
+    violations = []
+    for (name, label), limit in budgets.items():
+        for endpoint in (endpoint_mix if name == "all" else [name]):
+            if endpoint in summary and summary[endpoint][label] > limit:
+                violations.append(f"{endpoint} {label} {summary[endpoint][label]:.1f} ms > {limit:.0f} ms")
+    error_rate = summary["all"]["errors"] / summary["all"]["requests"]
+    if error_rate > max_error_rate:
+        violations.append(f"error rate {error_rate:.2%} > {max_error_rate:.2%}")
+    return violations
+
+
+def parse_budget(text):
+    """
+    Budget given as ENDPOINT:PERCENTILE=MILLISECONDS, e.g. calculate_gbd:p95=200 or all:p99=2000.
+    """
+    try:
+        target, limit = text.split("=")
+        name, label = target.split(":")
+        limit = float(limit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid budget '{text}', expected ENDPOINT:PERCENTILE=MILLISECONDS.")
+    if name != "all" and name not in endpoint_mix:
+        raise argparse.ArgumentTypeError(f"Unknown endpoint '{name}', expected 'all' or one of {', '.join(endpoint_mix)}.")
+    if label not in percentiles:
+        raise argparse.ArgumentTypeError(f"Unknown percentile '{label}', expected one of {', '.join(percentiles)}.")
+    return (name, label), limit
+
+
+def print_level(concurrency, summary, violations):
+    print(f"\nconcurrency {concurrency}")
+    print(f"{'endpoint':<40} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, row in summary.items():
+        print(f"{name:<40} {row['requests']:>9} {row['errors']:>7} {row['throughput']:>8.1f} "
+              f"{row['p50']:>9.1f} {row['p95']:>9.1f} {row['p99']:>9.1f}")
+    for violation in violations:
+        print(f"  OVER BUDGET: {violation}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Load an already running server instead of starting one")
+    parser.add_argument("--server-workers", type=int, default=1, help="uvicorn worker processes of the started server")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--samples-per-day", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--duration", type=float, default=15, help="Seconds per concurrency level")
+    parser.add_argument("--warm-up", type=float, default=3, help="Seconds of single-client traffic before the levels, not counted")
+    parser.add_argument("--blends", type=int, default=20, help="Distinct proportion blends in the traffic")
+    parser.add_argument("--budget", type=parse_budget, action="append", default=[],
+                        help="Latency budget ENDPOINT:PERCENTILE=MILLISECONDS, repeatable (defaults: all:p95=1000, all:p99=2500)")
+    parser.add_argument("--max-error-rate", type=float, default=0.0, help="Largest accepted share of failed requests")
+    parser.add_argument("--timeout", type=float, default=60, help="Client timeout per request in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from benchmarks.synthetic_workbook import write_workbook
+
+    budgets = {**default_budgets, **dict(args.budget)}
+    failed = False
+    server = None
+
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            if args.url is None:
+                port = free_port()
+                url = f"http://127.0.0.1:{port}"
+                server = start_server(port, directory, args.server_workers)
+            else:
+                url = args.url.rstrip("/")
+            wait_until_alive(url, server)
+
+            path = os.path.join(directory, "workbook.xlsx")
+            write_workbook(path, args.days, args.samples_per_day)
+            started = time.perf_counter()
+            dates = upload_workbook(url, path)
+            print(f"Uploaded {args.days} days x {args.samples_per_day} samples in {time.perf_counter() - started:.1f} s, "
+                  f"server at {url}")
+            print("Budgets: " + ", ".join(f"{name}:{label}={limit:.0f} ms" for (name, label), limit in budgets.items()))
+
+            plan = request_plan(dates, proportion_blends(args.blends, args.seed), args.seed)
+            if args.warm_up > 0:
+                asyncio.run(run_level(url, 1, args.warm_up, plan, args.timeout))
+
+            within_budgets = None
+            for concurrency in args.concurrency:
+                samples, elapsed = asyncio.run(run_level(url, concurrency, args.duration, plan, args.timeout))
+                summary = summarize(samples, elapsed)
+                violations = budget_violations(summary, budgets, args.max_error_rate)
+                print_level(concurrency, summary, violations)
+                failed |= bool(violations)
+                if not violations and not failed:
+                    within_budgets = concurrency
+
+            print(f"\nHighest concurrency within budgets: {within_budgets if within_budgets is not None else 'none'}")
+        finally:
+            if server is not None:
+                server.terminate()
+                try:
+                    server.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
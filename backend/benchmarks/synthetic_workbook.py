@@ -0,0 +1,59 @@
+"""
+Synthetic sieve workbooks in the layout expected by /upload/, for benchmarks and load tests.
+
+    python benchmarks/synthetic_workbook.py out.xlsx --days 365
+"""
+import argparse
+from datetime import date, timedelta
+
+import numpy as np
+from openpyxl import Workbook
+
+
+# Mesh columns of every sheet, their cumulative columns line up with `d_values` of the backend
+mesh_layout = {
+    "7-12": ["+6", "+8", "+10", "+12", "+14", "+16", "Pan"],
+    "14-30": ["+16", "+20", "+30", "+40", "Pan"],
+    "36-70": ["+30", "+40", "+50", "+70", "Pan"],
+    "80-180": ["+50", "+70", "+80", "+100", "+120", "Pan"],
+    "220F": ["+140", "+200", "+230", "+270", "Pan"],
+}
+
+
+def write_workbook(path, days=365, samples_per_day=2, start=date(2020, 1, 1), seed=0):
+    """
+    Writes a workbook with `samples_per_day` samples per day for `days` days. The sheets other than
+    7-12 skip every fifth day, so nearest past lookups are exercised.
+    """
+    rng = np.random.default_rng(seed)
+    workbook = Workbook(write_only=True)
+
+    for sheet_name, mesh in mesh_layout.items():
+        sheet = workbook.create_sheet(sheet_name)
+        columns = ["Samples No.", "Received Date", *mesh, "Total", "Loose Bulk Density (gm/cc)", "Sp. gravity"]
+        sheet.append([])
+        sheet.append([])
+        sheet.append(columns)
+        sheet.append([""] * len(columns))
+
+        for day in range(days):
+            if sheet_name != "7-12" and day % 5 == 3:
+                continue
+            received = (start + timedelta(days=day)).strftime("%d.%m.%y")
+            for sample in range(samples_per_day):
+                fractions = rng.random(len(mesh)) + 0.1
+                fractions = np.round(fractions / fractions.sum() * 100, 3)
+                sheet.append([f"S{day}-{sample}", received, *fractions.tolist(), 100.0,
+                              round(1.5 + rng.random() * 0.1, 4), round(3.5 + rng.random() * 0.2, 4)])
+
+    workbook.save(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--samples-per-day", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_workbook(args.path, args.days, args.samples_per_day, seed=args.seed)
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Importing the app opens its result store, the tests use a throwaway one
+os.environ.setdefault("RESULT_STORE_PATH", os.path.join(tempfile.mkdtemp(), "results.sqlite3"))
@@ -0,0 +1,107 @@
+"""
+Parity of the kernel backends (app/kernels.py), and of the golden-section fit of the batch paths with
+the curve_fit fit of the single-date endpoints.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from app import kernels
+from app.updated_model import optimize_q, optimize_q_batch, calculate_errors_and_mae, calculate_mae_batch
+
+requires_numba = pytest.mark.skipif(kernels.numba is None, reason="numba is not installed")
+backends = ["numpy", pytest.param("numba", marks=requires_numba)]
+
+
+@pytest.fixture
+def backend(request):
+    previous = kernels.backend
+    yield kernels.use_backend(request.param)
+    kernels.use_backend(previous)
+
+
+@pytest.fixture(scope="module")
+def kernel_inputs():
+    rng = np.random.default_rng(0)
+    curves, rows = 500, 24
+    D = np.broadcast_to(np.sort(rng.uniform(40, 3500, rows))[::-1], (curves, rows)).copy()
+    valid = rng.random((curves, rows)) > 0.2
+    D_min = np.where(valid, D, np.inf).min(axis=1)
+    D_max = np.where(valid, D, -np.inf).max(axis=1)
+    pct_CPFT = np.sort(rng.uniform(1, 100, (curves, rows)), axis=1)[:, ::-1].copy()
+    pct_CPFT[rng.random((curves, rows)) > 0.8] = 0
+    carry = rng.random((curves, rows)) > 0.7
+    return D, D_min, D_max, valid, pct_CPFT, carry
+
+
+@pytest.fixture(scope="module")
+def cube(tmp_path_factory):
+    from benchmarks.synthetic_workbook import write_workbook
+    from app.sieve_cube import SieveCube
+    from app.updated_main import required_sheets, d_values, excluded_columns
+    from app.updated_model import read_excel_file_streaming, clean_data
+
+    path = tmp_path_factory.mktemp("workbook") / "workbook.xlsx"
+    write_workbook(path, days=60)
+    return SieveCube.from_sheets(clean_data(read_excel_file_streaming(path, required_sheets)), d_values, excluded_columns)
+
+
+@requires_numba
+def test_andreasen_cpft_backends_agree(kernel_inputs):
+    D, D_min, D_max, _, _, _ = kernel_inputs
+    expected = kernels.andreasen_cpft_numpy(D, 0.3, D_min[:, None], D_max[:, None])
+    assert np.allclose(kernels.andreasen_cpft_numba(D, 0.3, D_min[:, None], D_max[:, None]), expected, equal_nan=True)
+
+
+@requires_numba
+def test_golden_section_q_backends_agree(kernel_inputs):
+    D, D_min, D_max, valid, pct_CPFT, _ = kernel_inputs
+    expected = kernels.golden_section_q_numpy(D, D_min, D_max, valid, pct_CPFT / 100, 0.1, 0.5, 60)
+    result = kernels.golden_section_q_numba(D, D_min, D_max, valid, pct_CPFT / 100, 0.1, 0.5, 60)
+    # The squared errors are summed in another order, the search can end a few 1e-8 apart on flat errors
+    assert np.allclose(result, expected, rtol=0, atol=1e-6)
+
+
+@requires_numba
+def test_mean_absolute_error_backends_agree(kernel_inputs):
+    D, D_min, D_max, valid, pct_CPFT, _ = kernel_inputs
+    q = np.linspace(0.1, 0.5, len(D))
+    expected = kernels.mean_absolute_error_numpy(D, D_min, D_max, valid, pct_CPFT, q)
+    assert np.allclose(kernels.mean_absolute_error_numba(D, D_min, D_max, valid, pct_CPFT, q), expected)
+
+
+@requires_numba
+def test_carry_forward_backends_agree(kernel_inputs):
+    _, _, _, _, pct_CPFT, carry = kernel_inputs
+    expected = kernels.carry_forward_numpy(pct_CPFT.copy(), carry)
+    assert np.allclose(kernels.carry_forward_numba(pct_CPFT.copy(), carry), expected)
+
+
+@pytest.mark.parametrize("backend", backends, indirect=True)
+@pytest.mark.parametrize("proportions", [[0.35, 0.20, 0.15, 0.10, 0.20], [0.2] * 5, [0.5, 0.1, 0.1, 0.1, 0.2]])
+def test_optimize_q_batch_matches_curve_fit(backend, cube, proportions):
+    from app.updated_main import updated_sheets
+    from app.updated_model import add_columns_stack, get_sheet_constants_from_proportions
+
+    proportions_dict = dict(zip(updated_sheets, proportions))
+    packing_density = 0.85
+    rows = cube.rows_for(cube.sheet_dates(updated_sheets[0]))
+    sheet_cpft, sheet_proportions = cube.cpft_rows(rows, proportions_dict)
+    D_values, _, interpolation, keep = add_columns_stack(
+        sheet_cpft, cube.mesh_plan, sheet_proportions, proportions_dict, get_sheet_constants_from_proportions(proportions_dict))
+    pct_CPFT = interpolation * packing_density
+
+    q = optimize_q_batch(D_values, pct_CPFT, mask=keep)
+    mae = calculate_mae_batch(D_values, pct_CPFT, q, mask=keep)
+
+    expected_q, expected_mae = [], []
+    for curve in pct_CPFT:
+        df = pd.DataFrame({"D_value": D_values[keep], "pct_poros_CPFT": curve[keep]})
+        expected_q.append(optimize_q(df, D_col="D_value", pct_CPFT_col="pct_poros_CPFT"))
+        expected_mae.append(calculate_errors_and_mae(df, D_col="D_value", pct_CPFT_col="pct_poros_CPFT", q=expected_q[-1])[1])
+
+    assert np.allclose(q, expected_q, rtol=0, atol=1e-6)
+    assert np.allclose(mae, expected_mae, rtol=0, atol=1e-6)
+    # The endpoints report 4 decimals, both fits must give the same reported values
+    assert np.array_equal(np.round(q, 4), np.round(expected_q, 4))
+    assert np.array_equal(np.round(mae, 4), np.round(expected_mae, 4))
@@ -3,9 +3,11 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import requests
+import json
 from datetime import datetime
 import time
 from streamlit_autorefresh import st_autorefresh
+from websocket import create_connection, WebSocketException
 import threading
 
 def plot_q_value_regression(df):
@@ -115,6 +117,110 @@ uploaded_file = st.file_uploader("Upload a CSV or Excel file", type=["csv", "xls
 
 BASE_URL ="https://cumi-dashboard.onrender.com"
 
+REQUEST_TIMEOUT = 120  # seconds, single-date calculations should finish well within this
+JOB_POLL_INTERVAL = 1  # seconds between job status checks
+
+def run_backend_job(endpoint, params):
+    """
+    Submits a background job to the backend, shows its progress and returns the response holding the job result.
+    """
+    submit_response = requests.post(f"{BASE_URL}{endpoint}", params=params, timeout=REQUEST_TIMEOUT)
+    if submit_response.status_code != 200:
+        return submit_response
+
+    job_id = submit_response.json()["job_id"]
+    progress_bar = st.progress(0.0, text="⏳ Job queued...")
+
+    while True:
+        status = requests.get(f"{BASE_URL}/jobs/{job_id}", timeout=REQUEST_TIMEOUT).json()
+        total = status.get("total") or 1
+        eta = status.get("eta_seconds")
+        eta_text = f", about {eta:.0f}s left" if eta else ""
+        progress_bar.progress(min(status["processed"] / total, 1.0),
+                              text=f"⏳ Processed {status['processed']} of {total} dates{eta_text}")
+
+        if status["status"] in ("completed", "failed", "cancelled"):
+            break
+        time.sleep(JOB_POLL_INTERVAL)
+
+    progress_bar.empty()
+    return requests.get(f"{BASE_URL}/jobs/{job_id}/result", timeout=REQUEST_TIMEOUT)
+
+def stream_backend_rows(endpoint, params):
+    """
+    Reads newline-delimited JSON rows from the backend and shows each row as soon as it arrives.
+    Returns the response and the list of received rows.
+    """
+    rows = []
+    table_placeholder = st.empty()
+
+    with requests.get(f"{BASE_URL}{endpoint}", params=params, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        if response.status_code != 200:
+            response.content  # Read the error body before the connection is closed
+            return response, rows
+
+        for line in response.iter_lines():
+            if line:
+                rows.append(json.loads(line))
+                table_placeholder.dataframe(pd.DataFrame(rows), hide_index=True)
+
+    table_placeholder.empty()
+    return response, rows
+
+def live_update(message):
+    """
+    Sends the current inputs over the session's live WebSocket and returns the backend's reply. The
+    connection is kept across reruns, so the backend only recomputes the stages whose inputs changed.
+    """
+    socket = st.session_state.get("live_socket")
+    for _ in range(2):
+        try:
+            if socket is None:
+                socket = create_connection(f"{BASE_URL.replace('http', 'ws', 1)}/ws/live/", timeout=REQUEST_TIMEOUT)
+                st.session_state["live_socket"] = socket
+            socket.send(json.dumps(message))
+            return json.loads(socket.recv())
+        except (WebSocketException, OSError):
+            # Reconnect once, e.g. after the backend restarted (every message carries all inputs)
+            socket = None
+            st.session_state["live_socket"] = None
+
+    return {"type": "error", "detail": "Could not reach the live recompute service."}
+
+def proportions_editor(key):
+    """
+    Shows the editable mixing proportions table and returns the proportions as the comma separated
+    query string, or None (with the error shown) when one is negative or they do not sum up to 1.
+    """
+    proportions_df = pd.DataFrame({
+        "Sheet": ["H(7-12)", "H(14-30)", "H(36-70)", "H(80-180)", "H(220)"],
+        "Proportion": st.session_state["proportions"]
+    })
+
+    updated_proportions_df = st.data_editor(
+        proportions_df,
+        num_rows="fixed",  # Prevent adding/removing rows
+        column_config={"Proportion": st.column_config.NumberColumn(format="%.4f", min_value=0.0)},
+        hide_index=True,
+        key=key
+    )
+
+    updated_proportions = updated_proportions_df["Proportion"].tolist()
+    total_proportion = sum(updated_proportions)
+
+    # ✅ Check if any proportion is negative
+    if any(p < 0 for p in updated_proportions):
+        st.error("❌ Proportion values cannot be negative. Please enter positive values.")
+        return None
+
+    # ✅ Ensure total proportion is exactly 1 before proceeding
+    if total_proportion != 1:
+        st.error(f"⚠️ The sum of all proportions must be exactly 1. Currently: {total_proportion:.4f}")
+        return None
+
+    st.session_state["proportions"] = updated_proportions
+    return ",".join(map(str, updated_proportions))
+
 available_dates = None
 selected_date = None
 sample_data = None
@@ -144,13 +250,17 @@ if uploaded_file:
 
     #  # Now upload the file
     # with st.spinner("⏳ Uploading file... Please wait..."):
-    response = requests.post(f"{BASE_URL}/upload/", files=files)
+    response = requests.post(f"{BASE_URL}/upload/", files=files, timeout=REQUEST_TIMEOUT)
 
 
     if response.status_code == 200:
         result = response.json()
         date_range = result.get("date_range", [])
 
+        # ✅ Columns missing from the layout that do not stop the upload
+        for warning in result.get("warnings", []):
+            st.warning(f"⚠️ {warning}")
+
         if date_range and len(date_range) == 2:
             min_date = datetime.strptime(date_range[0], "%Y-%m-%d")
             max_date = datetime.strptime(date_range[1], "%Y-%m-%d")
@@ -158,6 +268,26 @@ if uploaded_file:
             formatted_date_range = [min_date.strftime("%d-%m-%Y"), max_date.strftime("%d-%m-%Y")]
             st.write(f"Available date range: **{formatted_date_range[0]} to {formatted_date_range[1]}**")
 
+            # ✅ History precomputed by the backend after upload, no calculation needed
+            if st.checkbox("📈 Show q-value & GBD history (default proportions)"):
+                history_response = requests.get(f"{BASE_URL}/history/", params={"page_size": 1000}, timeout=REQUEST_TIMEOUT)
+
+                if history_response.status_code == 200:
+                    history = history_response.json()
+                    build = history["build"]
+                    if build["status"] != "completed":
+                        st.info(f"⏳ History is still being built: {build['processed']} of {build['total']} dates done.")
+
+                    history_df = pd.DataFrame(history["rows"])
+                    if "error" in history_df.columns:
+                        history_df = history_df[history_df["error"].isna()].drop(columns=["error"])
+
+                    if not history_df.empty:
+                        st.line_chart(history_df.set_index("Date")[["q_value", "modified_q", "double_modified_q"]])
+                        st.dataframe(history_df, hide_index=True)
+                else:
+                    st.error(f"❌ Error retrieving history: {history_response.text}")
+
 
             selected_date = st.date_input("Select a date:", value=None, format="DD-MM-YYYY")
 
@@ -170,7 +300,7 @@ if uploaded_file:
                     formatted_selected_date = selected_date_dt.strftime("%d-%m-%Y")
 
                     if st.button("🔍 Verify Sample Data"):
-                        sample_response = requests.get(f"{BASE_URL}/get_sample_data/", params={"selected_date": formatted_selected_date})
+                        sample_response = requests.get(f"{BASE_URL}/get_sample_data/", params={"selected_date": formatted_selected_date}, timeout=REQUEST_TIMEOUT)
 
                         if sample_response.status_code == 200:
                             sample_data = sample_response.json().get("sample_data", {})
@@ -191,7 +321,7 @@ if uploaded_file:
 
                     
 
-                    calculation_type = st.selectbox("Select Calculation Type:", ["Select", "GBD Values", "q-Values"])
+                    calculation_type = st.selectbox("Select Calculation Type:", ["Select", "GBD Values", "q-Values", "Compare All Methods", "Date Range Trend", "Live Preview"])
 
                     calculate_button_label = None
                     packing_density = None
@@ -371,6 +501,76 @@ if uploaded_file:
                                 calculate_button_label = f"Calculate {q_type}"
  
 
+                    elif calculation_type == "Compare All Methods":
+                        st.session_state["table_width"] = "auto"  # Force reset width
+                        st.write("### 📊 Edit Mixing Proportions")
+                        proportions_query = proportions_editor("compare_proportions")
+
+                        if proportions_query is not None:
+                            porosity_input = st.text_input("Enter Porosity (value should be between 0-1):")
+
+                            if porosity_input:
+                                try:
+                                    porosity = float(porosity_input.strip())
+                                    if 0 <= porosity <= 1:
+                                        packing_density = 1 - porosity  # ✅ Convert to Packing Density
+                                        calculate_button_label = f"Compare GBD and q-values with Porosity: {porosity}"
+                                    else:
+                                        st.error("❌ Please enter a valid Porosity value between 0 and 1.")
+                                except ValueError:
+                                    st.error("❌ Please enter a numeric value for Porosity.")
+
+                    elif calculation_type == "Date Range Trend":
+                        end_date = st.date_input("Select the end date:", value=max_date, min_value=selected_date_dt, max_value=max_date, format="DD-MM-YYYY")
+                        formatted_end_date = datetime.combine(end_date, datetime.min.time()).strftime("%d-%m-%Y")
+                        stream_results = st.checkbox("⚡ Show results as each date is computed", value=True)
+                        smoothing = st.selectbox("Smooth sieve data over:", ["No smoothing", "7 days", "30 days"])
+                        window_days = {"7 days": 7, "30 days": 30}.get(smoothing)
+
+                        st.write("### 📊 Edit Mixing Proportions")
+                        proportions_query = proportions_editor("trend_proportions")
+
+                        if proportions_query is not None:
+                            porosity_input = st.text_input("Enter Porosity (value should be between 0-1):")
+
+                            if porosity_input:
+                                try:
+                                    porosity = float(porosity_input.strip())
+                                    if 0 <= porosity <= 1:
+                                        packing_density = 1 - porosity  # ✅ Convert to Packing Density
+                                        calculate_button_label = f"Calculate trend from {formatted_selected_date} to {formatted_end_date}"
+                                    else:
+                                        st.error("❌ Please enter a valid Porosity value between 0 and 1.")
+                                except ValueError:
+                                    st.error("❌ Please enter a numeric value for Porosity.")
+
+                    elif calculation_type == "Live Preview":
+                        st.write("### ⚡ Live Preview")
+                        st.caption("GBD and q-values update as you edit the proportions and porosity, no button needed.")
+
+                        proportions_query = proportions_editor("live_proportions")
+                        live_porosity = st.number_input("Porosity (value should be between 0-1):", min_value=0.0, max_value=1.0, value=0.15, step=0.01, key="live_porosity")
+
+                        # ✅ The backend keeps this session's pipeline and only reruns what the edit affects
+                        if proportions_query is not None:
+                            live_reply = live_update({
+                                "selected_date": formatted_selected_date,
+                                "updated_proportions": proportions_query,
+                                "packing_density": round(1 - live_porosity, 6)
+                            })
+
+                            if live_reply.get("type") == "error":
+                                st.error(f"⚠️ {live_reply.get('detail')}")
+                            else:
+                                live_results = live_reply["results"]
+                                gbd_column, andreasen_column, modified_column, double_modified_column = st.columns(4)
+                                gbd_column.metric(f"GBD ({live_porosity:.0%} porosity)", live_results["gbd"])
+                                andreasen_column.metric("Andreasen q", live_results["q_value"], help=f"R² = {live_results['r_squared']}")
+                                modified_column.metric("Modified Andreasen q", live_results["modified_q"], help=f"MAE = {live_results['mae']}")
+                                double_modified_column.metric("Double Modified q", live_results["double_modified_q"])
+                                st.caption(f"Total volume {live_results['total_volume']}, specific gravity {live_results['specific_gravity']} g/cc. "
+                                           f"Recomputed in {live_reply['elapsed_ms']} ms: {', '.join(live_reply['recomputed']) or 'nothing changed'}.")
+
                     # ✅ Button to trigger calculations
                      
                     if calculate_button_label and st.button(calculate_button_label):
@@ -381,33 +581,59 @@ if uploaded_file:
                                 "selected_date": formatted_selected_date,
                                 "packing_density": packing_density
                             }
+                            streamed_result = None
 
 
                             if calculation_type == "GBD Values":
                                 
                                 payload["updated_proportions"] = ",".join(map(str, updated_proportions))  # ✅ Send only for GBD
                                 
-                                response = requests.get(f"{BASE_URL}/calculate_gbd/", params=payload)
+                                response = requests.get(f"{BASE_URL}/calculate_gbd/", params=payload, timeout=REQUEST_TIMEOUT)
+
+                            elif calculation_type == "Compare All Methods":
+
+                                payload["updated_proportions"] = proportions_query
+
+                                response = requests.get(f"{BASE_URL}/calculate_all/", params=payload, timeout=REQUEST_TIMEOUT)
+
+                            elif calculation_type == "Date Range Trend":
+
+                                range_params = {
+                                    "start_date": formatted_selected_date,
+                                    "end_date": formatted_end_date,
+                                    "packing_density": packing_density,
+                                    "updated_proportions": proportions_query
+                                }
+                                if window_days:
+                                    range_params["window_days"] = window_days  # ✅ Rolling-window averages
+
+                                if stream_results:
+                                    # ✅ Rows are rendered as the backend streams them
+                                    response, streamed_rows = stream_backend_rows("/calculate_range/stream/", range_params)
+                                    streamed_result = {"results": streamed_rows}
+                                else:
+                                    # ✅ Long computation, run as a background job and poll its progress
+                                    response = run_backend_job("/jobs/range/", range_params)
 
                             elif q_type == "q-value using Andreasen Eq.":
                                 # payload["updated_proportions"] = ",".join(map(str, updated_proportions))
                             
-                                response = requests.get(f"{BASE_URL}/calculate_q_value/", params={"selected_date": formatted_selected_date, "updated_proportions": ",".join(map(str, updated_proportions))})
+                                response = requests.get(f"{BASE_URL}/calculate_q_value/", params={"selected_date": formatted_selected_date, "updated_proportions": ",".join(map(str, updated_proportions))}, timeout=REQUEST_TIMEOUT)
                                 print(response.status_code)
                             elif q_type == "q-value using Modified Andreasen Eq.":
                                 
                                 payload["updated_proportions"] = ",".join(map(str, updated_proportions))
 
-                                response = requests.get(f"{BASE_URL}/calculate_q_value_modified_andreason/", params=payload)
+                                response = requests.get(f"{BASE_URL}/calculate_q_value_modified_andreason/", params=payload, timeout=REQUEST_TIMEOUT)
 
                             
                             elif q_type == "q-value using Double Modified Andreasen Eq.":
                                 # payload["updated_proportions"] = ",".join(map(str, updated_proportions_dmod))
 
-                                response = requests.get(f"{BASE_URL}/calculate_q_value_double_modified/", params = {"selected_date": formatted_selected_date, "updated_proportions": ",".join(map(str, updated_proportions))})
+                                response = requests.get(f"{BASE_URL}/calculate_q_value_double_modified/", params = {"selected_date": formatted_selected_date, "updated_proportions": ",".join(map(str, updated_proportions))}, timeout=REQUEST_TIMEOUT)
 
                             if response.status_code == 200:
-                                result = response.json()
+                                result = streamed_result if streamed_result is not None else response.json()
 
                                 if calculation_type == "GBD Values":
                                     total_volume = result.get("total_volume")
@@ -426,6 +652,45 @@ if uploaded_file:
                                         print("GBD Done!")
                                         # st.write(f"- **GBD for {formatted_density}% Packing Density:** `{gbd:.4f} g/cc`")
 
+                                elif calculation_type == "Compare All Methods":
+                                    gbd = result.get("gbd", {})
+                                    andreasen_q = result.get("andreasen", {}).get("q_values", [{}])[0]
+                                    modified_q = result.get("modified_andreasen", {}).get("q_values", [{}])[0]
+                                    double_modified_q = result.get("double_modified", {}).get("double_modified_q_values", [{}])[0]
+
+                                    st.write("## Results")
+                                    st.write(f"**🔹 Total Volume of the Mix:** `{gbd.get('total_volume', 0):.4f}`")
+                                    st.write(f"**🔹 Specific Gravity of the Mix:** `{gbd.get('specific_gravity', 0):.4f} g/cc`")
+                                    for density, gbd_value in gbd.get("gbd_values", {}).items():
+                                        porosity_value = 100 - int(float(density) * 100)
+                                        st.write(f"- **GBD for {porosity_value}% Porosity:** `{gbd_value:.4f} g/cc`")
+
+                                    # ✅ Side-by-side comparison of the three q-value methods
+                                    comparison_df = pd.DataFrame([
+                                        {"Method": "Andreasen Eq.", "q-value": andreasen_q.get("q-value"), "R² / MAE": andreasen_q.get("r-squared")},
+                                        {"Method": "Modified Andreasen Eq.", "q-value": next((v for k, v in modified_q.items() if k != "Date"), None), "R² / MAE": result.get("modified_andreasen", {}).get("mae")},
+                                        {"Method": "Double Modified Andreasen Eq.", "q-value": double_modified_q.get("q_value"), "R² / MAE": None},
+                                    ])
+                                    st.write("### **q-Value Comparison**")
+                                    st.dataframe(comparison_df, hide_index=True)
+
+                                elif calculation_type == "Date Range Trend":
+                                    trend_df = pd.DataFrame(result.get("results", []))
+
+                                    st.write("## Results")
+                                    if "error" in trend_df.columns:
+                                        failed_dates = trend_df[trend_df["error"].notna()]
+                                        if not failed_dates.empty:
+                                            st.warning(f"⚠️ {len(failed_dates)} date(s) could not be calculated.")
+                                        trend_df = trend_df[trend_df["error"].isna()].drop(columns=["error"])
+
+                                    if not trend_df.empty:
+                                        st.write("### 📈 **q-Value Trend**")
+                                        st.line_chart(trend_df.set_index("Date")[["q_value", "modified_q", "double_modified_q"]])
+                                        st.write("### 📈 **GBD Trend**")
+                                        st.line_chart(trend_df.set_index("Date")[["gbd"]])
+                                        st.dataframe(trend_df, hide_index=True)
+
                                 elif q_type == "q-value using Andreasen Eq.":
                                     
                                     st.write("## Results")
@@ -558,13 +823,20 @@ if uploaded_file:
                             else:
                                 st.error(f"❌ Error calculating {calculation_type}. Backend response: {response.text}")
 
+                        except requests.exceptions.Timeout:
+                            st.error(f"⏳ The server did not respond within {REQUEST_TIMEOUT} seconds. Please try again, or use 'Date Range Trend' for long computations.")
+
                         except Exception as e:
                             st.error(f"❌ Exception: {str(e)}")
         else:
             st.error("❌ Error: Could not retrieve date range. Please check your file.")
 
     else:
-        st.error(f"❌ Error uploading file: {response.json().get('detail', 'Unknown error')}. \n\n⚠️ Please check your file format and ensure all required sheets/columns are included.")
+        detail = response.json().get('detail', 'Unknown error')
+        if isinstance(detail, dict):
+            # ✅ Layout problems found by the backend before parsing, one per line
+            detail = detail.get("message", "Invalid workbook") + ":\n" + "\n".join(f"- {problem}" for problem in detail.get("problems", []))
+        st.error(f"❌ Error uploading file: {detail} \n\n⚠️ Please check your file format and ensure all required sheets/columns are included.")
                             
           
                             